@@ -1,14 +1,65 @@
 import os
+import sys
 import csv
 import json
-import praw
+import asyncio
 import tkinter as tk
 from tkinter import ttk, filedialog, messagebox
 from threading import Thread
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from tkinter.ttk import Progressbar
-from concurrent.futures import ThreadPoolExecutor, as_completed
+
+# Shared fetch engine and tracing hooks (set TRACE_FILE=trace.json to record spans,
+# REDDIT_API_URL=http://127.0.0.1:8080 to use a local mock server)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
+from tracing import span, traced
+from fetchEngine import RedditClient, FetchEngine, Listing, Sink, CommentBudget
+from redditStream import StreamPipeline, CsvStreamSink, ServiceScorer, keyword_filter
+
+
+def format_time(created_utc):
+    return datetime.fromtimestamp(created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class CsvSink(Sink):
+    """Appends the posts and their comments to the CSV files written by RedditFetcher.save_data."""
+
+    def __init__(self, subreddit, query, JSON_DUMP=False):
+        self.subreddit = subreddit
+        self.query = query
+        self.JSON_DUMP = JSON_DUMP
+        self.posts = []
+
+    def write(self, post, comments):
+        post_data = {
+            "post_id": post.id,
+            "title": post.title,
+            "body": post.selftext,
+            "subreddit": post.subreddit,
+            "upvotes": post.score,
+            "comments": post.num_comments,
+            "date_time": format_time(post.created_utc),
+            "author": post.author if post.author != "[deleted]" else "[Deleted]",
+        }
+        self.posts.append(post_data)
+        RedditFetcher.save_data(self.subreddit, self.query, [post_data], self.JSON_DUMP)
+
+        comment_rows = [{
+            "post_id": post.id,
+            "comment_id": comment.id,
+            "title": post.title,
+            "body": comment.body,
+            "subreddit": post.subreddit,
+            "upvotes": comment.score,
+            "comments": 0,
+            "date_time": format_time(comment.created_utc),
+            "author": comment.author if comment.author != "[deleted]" else "[Deleted]",
+        } for comment in comments]
+        # Comments go to the folder of the post's own subreddit (which differs from self.subreddit for r/all)
+        if comment_rows:
+            RedditFetcher.save_data(post.subreddit, self.query, comment_rows, self.JSON_DUMP)
+
 
 class RedditFetcher:
     def __init__(self, gui_update_callback=None):
@@ -29,7 +80,7 @@ class RedditFetcher:
             raise ValueError("Please set the environment variables USER, PASSWORD, CLIENT_ID, and CLIENT_SECRET.")
 
     def _initialize_reddit(self):
-        return praw.Reddit(
+        return RedditClient(
             client_id=self.client_id,
             client_secret=self.client_secret,
             user_agent="my user agent",
@@ -37,6 +88,7 @@ class RedditFetcher:
             password=self.password
         )
 
+    @traced("RedditFetcher.fetch_reddit_data")
     def fetch_reddit_data(self, subreddit, query, limit, sort, time_filter, safe_search, JSON_DUMP):
         # Validate input
         assert 1 <= limit <= 10000, "Limit must be between 1 and 10000."
@@ -49,87 +101,81 @@ class RedditFetcher:
             subreddit = "all"
             
         try:
-            subreddit_instance = self.reddit_instance.subreddit(subreddit)
-            posts = []
-
             self.gui_update_callback(0, "Fetching posts...")
 
             # Fetch posts based on query or sort option
-            data_fetcher = None
             if query:
-                data_fetcher = subreddit_instance.search(query=query, limit=limit, sort=sort, time_filter=time_filter, params={"include_over_18": safe_search})
+                listing = Listing(subreddit, sort, query, time_filter, limit, params={"include_over_18": safe_search})
             else:
                 match sort:
-                    case "hot":
-                        data_fetcher = subreddit_instance.hot(limit=limit)
+                    case "hot" | "relevance":
+                        listing = Listing(subreddit, "hot", limit=limit)
                     case "top":
-                        data_fetcher = subreddit_instance.top(limit=limit)
-                    case "relevance":
-                        data_fetcher = subreddit_instance.hot(limit=limit)
+                        listing = Listing(subreddit, "top", limit=limit)
                     case _:
-                        data_fetcher = subreddit_instance.new(limit=limit)
-                    
-
-            for i, post in enumerate(data_fetcher):
-                post_data = {
-                    "post_id": post.id,
-                    "title": post.title,
-                    "body": post.selftext,
-                    "subreddit": str(post.subreddit),
-                    "upvotes": post.score,
-                    "comments": post.num_comments,
-                    "date_time":  datetime.fromtimestamp(post.created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                    "author": post.author.name if post.author else "[Deleted]",
-                }
-                posts.append(post_data)
-                self.gui_update_callback(int((i/limit) * 100), f"Fetching posts {i}/{limit}...")
+                        listing = Listing(subreddit, "new", limit=limit)
 
             # self.remove_previous_data(subreddit)
-        
-            self.save_data(subreddit, query, posts, JSON_DUMP)
-
-            completed_requests = 0
-            total_requests = len(posts)
-            with ThreadPoolExecutor(max_workers=2) as executor:
-                futures = [executor.submit(self.fetch_comments, post["subreddit"],query ,post["post_id"], post["title"], JSON_DUMP) for post in posts]
-                for future in as_completed(futures):
-                    future.result()
-                    completed_requests += 1
-                    self.gui_update_callback(int((completed_requests/total_requests) * 100), f"Fetching comments {completed_requests}/{total_requests}...")
-
-            self.gui_update_callback(100, "Fetch Completed!")
-            return posts
+
+            sink = CsvSink(subreddit, query, JSON_DUMP)
+            errors = []
+            engine = FetchEngine(
+                self.reddit_instance,
+                sinks=[sink],
+                comment_filters=[lambda comment, post: comment.body in ("[deleted]", "[removed]")],
+                budget=CommentBudget(max_calls=5),
+                on_progress=self._report_progress,
+                on_error=lambda post, error: errors.append(error),
+            )
+            stats = asyncio.run(self._run(engine, listing))
+            if errors:
+                raise Exception(f"Error fetching comments: {str(errors[0])}")
+
+            # Posts whose comments were cut short by the budget (details in engine.truncations)
+            if stats["truncated"]:
+                self.gui_update_callback(100, f"Fetch Completed! ({stats['truncated']} posts with truncated comments)")
+            else:
+                self.gui_update_callback(100, "Fetch Completed!")
+            return sink.posts
         except Exception as e:
             self.gui_update_callback(0, f"Error: {str(e)}")
             raise Exception(f"Error fetching Reddit data: {str(e)}")
 
-    def fetch_comments(self, subreddit, query, post_id, post_title=None, JSON_DUMP=False):
+    async def _run(self, engine, listing):
         try:
-            submission = self.reddit_instance.submission(post_id)
-            comments = []
-            submission.comments.replace_more(limit=5)
-
-            self.gui_update_callback(0, f"Fetching comments for post {post_id}...")
-            for comment in submission.comments.list():
-                if comment.body in ("[deleted]","[removed]"):
-                    continue
-                comments.append({
-                    "post_id": submission.id,
-                    "comment_id": comment.id,
-                    "title": post_title,
-                    "body": comment.body,
-                    "subreddit": subreddit,
-                    "upvotes": comment.score,
-                    "comments": 0, 
-                    "date_time": datetime.fromtimestamp(comment.created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                    "author": comment.author.name if comment.author else "[Deleted]",
-                })
-
-            if comments:
-                self.save_data(subreddit, query, comments, JSON_DUMP)
-            return comments
-        except Exception as e:
-            raise Exception(f"Error fetching comments: {str(e)}")
+            return await engine.run(listing)
+        finally:
+            # The connection pool belongs to this event loop
+            await self.reddit_instance.close()
+
+    @traced("RedditFetcher.stream_reddit_data")
+    def stream_reddit_data(self, subreddits, keywords=(), exclude=(), service_url=None, duration=None,
+                           output_file=None):
+        """Follow the new posts and comments of the subreddits and append them, scored, to a CSV (see redditStream.py)"""
+        output_file = output_file or os.path.join(f"data_{'+'.join(subreddits)}", "stream_posts.csv")
+        pipeline = StreamPipeline(
+            self.reddit_instance,
+            subreddits,
+            filters=[keyword_filter(keywords, exclude)],
+            keywords=keywords,
+            scorer=ServiceScorer(service_url) if service_url else None,
+            sinks=[CsvStreamSink(output_file)],
+        )
+        if self.gui_update_callback:
+            self.gui_update_callback(0, f"Streaming r/{'+'.join(subreddits)} to {output_file}...")
+        return asyncio.run(self._run_stream(pipeline, duration))
+
+    async def _run_stream(self, pipeline, duration):
+        try:
+            return await pipeline.run(duration=duration)
+        finally:
+            await self.reddit_instance.close()
+
+    def _report_progress(self, stage, done, total):
+        if stage == "listing":
+            self.gui_update_callback(min(int((done / total) * 100), 100), f"Fetching posts {done}/{total}...")
+        else:
+            self.gui_update_callback(min(int((done / total) * 100), 100), f"Fetching comments {done}/{total}...")
         
     @staticmethod
     def remove_previous_data(subreddit):
@@ -153,11 +199,13 @@ class RedditFetcher:
 
         csv_file = os.path.join(folder_name, f"{query if not subreddit else subreddit}_posts.csv")
         file_exists = os.path.isfile(csv_file)
-        with open(csv_file, "a", newline="", encoding="utf-8") as f:
+        with span("save_data.csv", rows=len(posts)) as s, open(csv_file, "a", newline="", encoding="utf-8") as f:
+            start = f.tell()
             writer = csv.DictWriter(f, fieldnames=['post_id','comment_id','title', 'body', 'subreddit', 'upvotes', 'comments', 'date_time', 'author'])
             if not file_exists:
                 writer.writeheader()
             writer.writerows(posts)
+            s.add(bytes=f.tell() - start)
 
         if JSON_DUMP:
             json_file = os.path.join(folder_name, f"{query}_posts.json")
@@ -1,9 +1,13 @@
 import asyncio
-from asyncpraw import Reddit
 import json
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 import os
+import sys
+
+# Shared fetch engine (set REDDIT_API_URL to use a local mock server)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
+from fetchEngine import RedditClient, FetchEngine, Listing, CollectSink, CommentBudget, nest_comments
 
 load_dotenv()
 
@@ -12,9 +16,13 @@ PASSWORD = os.getenv('PASSWORD')
 CLIENT_ID = os.getenv('CLIENT_ID') 
 CLIENT_SECRET = os.getenv('CLIENT_SECRET') 
 
-# Initialize asyncpraw instance
+# Per-post limits of the comment expansion; everything is expanded by default.
+# e.g. CommentBudget(max_calls=50, time_limit=120) keeps megathreads from stalling the fetch
+COMMENT_BUDGET = CommentBudget()
+
+# Initialize the Reddit API client
 async def create_reddit_instance():
-    return Reddit(
+    return RedditClient(
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
         user_agent="my user agent",
@@ -22,48 +30,41 @@ async def create_reddit_instance():
         password=PASSWORD,
     )
 
+def format_time(created_utc):
+    return datetime.fromtimestamp(created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+# Recursive function to process comments and their replies
+def process_comment(comment):
+    return {
+        "ID": comment.id,
+        "Body": comment.body,
+        "Upvotes": comment.score,
+        "Created_UTC": format_time(comment.created_utc),
+        "Replies": [process_comment(reply) for reply in comment.replies]
+    }
+
 # Function to fetch top posts and their comments
-async def fetch_top_posts_with_comments(reddit, subreddit_name, json_filename, post_limit):
-    subreddit = await reddit.subreddit(subreddit_name)
-    submissions = subreddit.top(limit=post_limit, time_filter="all")  # Fetch top posts with user-defined limit
-    data = []
+async def fetch_top_posts_with_comments(reddit, subreddit_name, json_filename, post_limit, budget=COMMENT_BUDGET):
+    # Posts are fetched concurrently and "more" nodes are expanded within the budget
+    sink = CollectSink()
+    engine = FetchEngine(reddit, sinks=[sink], budget=budget)
+    await engine.run(Listing(subreddit_name, sort="top", time_filter="all", limit=post_limit))
 
-    async for submission in submissions:
-        await submission.load()  # Ensure submission data is fully loaded
-        await submission.comments.replace_more(limit=None)  # Load all comments
-        post_data = {
+    # Posts complete in any order: sort them back into the "top" order
+    data = []
+    for submission, comments in sorted(sink.posts, key=lambda item: -item[0].score):
+        data.append({
             "Title": submission.title,
             "Body": submission.selftext,
             "ID": submission.id,
             "URL": submission.url,
             "Upvotes": submission.score,
-            "Created_UTC": datetime.fromtimestamp(submission.created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
+            "Created_UTC": format_time(submission.created_utc),
             # Number of comments:
-            "Number_of_Comments": len(submission.comments.list()),
-            "Comments": []
-            
-        }
-
-        # Recursive function to process comments and their replies
-        def process_comment(comment):
-            comment_data = {
-                "ID": comment.id,
-                "Body": comment.body,
-                "Upvotes": comment.score,
-                "Created_UTC": datetime.fromtimestamp(comment.created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                "Replies": []
-            }
-            # Process replies recursively
-            if comment.replies:
-                for reply in comment.replies:
-                    comment_data["Replies"].append(process_comment(reply))
-            return comment_data
-
-        # Process top-level comments
-        for comment in submission.comments.list():
-            post_data["Comments"].append(process_comment(comment))
-
-        data.append(post_data)
+            "Number_of_Comments": len(comments),
+            # Top-level comments, with their replies nested
+            "Comments": [process_comment(comment) for comment in nest_comments(comments)]
+        })
 
     # Save to JSON
     with open(json_filename, "w", encoding="utf-8") as file:
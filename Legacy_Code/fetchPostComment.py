@@ -1,9 +1,9 @@
 import asyncio
 import threading
-from asyncpraw import Reddit
 import json
 import csv
 import os
+import sys
 from datetime import datetime, timezone
 from dotenv import load_dotenv
 from tkinter import Tk, Label, Entry, Button, StringVar, IntVar, OptionMenu, Text, DISABLED, NORMAL, END
@@ -12,6 +12,12 @@ from vaderSentiment.vaderSentiment import SentimentIntensityAnalyzer
 import text2emotion as te
 from collections import deque
 
+# Shared fetch engine and tracing hooks (set TRACE_FILE=trace.json to record spans,
+# REDDIT_API_URL=http://127.0.0.1:8080 to use a local mock server)
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "Scripts"))
+from tracing import span, traced
+from fetchEngine import RedditClient, FetchEngine, Listing, Sink, CommentBudget
+
 load_dotenv()
 
 # ======== COMPANY-SPECIFIC CONFIGURATION ========
@@ -105,9 +111,9 @@ if not CLIENT_SECRET:
 
 sentiment_analyzer = SentimentIntensityAnalyzer()
 
-# Initialize asyncpraw instance
+# Initialize the Reddit API client
 async def create_reddit_instance():
-    return Reddit(
+    return RedditClient(
         client_id=CLIENT_ID,
         client_secret=CLIENT_SECRET,
         user_agent="my user agent",
@@ -230,19 +236,22 @@ class StatusCallback:
                 self.app.progress.start(10)
                 
 
-async def analyse_comments_sentiment(submission, status_callback):
+@traced("analyse_comments_sentiment")
+def analyse_comments_sentiment(comments, status_callback):
     """Analyze comments to determine if there's significant discussion or positive emotion"""
-    await submission.comments.replace_more(limit=0)
     opinionated_comments = 0
     total_sentiment = 0
     positive_emotion_comments = 0
     
     # Analyze top 15 comments
-    for comment in submission.comments[:15]:
+    top_level_comments = [comment for comment in comments if comment.depth == 0]
+    for comment in top_level_comments[:15]:
         try:
             # Analyze both sentiment and emotions
-            sentiment = sentiment_analyzer.polarity_scores(comment.body)
-            emotions = analyze_emotions(comment.body)
+            with span("vader", rows=1, bytes=len(comment.body)):
+                sentiment = sentiment_analyzer.polarity_scores(comment.body)
+            with span("emotions", rows=1, bytes=len(comment.body)):
+                emotions = analyze_emotions(comment.body)
             
             # Check for strong opinions
             if abs(sentiment["compound"]) > SENTIMENT_THRESHOLD:
@@ -271,10 +280,151 @@ async def analyse_comments_sentiment(submission, status_callback):
         return True
     return False
 
+def post_filter_reasons(submission):
+    """Reasons to reject a post before fetching its comments"""
+    filter_reasons = []
+    
+    with span("keyword_filters", rows=1, bytes=len(submission.title) + len(submission.selftext)):
+        # Keyword check
+        if not contains_company_keywords(submission.title + submission.selftext):
+            filter_reasons.append("no relevant keywords")
+        
+        # Content relevance
+        if not is_relevant(submission):
+            filter_reasons.append("irrelevant content")
+        
+        # Flair check
+        if not has_relevant_flair(submission):
+            filter_reasons.append(f"wrong flair: {submission.link_flair_text}")
+    
+    # Upvote threshold
+    if submission.score < MIN_POST_UPVOTES:
+        filter_reasons.append(f"low upvotes ({submission.score})")
+    
+    # Sentiment check: a neutral post that passes every other check is only rejected
+    # if its comments are neutral too (see neutral_sentiment_reason)
+    with span("vader", rows=1, bytes=len(submission.selftext)):
+        is_neutral = not is_opinion_driven(submission.selftext)
+    if filter_reasons and is_neutral:
+        filter_reasons.append("neutral sentiment")
+    
+    return filter_reasons
+
+def format_time(created_utc):
+    return datetime.fromtimestamp(created_utc, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+class PostFolderSink(Sink):
+    """Writes kept posts to the posts CSV and to one folder per post, and filtered posts to filtered_posts.csv"""
+    def __init__(self, output_dir, post_writer, status_callback):
+        self.output_dir = output_dir
+        self.post_writer = post_writer
+        self.status_callback = status_callback
+        self.filtered_posts = []
+        self.progress = 10
+
+    def reject(self, submission, reasons):
+        self.status_callback(
+            f"🔴 Filtered post '{submission.title[:50]}...' "
+            f"Reasons: {', '.join(reasons)}",
+            self.progress,
+            (submission.title[:100], "filtered", ', '.join(reasons))
+        )
+
+        # Log filtered post to CSV into a new file for rejected posts
+        with span("csv_write", rows=1), open(f"{self.output_dir}/filtered_posts.csv", "a", encoding="utf-8") as filtered_file:
+            filtered_writer = csv.writer(filtered_file)
+            filtered_writer.writerow([
+                submission.id,
+                submission.title,
+                submission.selftext,
+                submission.score,
+                submission.url,
+                format_time(submission.created_utc),
+                submission.num_comments,
+                sentiment_analyzer.polarity_scores(submission.selftext)["compound"],
+                submission.link_flair_text,
+                ', '.join(reasons)
+            ])
+
+    def write(self, submission, comments):
+        filtered_comments = [{
+            "comment_id": comment.id,
+            "body": comment.body,
+            "upvotes": comment.score,
+            "created_utc": comment.created_utc,
+            "sentiment": sentiment_analyzer.polarity_scores(comment.body)
+        } for comment in comments]
+
+        # --- Store Valid Post ---
+        self.status_callback(f"🟢 Keeping post '{submission.title[:30]}...'")
+        
+        # Write to CSV
+        with span("csv_write", rows=1):
+            self.post_writer.writerow([
+                submission.id,
+                submission.title,
+                submission.selftext,
+                submission.score,
+                submission.url,
+                format_time(submission.created_utc),
+                submission.num_comments,
+                sentiment_analyzer.polarity_scores(submission.selftext)["compound"],
+                submission.link_flair_text
+            ])
+
+        # Build JSON structure
+        post_data = {
+            "post_id": submission.id,
+            "title": submission.title,
+            "body": submission.selftext,
+            "upvotes": submission.score,
+            "url": submission.url,
+            "created_utc": submission.created_utc,
+            "sentiment": sentiment_analyzer.polarity_scores(submission.selftext),
+            "flair": submission.link_flair_text,
+            "comments": filtered_comments
+        }
+        self.filtered_posts.append(post_data)
+
+        # Save individual post JSON
+        post_dir = os.path.join(self.output_dir, submission.id)
+        os.makedirs(post_dir, exist_ok=True)
+        with span("json_write", rows=1) as s, open(f"{post_dir}/post.json", "w") as f:
+            json.dump(post_data, f, indent=4)
+            s.add(bytes=f.tell())
+            self.status_callback(f"🔵 Saved JSON for post {submission.id}")
+
+        # Save comments as CSV
+        with span("csv_write", rows=len(filtered_comments)), open(f"{post_dir}/comments.csv", "w", encoding="utf-8") as comment_file:
+            comment_writer = csv.writer(comment_file)
+            comment_writer.writerow([
+                "Post  Id","Comment ID", "Body", "Upvotes", "Created UTC", "Sentiment"
+            ])
+            for comment in filtered_comments:
+                comment_writer.writerow([
+                    submission.id,
+                    comment["comment_id"],
+                    comment["body"],
+                    comment["upvotes"],
+                    format_time(comment["created_utc"]),
+                    comment["sentiment"]["compound"]
+                ])
+
+        self.status_callback(
+            f"Processing post {submission.id}",
+            self.progress,
+            (
+                submission.title[:100],
+                "accepted",
+                f"Score: {submission.score}, Comments: {submission.num_comments}, "
+                f"Sentiment: {sentiment_analyzer.polarity_scores(submission.selftext)['compound']:.2f}"
+            )
+        )
+
+@traced("fetch_posts_and_comments")
 async def fetch_posts_and_comments(reddit, subreddit_name, post_limit, post_sort, status_callback):
     try:
         status_callback(f"🟠 Connecting to r/{subreddit_name}...", 0)
-        subreddit = await reddit.subreddit(subreddit_name)
         print(TECHNICAL_KEYWORDS)
         print(REPUTATION_KEYWORDS)
         print(EXCLUDE_KEYWORDS)
@@ -295,16 +445,29 @@ async def fetch_posts_and_comments(reddit, subreddit_name, post_limit, post_sort
         sort_type, time_filter = sort_mapping.get(post_sort, ("new", None))
 
         status_callback(f"🔵 Fetching {post_limit} {post_sort} posts...", 10)
-        if sort_type == "top":
-            submissions = subreddit.top(limit=post_limit, time_filter=time_filter)
-        elif sort_type == "hot":
-            submissions = subreddit.hot(limit=post_limit)
-        else:
-            submissions = subreddit.new(limit=post_limit)
+        listing = Listing(subreddit_name, sort_type, time_filter=time_filter or "all", limit=post_limit)
 
-        filtered_posts = []
-        total_processed = 0
-        filtered_out = 0
+        def neutral_sentiment_reason(submission, comments):
+            if is_opinion_driven(submission.selftext):
+                return None
+            status_callback(
+                f"🔍 Post is neutral, analyzing comments for '{submission.title[:30]}...'"
+            )
+            if analyse_comments_sentiment(comments, status_callback):
+                return None  # Comments are opinionated
+            return "neutral sentiment (including comments)"
+
+        def comment_filtered(comment, submission):
+            # Only top-level comments are kept
+            if comment.depth > 0:
+                return True
+            if comment.score < MIN_COMMENT_UPVOTES:
+                status_callback(
+                    f"⚫ Filtered comment: {comment.body[:30]}... "
+                    f"Reasons: low votes ({comment.score})"
+                )
+                return True
+            return False
 
         with open(f"{output_dir}/{subreddit_name}_posts.csv", "w", encoding="utf-8") as post_file:
             post_writer = csv.writer(post_file)
@@ -312,190 +475,40 @@ async def fetch_posts_and_comments(reddit, subreddit_name, post_limit, post_sort
                 "Post ID", "Title", "Body", "Upvotes", "URL", 
                 "Created UTC", "Num Comments", "Sentiment", "Flair"
             ])
+            sink = PostFolderSink(output_dir, post_writer, status_callback)
+
+            def report_progress(stage, done, total):
+                if stage != "posts":
+                    return
+                sink.progress = (done / total) * 90 + 10  # 10-100% range
+                status_callback(
+                    f"⚪ Processing post {done}/{total} "
+                    f"(Kept: {len(sink.filtered_posts)}, Filtered: {engine.stats['rejected']})",
+                    sink.progress
+                )
+
+            # Posts are processed concurrently; "more" comments are not expanded (replace_more(limit=0))
+            engine = FetchEngine(
+                reddit,
+                sinks=[sink],
+                post_filters=[post_filter_reasons],
+                thread_filters=[neutral_sentiment_reason],
+                comment_filters=[comment_filtered],
+                budget=CommentBudget(max_calls=0),
+                min_comments=2,
+                on_progress=report_progress,
+                on_error=lambda submission, error: status_callback(f"⚠️ Error processing post {submission.id}: {str(error)}"),
+            )
+            stats = await engine.run(listing)
 
-            async for submission in submissions:
-                try:
-                    total_processed += 1
-                    current_progress = (total_processed / post_limit) * 90 + 10  # 10-100% range
-                    status_callback(
-                        f"⚪ Processing post {total_processed}/{post_limit} "
-                        f"(Kept: {len(filtered_posts)}, Filtered: {filtered_out})",
-                        current_progress
-                    )
-                    
-                    await submission.load()
-                    
-                    # --- Filter Checks with Logging ---
-                    filter_reasons = []
-                    
-                    # Keyword check
-                    if not contains_company_keywords(submission.title + submission.selftext):
-                        filter_reasons.append("no relevant keywords")
-                    
-                    # Content relevance
-                    if not is_relevant(submission):
-                        filter_reasons.append("irrelevant content")
-                    
-                    # Flair check
-                    if not has_relevant_flair(submission):
-                        filter_reasons.append(f"wrong flair: {submission.link_flair_text}")
-                    
-                    # Upvote threshold
-                    if submission.score < MIN_POST_UPVOTES:
-                        filter_reasons.append(f"low upvotes ({submission.score})")
-                    
-                    # Sentiment check
-                    is_neutral = not is_opinion_driven(submission.selftext)
-                    
-                    # If only rejected due to neutral sentiment, analyze comments
-                    if len(filter_reasons) == 0 and is_neutral:
-                        status_callback(
-                            f"🔍 Post is neutral, analyzing comments for '{submission.title[:30]}...'"
-                        )
-                        if await analyse_comments_sentiment(submission, status_callback):
-                            is_neutral = False  # Override neutral status if comments are opinionated
-                        else:
-                            filter_reasons.append("neutral sentiment (including comments)")
-                    elif is_neutral:
-                        filter_reasons.append("neutral sentiment")
-
-                    # Reject if any filter failed
-                    if filter_reasons:
-                        filtered_out += 1
-                        status_callback(
-                            f"🔴 Filtered post '{submission.title[:50]}...' "
-                            f"Reasons: {', '.join(filter_reasons)}",
-                            current_progress,
-                            (submission.title[:100], "filtered", ', '.join(filter_reasons))
-                        )
-
-                        # Log filtered post to CSV into a new file for rejected posts
-                        with open(f"{output_dir}/filtered_posts.csv", "a", encoding="utf-8") as filtered_file:
-                            filtered_writer = csv.writer(filtered_file)
-                            filtered_writer.writerow([
-                                submission.id,
-                                submission.title,
-                                submission.selftext,
-                                submission.score,
-                                submission.url,
-                                datetime.fromtimestamp(submission.created_utc, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                                submission.num_comments,
-                                sentiment_analyzer.polarity_scores(submission.selftext)["compound"],
-                                submission.link_flair_text,
-                                ', '.join(filter_reasons)
-                            ])
-                        continue
-
-                    
-
-                    # --- Process Comments ---
-                    status_callback(f"🟡 Processing comments for post '{submission.title[:30]}...'")
-                    filtered_comments = []
-                    await submission.comments.replace_more(limit=0)
-                    
-                    for comment in submission.comments:
-                        comment_reasons = []
-                        if comment.score < MIN_COMMENT_UPVOTES:
-                            comment_reasons.append(f"low votes ({comment.score})")
-                        # if not is_opinion_driven(comment.body):
-                        #     comment_reasons.append("neutral sentiment")
-                            
-                        if not comment_reasons:
-                            filtered_comments.append({
-                                "comment_id": comment.id,
-                                "body": comment.body,
-                                "upvotes": comment.score,
-                                "created_utc": comment.created_utc,
-                                "sentiment": sentiment_analyzer.polarity_scores(comment.body)
-                            })
-                        else:
-                            status_callback(
-                                f"⚫ Filtered comment: {comment.body[:30]}... "
-                                f"Reasons: {', '.join(comment_reasons)}"
-                            )
-
-                    # Comment quantity check
-                    if len(filtered_comments) < 2:
-                        status_callback(
-                            f"🟤 Skipped post due to low comments ({len(filtered_comments)})"
-                        )
-                        filtered_out += 1
-                        continue
-
-                    # --- Store Valid Post ---
-                    status_callback(f"🟢 Keeping post '{submission.title[:30]}...'")
-                    
-                    # Write to CSV
-                    post_writer.writerow([
-                        submission.id,
-                        submission.title,
-                        submission.selftext,
-                        submission.score,
-                        submission.url,
-                        datetime.fromtimestamp(submission.created_utc, tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                        submission.num_comments,
-                        sentiment_analyzer.polarity_scores(submission.selftext)["compound"],
-                        submission.link_flair_text
-                    ])
-
-                    # Build JSON structure
-                    post_data = {
-                        "post_id": submission.id,
-                        "title": submission.title,
-                        "body": submission.selftext,
-                        "upvotes": submission.score,
-                        "url": submission.url,
-                        "created_utc": submission.created_utc,
-                        "sentiment": sentiment_analyzer.polarity_scores(submission.selftext),
-                        "flair": submission.link_flair_text,
-                        "comments": filtered_comments
-                    }
-                    filtered_posts.append(post_data)
-
-                    # Save individual post JSON
-                    post_dir = os.path.join(output_dir, submission.id)
-                    os.makedirs(post_dir, exist_ok=True)
-                    with open(f"{post_dir}/post.json", "w") as f:
-                        json.dump(post_data, f, indent=4)
-                        status_callback(f"🔵 Saved JSON for post {submission.id}")
-
-                    # Save comments as CSV
-                    with open(f"{post_dir}/comments.csv", "w", encoding="utf-8") as comment_file:
-                        comment_writer = csv.writer(comment_file)
-                        comment_writer.writerow([
-                            "Post  Id","Comment ID", "Body", "Upvotes", "Created UTC", "Sentiment"
-                        ])
-                        for comment in filtered_comments:
-                            comment_writer.writerow([
-                                submission.id,
-                                comment["comment_id"],
-                                comment["body"],
-                                comment["upvotes"],
-                                datetime.fromtimestamp(comment["created_utc"], tz=timezone.utc).strftime('%Y-%m-%d %H:%M:%S'),
-                                comment["sentiment"]["compound"]
-                            ])
-
-                    # For accepted posts, add this before storing:
-                    status_callback(
-                        f"Processing post {total_processed}/{post_limit}",
-                        current_progress,
-                        (
-                            submission.title[:100],
-                            "accepted",
-                            f"Score: {submission.score}, Comments: {submission.num_comments}, "
-                            f"Sentiment: {sentiment_analyzer.polarity_scores(submission.selftext)['compound']:.2f}"
-                        )
-                    )
-
-                except Exception as post_error:
-                    status_callback(f"⚠️ Error processing post {submission.id}: {str(post_error)}")
+        filtered_posts = sink.filtered_posts
 
         # Final summary
         status_callback(
             f"Completed r/{subreddit_name}\n"
-            f"- Total processed: {total_processed}\n"
+            f"- Total processed: {stats['listed']}\n"
             f"- Posts kept: {len(filtered_posts)}\n"
-            f"- Posts filtered: {filtered_out}\n"
+            f"- Posts filtered: {stats['rejected']}\n"
             f"- Comments collected: {sum(len(p['comments']) for p in filtered_posts)}",
             100
         )
@@ -0,0 +1,485 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import resource
+import platform
+import argparse
+import subprocess
+import contextlib
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+# Default location of the generated corpora, stand-in models and results (relative to the working directory)
+DEFAULT_BENCH_DIR = os.path.join(".cache", "benchmark")
+
+# Corpus sizes (number of rows in the combined dataset)
+SIZES = {"10k": 10_000, "100k": 100_000, "1m": 1_000_000}
+
+# Pinned seed of the synthetic corpora and stand-in models
+DEFAULT_SEED = 1234
+
+# Latency of the mock Reddit API in the fetch benchmark
+FETCH_LATENCY_MS = 20
+
+# Concurrent clients of the scoring service benchmark
+SERVE_CLIENTS = 64
+
+# Words of the synthetic comments; the first ones are the topics the selection queries look for
+VOCABULARY = (
+    "openai chatgpt gpt dalle api model sora whisper altman subscription price plus pro "
+    "great love amazing helpful useful fast smart impressive better best awesome "
+    "terrible hate awful slow broken worse worst useless expensive censorship bug error "
+    "the a is it to and of i you this that for in on with was but not have just like "
+    "code python image write answer question prompt token context memory search voice "
+    "google gemini claude anthropic meta llama microsoft copilot apple"
+).split()
+SUBREDDITS = ["OpenAI", "ChatGPT", "artificial", "singularity", "technology"]
+QUERIES = ["OpenAI", "ChatGPT", "GPT-4", "DALL-E", "Sora"]
+SELECTION_QUERIES = ["what do users think about openai chatgpt", "criticism and complaints about openai products"]
+
+# Rows labelled by the (slow) labelling benchmark, whatever the corpus size
+MAX_LABEL_ROWS = 2000
+
+
+# ---- Synthetic Reddit-shaped corpora
+
+def _texts(rng, n, mean_words):
+    """n random texts with geometric word counts."""
+    lengths = np.minimum(rng.geometric(1 / mean_words, n), 200)
+    words = np.asarray(VOCABULARY, dtype=object)[rng.integers(0, len(VOCABULARY), lengths.sum())]
+    ends = np.cumsum(lengths)
+    return [" ".join(words[end - length:end]) for end, length in zip(ends, lengths)]
+
+
+def make_corpus(n_rows, seed=DEFAULT_SEED):
+    """
+    Reddit-shaped combined dataset (one row per comment with its post's fields, as read by filtering.ipynb),
+    including the noise the filters remove: deleted/bot comments, repeated comments, old records and short ids.
+    """
+    rng = np.random.default_rng(seed)
+    n_posts = max(n_rows // 10, 1)
+    post_ids = np.array([f"{i:07x}"[-7:] for i in range(n_posts)], dtype=object)
+    post_of_row = np.sort(rng.integers(0, n_posts, n_rows))
+
+    post_titles = np.asarray(_texts(rng, n_posts, 8), dtype=object)
+    post_bodies = np.asarray(_texts(rng, n_posts, 40), dtype=object)
+    comments = np.asarray(_texts(rng, n_rows, 25), dtype=object)
+
+    # Noise removed by the filtering stage
+    noise = rng.random(n_rows)
+    comments[noise < 0.02] = "[deleted]"
+    comments[(noise >= 0.02) & (noise < 0.03)] = "Hey /u/someone, if you have any questions or concerns contact the mods"
+    comments[(noise >= 0.03) & (noise < 0.04)] = "This is a repeated template comment"
+    post_ids_of_rows = post_ids[post_of_row]
+    post_ids_of_rows[(noise >= 0.04) & (noise < 0.045)] = "short"
+
+    start = pd.Timestamp("2019-01-01").value // 10 ** 9
+    end = pd.Timestamp("2025-02-28").value // 10 ** 9
+    timestamps = pd.to_datetime(rng.integers(start, end, n_rows), unit="s")
+
+    return pd.DataFrame({
+        "post_id": post_ids_of_rows,
+        "comment_id": [f"c{i:08x}" for i in range(n_rows)],
+        "post_title": post_titles[post_of_row],
+        "post_body": post_bodies[post_of_row],
+        "comment_body": comments,
+        "post_author": rng.choice(["alice", "bob", "carol", "dave"], n_rows),
+        "comment_author": rng.choice(["erin", "frank", "grace", "heidi"], n_rows),
+        "subreddit": rng.choice(SUBREDDITS, n_rows),
+        "query": rng.choice(QUERIES, n_rows),
+        "number_of_comments": rng.integers(0, 500, n_rows),
+        "number_of_upvotes": rng.integers(-10, 5000, n_rows),
+        "readable_datetime": timestamps.strftime("%Y-%m-%d %H:%M:%S"),
+        "text": comments,
+        "label_1": rng.choice(["positive", "neutral", "negative"], n_rows),
+        "label_2": rng.choice(["positive", "neutral", "negative"], n_rows),
+        "m_label_1": np.nan,
+    })
+
+
+def corpus_file(size, seed=DEFAULT_SEED, bench_dir=DEFAULT_BENCH_DIR):
+    """Path of the corpus CSV for a size, generated once per (size, seed)."""
+    path = os.path.join(bench_dir, "corpora", f"corpus_{size}_{seed}.csv")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        make_corpus(SIZES[size], seed).to_csv(f"{path}.tmp", index=False)
+        os.replace(f"{path}.tmp", path)
+    return path
+
+
+def scrape_folders(size, seed=DEFAULT_SEED, bench_dir=DEFAULT_BENCH_DIR):
+    """Scrape folders (data_<x>.csv + query.txt per query) in the format read by dataJoiner.py."""
+    folder = os.path.join(bench_dir, "scrapes", f"scrapes_{size}_{seed}")
+    if os.path.exists(folder):
+        return folder
+    corpus = pd.read_csv(corpus_file(size, seed, bench_dir))
+    tmp_folder = f"{folder}.tmp"
+    for query, rows in corpus.groupby("query"):
+        # Scrape files hold the posts (without comment_id) followed by their comments
+        posts = rows.drop_duplicates("post_id")
+        scraped = pd.concat([
+            pd.DataFrame({"post_id": posts["post_id"], "comment_id": None, "title": posts["post_title"],
+                          "body": posts["post_body"], "subreddit": posts["subreddit"],
+                          "upvotes": posts["number_of_upvotes"], "comments": posts["number_of_comments"],
+                          "date_time": posts["readable_datetime"], "author": posts["post_author"]}),
+            pd.DataFrame({"post_id": rows["post_id"], "comment_id": rows["comment_id"], "title": rows["post_title"],
+                          "body": rows["comment_body"], "subreddit": rows["subreddit"], "upvotes": rows["number_of_upvotes"],
+                          "comments": 0, "date_time": rows["readable_datetime"], "author": rows["comment_author"]}),
+        ])
+        query_folder = os.path.join(tmp_folder, f"data_{query.replace(' ', '_')}")
+        os.makedirs(query_folder, exist_ok=True)
+        scraped.to_csv(os.path.join(query_folder, f"data_{query}.csv"), index=False)
+        with open(os.path.join(query_folder, "query.txt"), "w", encoding="utf-8") as f:
+            f.write(query)
+    os.replace(tmp_folder, folder)
+    return folder
+
+
+def tiny_sentiment_model(seed=DEFAULT_SEED, bench_dir=DEFAULT_BENCH_DIR):
+    """
+    Small randomly initialised RoBERTa classifier (with a word-level tokenizer over VOCABULARY)
+    saved locally, standing in for cardiffnlp/twitter-roberta-base-sentiment-latest offline.
+    """
+    folder = os.path.join(bench_dir, "models", f"tiny-roberta-sentiment-{seed}")
+    if os.path.exists(folder):
+        return folder
+
+    import torch
+    from tokenizers import Tokenizer, models, pre_tokenizers
+    from transformers import PreTrainedTokenizerFast, RobertaConfig, RobertaForSequenceClassification
+
+    special_tokens = ["<s>", "<pad>", "</s>", "<unk>", "<mask>"]
+    vocab = {token: i for i, token in enumerate(special_tokens + sorted(set(VOCABULARY)))}
+    tokenizer = Tokenizer(models.WordLevel(vocab=vocab, unk_token="<unk>"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<s>", eos_token="</s>",
+                                        unk_token="<unk>", pad_token="<pad>", cls_token="<s>",
+                                        sep_token="</s>", mask_token="<mask>", model_max_length=512)
+
+    torch.manual_seed(seed)
+    config = RobertaConfig(vocab_size=len(vocab), hidden_size=32, num_hidden_layers=2, num_attention_heads=2,
+                           intermediate_size=64, max_position_embeddings=514, pad_token_id=vocab["<pad>"],
+                           bos_token_id=vocab["<s>"], eos_token_id=vocab["</s>"], num_labels=3,
+                           id2label={0: "negative", 1: "neutral", 2: "positive"},
+                           label2id={"negative": 0, "neutral": 1, "positive": 2})
+    model = RobertaForSequenceClassification(config)
+    model.save_pretrained(f"{folder}.tmp")
+    tokenizer.save_pretrained(f"{folder}.tmp")
+    os.replace(f"{folder}.tmp", folder)
+    return folder
+
+
+# ---- Benchmarks: setup(corpus, workdir) returns a state, run(state) returns the number of rows processed
+
+def setup_join(size, seed, workdir):
+    return scrape_folders(size, seed)
+
+
+def run_join(folder):
+    from dataJoiner import find_scrape_folders, read_scrape_folder, combine_frames
+    combined = combine_frames([read_scrape_folder(csv_path, txt_path)
+                               for _, csv_path, txt_path in find_scrape_folders(folder)])
+    return len(combined)
+
+
+def setup_corpus(size, seed, workdir):
+    return corpus_file(size, seed)
+
+
+def run_profiler(path):
+    from dataProfiler import count_unique_items
+    # count_unique_items prints its results; keep the benchmark output readable
+    with contextlib.redirect_stdout(io.StringIO()):
+        count_unique_items(path)
+    return _corpus_rows(path)
+
+
+def setup_filter(size, seed, workdir):
+    return corpus_file(size, seed), os.path.join(workdir, "filtered_data.parquet")
+
+
+def run_filter(state):
+    from dataFilter import filter_data
+    path, output_file = state
+    with contextlib.redirect_stdout(io.StringIO()):
+        filter_data(path, output_file)
+    return _corpus_rows(path)
+
+
+def setup_texts(size, seed, workdir):
+    return pd.read_csv(corpus_file(size, seed), usecols=["text"])["text"].fillna("")
+
+
+def run_clean(texts):
+    from textCleaner import clean_series
+    # The chunk cache is disabled so that every repeat measures the cleaning itself
+    clean_series(texts, cache_dir=None)
+    return len(texts)
+
+
+def run_tfidf_select(texts):
+    from tfidfRetrieval import StreamingTfidf, top_k_per_query
+    model = StreamingTfidf(min_df=5)
+    blocks = [texts.iloc[start:start + 50000] for start in range(0, len(texts), 50000)]
+    for block in blocks:
+        model.partial_fit(block)
+    query_vectors = model.transform(SELECTION_QUERIES, use_idf=True)
+    top_k_per_query(query_vectors, (model.transform(block) for block in blocks), k=3000)
+    return len(texts)
+
+
+def setup_embeddings(size, seed, workdir):
+    # Random unit vectors stand in for the msmarco-distilbert-cos-v5 embeddings (768 dimensions)
+    rng = np.random.default_rng(seed)
+    embeddings = rng.standard_normal((SIZES[size], 768), dtype=np.float32)
+    embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+    queries = embeddings[:len(SELECTION_QUERIES)] + 0.1
+    return queries, embeddings
+
+
+def run_semantic_search(state):
+    import torch
+    from sentence_transformers import util
+    queries, embeddings = state
+    util.semantic_search(torch.from_numpy(queries), torch.from_numpy(embeddings), top_k=3000)
+    return len(embeddings)
+
+
+def setup_labelling(size, seed, workdir):
+    model_folder = tiny_sentiment_model(seed)
+    texts = pd.read_csv(corpus_file(size, seed), usecols=["text"], nrows=MAX_LABEL_ROWS)["text"].fillna("")
+    return model_folder, texts.tolist()
+
+
+def run_labelling(state):
+    from transformers import pipeline
+    model_folder, reviews = state
+    # Same call as label_data() in labelling_active_learning.ipynb, on CPU
+    sentiment_pipeline = pipeline("text-classification", model=model_folder, tokenizer=model_folder, device=-1)
+    results = sentiment_pipeline(reviews, padding=True, truncation=True, max_length=512)
+    return len(results)
+
+
+def setup_update_label(size, seed, workdir):
+    import streamlit as st
+    import labeler
+    # update_label rewrites the whole labelling file, so work on a copy of the corpus
+    path = os.path.join(workdir, "labelling_file.csv")
+    pd.read_csv(corpus_file(size, seed)).to_csv(path, index=False)
+    labeler.FILE = path
+    st.session_state.df = pd.read_csv(path)
+    st.session_state.current_mode = "Full manually labelling"
+    st.session_state.index = 0
+    return labeler
+
+
+def run_update_label(labeler, n_labels=5):
+    for label in ["Positive", "Negative", "Neutral", "Irrelevant", "Positive"][:n_labels]:
+        labeler.update_label(label)
+    return n_labels
+
+
+def setup_fetch(size, seed, workdir):
+    from redditMock import serve_in_thread, SyntheticReddit
+    # About 100 comments per post, so the number of comments fetched is close to the corpus size
+    n_posts = max(SIZES[size] // 100, 1)
+    reddit = SyntheticReddit(posts=n_posts, comments=100, subreddits=["OpenAI"], seed=seed)
+    # The context is kept in the state (the server stops when it is garbage collected) and exits with the process
+    context = serve_in_thread(reddit=reddit, latency_ms=FETCH_LATENCY_MS, seed=seed)
+    return context, context.__enter__(), n_posts
+
+
+def run_fetch(state):
+    from fetchEngine import RedditClient, FetchEngine, Listing
+    _, server, n_posts = state
+
+    async def fetch():
+        async with RedditClient("mock", "mock", "mock", "mock", api_url=server.url) as client:
+            return await FetchEngine(client).run(Listing("OpenAI", "new", limit=n_posts))
+
+    return asyncio.run(fetch())["comments"]
+
+
+def setup_serve(size, seed, workdir):
+    from sentimentService import SentimentModel
+    model = SentimentModel(tiny_sentiment_model(seed))
+    texts = pd.read_csv(corpus_file(size, seed), usecols=["text"], nrows=MAX_LABEL_ROWS)["text"].fillna("")
+    return model, texts.tolist()
+
+
+def run_serve(state):
+    import aiohttp
+    from sentimentService import MicroBatcher, SentimentService
+    model, texts = state
+
+    async def score_concurrently():
+        # One text per request from SERVE_CLIENTS concurrent clients, coalesced by the service
+        async with SentimentService(MicroBatcher(model), port=0) as service, aiohttp.ClientSession() as session:
+            clients = asyncio.Semaphore(SERVE_CLIENTS)
+
+            async def score(text):
+                async with clients, session.post(f"{service.url}/score", json={"text": text}) as response:
+                    response.raise_for_status()
+
+            await asyncio.gather(*(score(text) for text in texts))
+
+    asyncio.run(score_concurrently())
+    return len(texts)
+
+
+def _corpus_rows(path):
+    """Number of rows of a generated corpus, from its file name."""
+    return SIZES[os.path.basename(path).split("_")[1]]
+
+
+BENCHMARKS = {
+    "join": (setup_join, run_join),
+    "profiler": (setup_corpus, run_profiler),
+    "filter": (setup_filter, run_filter),
+    "clean": (setup_texts, run_clean),
+    "tfidf_select": (setup_texts, run_tfidf_select),
+    "semantic_search": (setup_embeddings, run_semantic_search),
+    "labelling": (setup_labelling, run_labelling),
+    "update_label": (setup_update_label, run_update_label),
+    "fetch": (setup_fetch, run_fetch),
+    "serve": (setup_serve, run_serve),
+}
+
+
+# ---- Runner
+
+def _peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run_benchmark(name, size, seed, repeat, workdir):
+    """Worker: set up and time one benchmark in a fresh process, so that peak RSS is its own."""
+    scripts = os.path.dirname(os.path.abspath(__file__))
+    if scripts not in sys.path:
+        sys.path.append(scripts)
+    setup, run = BENCHMARKS[name]
+    os.makedirs(workdir, exist_ok=True)
+    # Set up, then one warm-up call (imports, lazy loading) before the timed repeats
+    try:
+        state = setup(size, seed, workdir)
+        setup_rss = _peak_rss_mb()
+        rows = run(state)
+    except ImportError as e:
+        return {"status": "skipped", "reason": f"missing dependency: {e.name}"}
+    times, cpu_times = [], []
+    for _ in range(repeat):
+        start, cpu_start = time.perf_counter(), time.process_time()
+        rows = run(state)
+        times.append(time.perf_counter() - start)
+        cpu_times.append(time.process_time() - cpu_start)
+
+    return {
+        "status": "ok",
+        "rows": rows,
+        "repeat": repeat,
+        "min_s": min(times),
+        "median_s": float(np.median(times)),
+        "mean_s": float(np.mean(times)),
+        "cpu_median_s": float(np.median(cpu_times)),
+        "rows_per_s": rows / float(np.median(times)) if np.median(times) > 0 else None,
+        "setup_peak_rss_mb": setup_rss,
+        "peak_rss_mb": _peak_rss_mb(),
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = ""
+    return {
+        "commit": commit,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def run_benchmarks(names=None, sizes=("10k",), seed=DEFAULT_SEED, repeat=3, output_dir=None):
+    """Run the benchmarks for every size and save the results as JSON. Returns the results dict."""
+    names = names or list(BENCHMARKS)
+    output_dir = output_dir or os.path.join(DEFAULT_BENCH_DIR, "results")
+    results = {"timestamp": datetime.now().isoformat(timespec="seconds"), "seed": seed,
+               "environment": _environment(), "benchmarks": {}}
+
+    # A spawned process per benchmark keeps peak RSS and imports independent between benchmarks
+    context = multiprocessing.get_context("spawn")
+    for size in sizes:
+        for name in names:
+            workdir = os.path.abspath(os.path.join(DEFAULT_BENCH_DIR, "work", f"{name}_{size}"))
+            with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+                result = executor.submit(_run_benchmark, name, size, seed, repeat, workdir).result()
+            results["benchmarks"][f"{name}[{size}]"] = result
+            if result["status"] == "ok":
+                print(f"{name + '[' + size + ']':<24} {result['median_s']:9.3f}s  "
+                      f"{result['rows_per_s'] or 0:12,.0f} rows/s  {result['peak_rss_mb']:8.1f} MB")
+            else:
+                print(f"{name + '[' + size + ']':<24} skipped ({result['reason']})")
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_file = os.path.join(output_dir, f"{datetime.now():%Y%m%d-%H%M%S}_{results['environment']['commit'] or 'nogit'}.json")
+    with open(output_file, "w") as f:
+        json.dump(results, f, indent=4)
+    print(f"Results saved to {output_file}")
+    return results
+
+
+def compare(baseline_file, current_file, threshold=1.1):
+    """Print the median time and peak RSS ratios of two result files, flagging regressions above threshold."""
+    with open(baseline_file) as f:
+        baseline = json.load(f)["benchmarks"]
+    with open(current_file) as f:
+        current = json.load(f)["benchmarks"]
+
+    print("=" * 50)
+    for name in sorted(set(baseline) & set(current)):
+        before, after = baseline[name], current[name]
+        if before["status"] != "ok" or after["status"] != "ok":
+            continue
+        time_ratio = after["median_s"] / before["median_s"]
+        rss_ratio = after["peak_rss_mb"] / before["peak_rss_mb"]
+        flag = "  REGRESSION" if time_ratio > threshold or rss_ratio > threshold else ""
+        print(f"{name:<24} time x{time_ratio:5.2f}  rss x{rss_ratio:5.2f}{flag}")
+    print("=" * 50)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Benchmark the ingestion, selection and labelling stages on synthetic corpora')
+    parser.add_argument('-b', '--benchmark', type=str, action='append', choices=list(BENCHMARKS),
+                        help='Benchmark to run (repeatable, default: all)')
+    parser.add_argument('-s', '--size', type=str, action='append', choices=list(SIZES),
+                        help='Corpus size (repeatable, default: 10k)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='Timed repeats per benchmark')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED, help='Seed of the synthetic corpora')
+    parser.add_argument('-o', '--output-dir', type=str, default=None, help='Folder for the JSON results')
+    parser.add_argument('--compare', type=str, nargs=2, metavar=('BASELINE', 'CURRENT'),
+                        help='Compare two result files instead of running')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run_benchmarks(args.benchmark, args.size or ["10k"], seed=args.seed, repeat=args.repeat,
+                       output_dir=args.output_dir)
+
+if __name__ == "__main__":
+    main()
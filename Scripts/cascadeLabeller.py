@@ -0,0 +1,209 @@
+import os
+import json
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from sentimentService import load_model
+
+# Tier names written to the "tier" column
+CHEAP_TIER = "cheap"
+TRANSFORMER_TIER = "transformer"
+
+# Default agreement with the full transformer targeted by the calibration
+DEFAULT_TARGET_AGREEMENT = 0.95
+
+
+def score_in_batches(model, texts, batch_size=64):
+    """Labels and scores of a model (see sentimentService.load_model) over a list of texts."""
+    labels, scores = np.empty(len(texts), dtype=np.int64), np.empty(len(texts))
+    for start in range(0, len(texts), batch_size):
+        results = model(texts[start:start + batch_size])
+        labels[start:start + len(results)] = [res["roberta_label"] for res in results]
+        scores[start:start + len(results)] = [res["roberta_score"] for res in results]
+    return labels, scores
+
+
+def cascade_label(texts, cheap, transformer, threshold, batch_size=64):
+    """
+    Label texts with the cheap model and send only those scored below threshold to the transformer.
+
+    Returns the labels, scores and tiers, plus the time spent in each tier.
+    """
+    texts = [str(text) for text in texts]
+    start = time.perf_counter()
+    labels, scores = score_in_batches(cheap, texts, batch_size=10000)
+    cheap_seconds = time.perf_counter() - start
+
+    escalated = np.flatnonzero(scores < threshold)
+    start = time.perf_counter()
+    if len(escalated):
+        labels[escalated], scores[escalated] = score_in_batches(transformer, [texts[i] for i in escalated], batch_size)
+    transformer_seconds = time.perf_counter() - start
+
+    tiers = np.full(len(texts), CHEAP_TIER, dtype=object)
+    tiers[escalated] = TRANSFORMER_TIER
+    return labels, scores, tiers, {"cheap": cheap_seconds, "transformer": transformer_seconds}
+
+
+def agreement_curve(confidence, agrees):
+    """
+    Agreement with the transformer for every threshold: escalating the records below a threshold
+    makes them agree, so with the k most confident records kept by the cheap model the agreement is
+    (agreements among those k + the n - k escalated) / n.
+
+    Returns the candidate thresholds (distinct confidences, descending), the fraction of records
+    kept by the cheap model and the agreement at each of them.
+    """
+    order = np.argsort(-confidence, kind="stable")
+    confidence, agrees = confidence[order], agrees[order].astype(np.int64)
+    n = len(confidence)
+    kept = np.arange(1, n + 1)
+    agreement = (np.cumsum(agrees) + n - kept) / n
+    # A threshold keeps every record at or above it, so only the last record of each run of ties counts
+    last = np.r_[confidence[1:] != confidence[:-1], True]
+    return confidence[last], kept[last] / n, agreement[last]
+
+
+def calibrate(confidence, cheap_labels, transformer_labels, target_agreement=DEFAULT_TARGET_AGREEMENT):
+    """
+    Lowest confidence threshold (the most records kept by the cheap model) whose cascade agrees with
+    the full transformer on at least target_agreement of the records.
+    """
+    confidence = np.asarray(confidence, dtype=np.float64)
+    agrees = np.asarray(cheap_labels) == np.asarray(transformer_labels)
+    thresholds, cheap_fraction, agreement = agreement_curve(confidence, agrees)
+    reached = np.flatnonzero(agreement >= target_agreement)
+    if len(reached) == 0:
+        # Escalating everything always agrees
+        return {"threshold": float(np.inf), "cheap_fraction": 0.0, "agreement": 1.0}
+    best = reached[-1]
+    return {"threshold": float(thresholds[best]), "cheap_fraction": float(cheap_fraction[best]),
+            "agreement": float(agreement[best])}
+
+
+def calibrate_file(input_file, cheap_model, output_file, transformer=None, target_agreement=DEFAULT_TARGET_AGREEMENT,
+                   sample=None, batch_size=64, seed=42, held_out=False):
+    """
+    Choose the cascade threshold on a calibration CSV and save it as JSON.
+
+    The reference labels are the roberta_label column of a file labelled by label_data(), or the
+    transformer's labels when the file has none (transformer is then required).
+
+    The cheap model must not have been trained on the calibration records, or its agreement (and so
+    the threshold) is optimistic: the records a distilled student was trained on are left out, and
+    a cheap model that does not know its training texts needs held_out=True (the file is held out).
+    """
+    print("=" * 50)
+    data = pd.read_csv(input_file)
+    data = data[data["text"].notna()]
+    cheap = load_model(cheap_model)
+    trained_on = cheap.trained_on(data["text"]) if hasattr(cheap, "trained_on") else None
+    excluded = 0 if trained_on is None else int(trained_on.sum())
+    if trained_on is not None:
+        print(f"Left out {excluded:,} of {len(data):,} records the cheap model was trained on")
+        data = data[~trained_on]
+    elif not held_out:
+        raise ValueError(f"{cheap_model} does not record its training texts: calibrate on a held-out file "
+                         "(and pass held_out=True / --held-out)")
+    if data.empty:
+        raise ValueError(f"No record of {input_file} is held out from the cheap model's training data")
+    if sample and len(data) > sample:
+        data = data.sample(sample, random_state=seed)
+    texts = data["text"].astype(str).tolist()
+
+    start = time.perf_counter()
+    cheap_labels, confidence = score_in_batches(cheap, texts, batch_size=10000)
+    cheap_seconds = time.perf_counter() - start
+    calibration = {"cheap_model": cheap_model, "target_agreement": target_agreement, "rows": len(texts),
+                   "excluded_train_rows": excluded,
+                   "cheap_texts_per_s": len(texts) / max(cheap_seconds, 1e-9)}
+    if "roberta_label" in data and transformer is None:
+        transformer_labels = data["roberta_label"].astype(int).to_numpy()
+    else:
+        if transformer is None:
+            raise ValueError(f"{input_file} has no roberta_label column: a transformer model is required")
+        start = time.perf_counter()
+        transformer_labels, _ = score_in_batches(load_model(transformer), texts, batch_size)
+        calibration["transformer_texts_per_s"] = len(texts) / (time.perf_counter() - start)
+    calibration["cheap_agreement"] = float(np.mean(cheap_labels == transformer_labels))
+    calibration.update(calibrate(confidence, cheap_labels, transformer_labels, target_agreement))
+    if "transformer_texts_per_s" in calibration:
+        # Inference time of the cascade relative to the transformer alone
+        calibration["relative_cost"] = (calibration["transformer_texts_per_s"] / calibration["cheap_texts_per_s"]
+                                        + 1 - calibration["cheap_fraction"])
+
+    with open(output_file, "w") as f:
+        json.dump(calibration, f, indent=4)
+    print(f"Cheap model alone agrees with the transformer on {calibration['cheap_agreement']:.2%} of {len(texts):,} records")
+    print(f"Threshold {calibration['threshold']:.4f}: the cheap model keeps {calibration['cheap_fraction']:.2%} "
+          f"of the records at {calibration['agreement']:.2%} agreement (target {target_agreement:.2%})")
+    if "relative_cost" in calibration:
+        print(f"Estimated inference time: {calibration['relative_cost']:.2%} of the transformer alone")
+    print(f"Calibration saved to {output_file}")
+    print("=" * 50)
+    return calibration
+
+
+def label_file(input_file, cheap_model, transformer, threshold, output_file=None, batch_size=64):
+    """
+    Label a CSV with the cascade, writing the roberta_label/roberta_score columns and the tier of each record to a new
+    CSV (<input>_cascade_labelled.csv by default). The input file is never overwritten.
+    """
+    output_file = output_file or f"{os.path.splitext(input_file)[0]}_cascade_labelled.csv"
+    if os.path.abspath(output_file) == os.path.abspath(input_file):
+        raise ValueError(f"The labelled output would overwrite the input file {input_file}")
+    print("=" * 50)
+    data = pd.read_csv(input_file)
+    labels, scores, tiers, seconds = cascade_label(data["text"].fillna("").tolist(), load_model(cheap_model),
+                                                   load_model(transformer), threshold, batch_size)
+    data["roberta_label"], data["roberta_score"], data["tier"] = labels, scores, tiers
+    data.to_csv(output_file, index=False)
+
+    escalated = int((tiers == TRANSFORMER_TIER).sum())
+    print(f"Labelled {len(data):,} records: {len(data) - escalated:,} by the cheap model "
+          f"({seconds['cheap']:.1f}s), {escalated:,} escalated to the transformer ({seconds['transformer']:.1f}s)")
+    print(f"Saved to {output_file}")
+    print("=" * 50)
+    return data
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Label with a cheap model first and the transformer only for uncertain records')
+    parser.add_argument('-f', '--file', type=str, required=True, help='CSV to label (or to calibrate on)')
+    parser.add_argument('-c', '--cheap', type=str, default='Models/student.joblib', help='Cheap model (distilled student)')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Transformer model folder')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Labelled CSV (defaults to <file>_cascade_labelled.csv)')
+    parser.add_argument('-t', '--threshold', type=float, default=None, help='Escalate records scored below this')
+    parser.add_argument('--calibration', type=str, default='Models/cascade_calibration.json',
+                        help='Calibration file, written by --calibrate and read when -t is not given')
+    parser.add_argument('--calibrate', action='store_true', help='Choose the threshold on --file instead of labelling')
+    parser.add_argument('-a', '--target-agreement', type=float, default=DEFAULT_TARGET_AGREEMENT,
+                        help='Agreement with the full transformer targeted by --calibrate')
+    parser.add_argument('--sample', type=int, default=None, help='Calibrate on at most this many records')
+    parser.add_argument('--held-out', action='store_true',
+                        help='--file was not used to train the cheap model '
+                             '(required for cheap models that do not record their training texts)')
+    parser.add_argument('-b', '--batch-size', type=int, default=64, help='Transformer batch size')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.calibrate:
+        calibrate_file(args.file, args.cheap, args.calibration, transformer=args.model,
+                       target_agreement=args.target_agreement, sample=args.sample, batch_size=args.batch_size,
+                       held_out=args.held_out)
+        return
+    if args.model is None:
+        parser.error("-m/--model is required for labelling")
+    threshold = args.threshold
+    if threshold is None:
+        with open(args.calibration) as f:
+            threshold = json.load(f)["threshold"]
+    label_file(args.file, args.cheap, args.model, threshold, args.output, args.batch_size)
+
+if __name__ == "__main__":
+    main()
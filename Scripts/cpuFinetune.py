@@ -0,0 +1,335 @@
+import os
+import json
+import math
+import time
+import glob
+import shutil
+import argparse
+import threading
+
+import numpy as np
+import psutil
+from sklearn.metrics import accuracy_score, f1_score
+
+from trainingStore import DEFAULT_STORE_DIR, TrainingStore
+
+# Pretrained model of round 1, as in the labelling notebook
+PRETRAINED_MODEL = "cardiffnlp/twitter-roberta-base-sentiment-latest"
+
+# Timed forward/backward passes per candidate thread count
+TUNE_STEPS = 2
+
+# Seconds between two memory samples
+RSS_INTERVAL = 0.5
+
+
+def compute_metrics(eval_preds):
+    """Accuracy and weighted F1, as compute_metrics() in the labelling notebook."""
+    logits, true_labels = eval_preds
+    pred_labels = np.argmax(logits, axis=-1)
+    return {"accuracy": accuracy_score(true_labels, pred_labels),
+            "f1": f1_score(true_labels, pred_labels, average="weighted")}
+
+
+class PeakRss:
+    """
+    Peak resident memory of this process and its children (the dataloader workers), sampled in a
+    background thread while the block runs. Pages shared with forked workers are counted once per
+    process, so this is an upper bound.
+
+    Parameters:
+    - interval: Seconds between two samples
+    """
+
+    def __init__(self, interval=RSS_INTERVAL):
+        self.interval = interval
+        self.peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _sample(self):
+        process = psutil.Process()
+        rss = process.memory_info().rss
+        for child in process.children(recursive=True):
+            try:
+                rss += child.memory_info().rss
+            except psutil.NoSuchProcess:
+                pass
+        self.peak = max(self.peak, rss)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        self._sample()
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+        self._sample()
+
+    @property
+    def peak_mb(self):
+        return self.peak / (1 << 20)
+
+
+def physical_cores():
+    return psutil.cpu_count(logical=False) or os.cpu_count() or 1
+
+
+def tune_workers(cores, workers=None):
+    """
+    Dataloader workers: rows come pre-tokenised from the training store, so collating a batch is
+    cheap and a worker only pays off when there are cores to spare from the torch threads.
+    """
+    if workers is not None:
+        return workers
+    return 0 if cores < 8 else min(2, cores // 8)
+
+
+def tune_threads(model, batch, cores, threads=None):
+    """
+    Torch intra-op threads: the fastest of a few candidate counts on forward and backward passes
+    of a real batch (hyper-threads and threads competing with the workers usually slow training down).
+    Returns the chosen count and the seconds per step of every candidate.
+    """
+    import torch
+
+    candidates = [threads] if threads else sorted({cores, max(1, cores - 1), max(1, cores // 2)}, reverse=True)
+    timings = {}
+    if len(candidates) > 1:
+        model.train()
+        for count in candidates:
+            torch.set_num_threads(count)
+            # The first pass of a thread count is not timed
+            model(**batch).loss.backward()
+            start = time.perf_counter()
+            for _ in range(TUNE_STEPS):
+                model(**batch).loss.backward()
+            timings[count] = (time.perf_counter() - start) / TUNE_STEPS
+        model.zero_grad(set_to_none=True)
+    best = min(timings, key=timings.get) if timings else candidates[0]
+    torch.set_num_threads(best)
+    return best, timings
+
+
+def freeze_layers(model, num_layers):
+    """
+    Freeze the embeddings and the lowest num_layers encoder layers, so that only the upper layers and
+    the classification head are trained. Returns the number of trainable parameters.
+    """
+    if num_layers:
+        base = getattr(model, model.base_model_prefix)
+        for module in [base.embeddings] + list(base.encoder.layer[:num_layers]):
+            for parameter in module.parameters():
+                parameter.requires_grad = False
+    return sum(parameter.numel() for parameter in model.parameters() if parameter.requires_grad)
+
+
+def add_lengths(dataset):
+    """Add the token count of every row as the "length" column, read from the Arrow list offsets."""
+    import pyarrow.compute as pc
+
+    lengths = pc.list_value_length(dataset.with_format("arrow")[:]["input_ids"]).to_numpy()
+    return dataset.add_column("length", lengths.tolist())
+
+
+def sample_batch(dataset, data_collator, batch_size, seed=42):
+    """A random training batch, used to time the thread counts."""
+    rows = np.random.default_rng(seed).choice(len(dataset), size=min(batch_size, len(dataset)), replace=False)
+    return data_collator([{key: row[key] for key in ("input_ids", "attention_mask", "labels")}
+                          for row in dataset.select(rows)])
+
+
+def find_warm_start(models_dir, round):
+    """
+    Model an incremental round starts from: the best checkpoint of the previous round (as recorded by
+    the Trainer in round<N-1>_finetuned_model_checkpoints), else the previous round's model, else None.
+    """
+    checkpoints_dir = os.path.join(models_dir, f"round{round - 1}_finetuned_model_checkpoints")
+    states = glob.glob(os.path.join(checkpoints_dir, "checkpoint-*", "trainer_state.json"))
+    if states:
+        latest = max(states, key=lambda path: int(os.path.basename(os.path.dirname(path)).split("-")[1]))
+        with open(latest) as f:
+            best = json.load(f).get("best_model_checkpoint")
+        # The recorded path is relative to where that round was trained
+        if best and os.path.isdir(os.path.join(checkpoints_dir, os.path.basename(best))):
+            return os.path.join(checkpoints_dir, os.path.basename(best))
+    model_dir = os.path.join(models_dir, f"round{round - 1}_finetuned_model")
+    return model_dir if os.path.isdir(model_dir) else None
+
+
+def finetune_cpu(model, dataset, tokenizer, round, models_dir="Models", batch_size=16, effective_batch_size=32,
+                 epochs=3, learning_rate=5e-5, freeze=0, threads=None, workers=None, bf16=False, seed=42,
+                 keep_best=False, check_regression=False, tolerance=0.0, report_extra=None):
+    """
+    Fine-tune on CPU, as finetune() in the labelling notebook with the same outputs (the evaluation
+    results in <models_dir>/Evaluation and the model in <models_dir>/round<N>_finetuned_model), using:
+    - length-grouped batches, so that dynamic padding adds as few pad tokens as possible
+    - gradient accumulation up to effective_batch_size
+    - torch threads timed on a real batch and dataloader workers sized to the cores
+    - optionally, the embeddings and the lowest encoder layers frozen
+
+    Returns the fine-tuned model and the report (evaluation results, samples/s and peak RSS).
+
+    Parameters:
+    - model: Model to fine-tune
+    - dataset: DatasetDict with tokenised "train" and "val" sets (see TrainingStore.dataset)
+    - tokenizer: Tokenizer of the model
+    - round: Active learning round
+    - batch_size: Rows per forward pass
+    - effective_batch_size: Rows per optimiser step
+    - freeze: Number of lower encoder layers to freeze
+    - threads: Torch threads (None times a few candidates)
+    - workers: Dataloader workers (None sizes them to the cores)
+    - bf16: Train in bfloat16 autocast (faster on CPUs with AVX-512 BF16/AMX)
+    - keep_best: Evaluate every epoch, keep the best epoch (by F1) and its checkpoint for the next round
+    - check_regression: Evaluate the model before training too; if the validation F1 drops by more than
+      tolerance, the round keeps the weights it started from
+    - report_extra: Entries added to the report
+    """
+    # transformers is only needed for fine-tuning
+    from transformers import DataCollatorWithPadding, TrainingArguments, Trainer
+
+    data_collator = DataCollatorWithPadding(tokenizer=tokenizer)
+    trainable = freeze_layers(model, freeze)
+    cores = physical_cores()
+    workers = tune_workers(cores, workers)
+    threads, timings = tune_threads(model, sample_batch(dataset["train"], data_collator, batch_size, seed),
+                                    max(1, cores - workers), threads)
+    accumulation = max(1, math.ceil(effective_batch_size / batch_size))
+
+    train = add_lengths(dataset["train"])
+    # The evaluation order does not matter, so the validation set is sorted by length to pad as little as possible
+    val = add_lengths(dataset["val"]).sort("length")
+
+    training_arguments = TrainingArguments(
+        output_dir=os.path.join(models_dir, f"round{round}_finetuned_model_checkpoints"),
+        num_train_epochs=epochs,
+        learning_rate=learning_rate,
+        per_device_train_batch_size=batch_size,
+        per_device_eval_batch_size=batch_size * 2,
+        gradient_accumulation_steps=accumulation,
+        group_by_length=True,
+        length_column_name="length",
+        dataloader_num_workers=workers,
+        dataloader_pin_memory=False,
+        use_cpu=True,
+        bf16=bf16,
+        eval_strategy="epoch",
+        logging_strategy="epoch",
+        save_strategy="epoch" if keep_best else "no",
+        save_only_model=keep_best,
+        save_total_limit=1 if keep_best else None,
+        load_best_model_at_end=keep_best,
+        metric_for_best_model="f1" if keep_best else None,
+        report_to="none",
+        seed=seed,
+    )
+
+    trainer = Trainer(
+        model,
+        training_arguments,
+        train_dataset=train,
+        eval_dataset=val,
+        data_collator=data_collator,
+        tokenizer=tokenizer,
+        compute_metrics=compute_metrics,
+    )
+
+    print(f"\nRound {round} - Fine-tuning the model on CPU ({threads} threads, {workers} workers, "
+          f"{batch_size} x {accumulation} rows per step, {trainable:,} trainable parameters)...")
+    baseline = None
+    if check_regression:
+        baseline = trainer.evaluate()
+        initial_state = {name: tensor.detach().clone() for name, tensor in model.state_dict().items()}
+        print(f"Round {round} - F1 before training: {baseline['eval_f1']:.4f}")
+    with PeakRss() as rss:
+        train_output = trainer.train()
+        eval_results = trainer.evaluate()
+    print(f"Round {round} - Evaluation results: {eval_results}")
+
+    report = dict(eval_results)
+    if baseline is not None:
+        report.update(baseline_f1=baseline["eval_f1"], regressed=eval_results["eval_f1"] < baseline["eval_f1"] - tolerance)
+        if report["regressed"]:
+            print(f"Round {round} - F1 regressed from {baseline['eval_f1']:.4f} to {eval_results['eval_f1']:.4f}: "
+                  f"keeping the weights the round started from")
+            trainer.model.load_state_dict(initial_state)
+            # The next round then starts from the saved round model rather than the regressed checkpoint
+            shutil.rmtree(training_arguments.output_dir, ignore_errors=True)
+    report.update(report_extra or {})
+    report.update(train_samples_per_second=train_output.metrics["train_samples_per_second"],
+                  train_runtime=train_output.metrics["train_runtime"],
+                  peak_rss_mb=rss.peak_mb,
+                  cpu={"physical_cores": cores, "threads": threads, "thread_timings": timings,
+                       "dataloader_workers": workers, "batch_size": batch_size,
+                       "gradient_accumulation_steps": accumulation, "frozen_layers": freeze,
+                       "trainable_parameters": trainable, "bf16": bf16})
+    print(f"Round {round} - {report['train_samples_per_second']:.1f} samples/s, "
+          f"{report['train_runtime'] / 60:.1f} minutes, peak RSS {report['peak_rss_mb']:,.0f} MB")
+
+    # Save evaluation results to a json file
+    os.makedirs(os.path.join(models_dir, "Evaluation"), exist_ok=True)
+    with open(os.path.join(models_dir, "Evaluation", f"round{round}_finetuned_model_eval_results.json"), "w") as f:
+        json.dump(report, f, indent=4)
+
+    trainer.save_model(os.path.join(models_dir, f"round{round}_finetuned_model"))
+    print(f"Round {round} - Model fine-tuned.")
+    return trainer.model, report
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Fine-tune the model of an active learning round on CPU')
+    parser.add_argument('-r', '--round', type=int, required=True, help='Active learning round')
+    parser.add_argument('--pretrained', type=str, default=PRETRAINED_MODEL, help='Model of round 1 (and tokenizer)')
+    parser.add_argument('--models-dir', type=str, default='Models', help='Folder of the round models')
+    parser.add_argument('--manual-dir', type=str, default='Data/Labelling/Manual',
+                        help='Folder of the round<N>_manual_low_confidence.csv files')
+    parser.add_argument('-v', '--val', type=str, default='Data/Labelling/Manual/manual_val_set.csv', help='Validation set')
+    parser.add_argument('-s', '--store', type=str, default=DEFAULT_STORE_DIR, help='Training store folder')
+    parser.add_argument('-b', '--batch-size', type=int, default=16, help='Rows per forward pass')
+    parser.add_argument('-e', '--effective-batch-size', type=int, default=32, help='Rows per optimiser step')
+    parser.add_argument('--epochs', type=float, default=3, help='Training epochs')
+    parser.add_argument('--lr', type=float, default=5e-5, help='Learning rate')
+    parser.add_argument('--freeze', type=int, default=0, help='Number of lower encoder layers to freeze')
+    parser.add_argument('--threads', type=int, default=None, help='Torch threads (default: timed)')
+    parser.add_argument('--workers', type=int, default=None, help='Dataloader workers (default: sized to the cores)')
+    parser.add_argument('--bf16', action='store_true', help='Train in bfloat16 autocast')
+    parser.add_argument('--incremental', action='store_true',
+                        help="Start from the previous round's best checkpoint and train on the new rows plus a replay sample")
+    parser.add_argument('--replay', type=int, default=500, help='Rows of earlier rounds replayed by --incremental')
+    parser.add_argument('--tolerance', type=float, default=0.0,
+                        help='Validation F1 drop tolerated by --incremental before the round keeps its starting weights')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+    # Round 1 starts from the pretrained model, later rounds from the previous round's model
+    # (its best checkpoint with --incremental)
+    if args.incremental:
+        model_name = find_warm_start(args.models_dir, args.round) or args.pretrained
+    else:
+        model_name = args.pretrained if args.round == 1 else os.path.join(args.models_dir, f"round{args.round - 1}_finetuned_model")
+    print(f"Round {args.round} - Starting from {model_name}")
+    model = AutoModelForSequenceClassification.from_pretrained(model_name)
+    tokenizer = AutoTokenizer.from_pretrained(args.pretrained)
+
+    store = TrainingStore(args.store)
+    store.ingest(args.manual_dir, val_file=args.val)
+    dataset = store.dataset(tokenizer, round=args.round, replay=args.replay if args.incremental else None)
+    finetune_cpu(model, dataset, tokenizer, args.round, models_dir=args.models_dir, batch_size=args.batch_size,
+                 effective_batch_size=args.effective_batch_size, epochs=args.epochs, learning_rate=args.lr,
+                 freeze=args.freeze, threads=args.threads, workers=args.workers, bf16=args.bf16,
+                 keep_best=args.incremental, check_regression=args.incremental, tolerance=args.tolerance,
+                 report_extra={"warm_start": model_name, "train_rows": dataset["train"].num_rows,
+                               "replay": args.replay if args.incremental else None})
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,278 @@
+import os
+import argparse
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+# Comments repeated more often than this are treated as bot/template comments
+MAX_COMMENT_REPEATS = 50
+
+# Bot and moderator comments removed in filtering.ipynb, fused into one pattern
+BOT_COMMENT_PATTERN = "|".join([
+    r'^Hey\s+/u/\w+.*?$',
+    r'^.*?if you have any questions or concerns.*?$',
+    r'\[ Removed by Reddit \]',
+    r'^.*?\[.*?\].*?$',
+])
+
+# Placeholder texts left behind by str() conversions of missing values
+EMPTY_TEXTS = ["", "nan", "None"]
+
+TEXT_COLUMNS = ["post_title", "post_body", "comment_body"]
+COMMENT_COLUMNS = ["comment_id", "comment_body", "comment_author"]
+
+# Column types of the output (every other column is written as a string)
+OUTPUT_TYPES = {
+    "post_id": pa.string(),
+    "comment_id": pa.string(),
+    "post_title": pa.string(),
+    "post_body": pa.string(),
+    "post_author": pa.string(),
+    "comment_body": pa.string(),
+    "comment_author": pa.string(),
+    "subreddit": pa.dictionary(pa.int32(), pa.string()),
+    "query": pa.dictionary(pa.int32(), pa.string()),
+    "number_of_comments": pa.int64(),
+    "number_of_upvotes": pa.int64(),
+    "readable_datetime": pa.timestamp("ns"),
+    "text": pa.string(),
+}
+
+
+def estimate_chunksize(file_path, memory_mb):
+    """Number of rows per chunk that keeps a chunk (and its working copies) within memory_mb."""
+    sample = pd.read_csv(file_path, nrows=1000, dtype=str, encoding_errors="ignore")
+    bytes_per_row = max(sample.memory_usage(deep=True).sum() / max(len(sample), 1), 1)
+    # A chunk is held about 4 times over while it is filtered (raw, text, post rows, output)
+    return max(int(memory_mb * 1024 * 1024 / (bytes_per_row * 4)), 1000)
+
+
+def read_chunks(file_path, chunksize):
+    """Stream the combined dataset in chunks, dropping invalid UTF-8 while reading."""
+    return pd.read_csv(
+        file_path,
+        chunksize=chunksize,
+        dtype={"post_id": str, "comment_id": str, "post_title": str, "post_body": str,
+               "comment_body": str, "post_author": str, "comment_author": str},
+        encoding_errors="ignore",
+    )
+
+
+def comment_hashes(comment_body):
+    """64-bit hashes of the comment bodies (missing bodies hash to the same value)."""
+    return pd.util.hash_array(comment_body.fillna("").to_numpy(dtype=object))
+
+
+class SeenKeys:
+    """Sorted 64-bit keys seen so far (8 bytes per key, instead of a Python set entry per row)."""
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+
+    def first_seen(self, keys):
+        """Mask of the keys seen for the first time (also within keys); they are added to the seen keys."""
+        keys = np.asarray(keys, dtype=np.uint64)
+        new = ~pd.Series(keys).duplicated().to_numpy()
+        if len(self.keys):
+            positions = np.searchsorted(self.keys, keys).clip(0, len(self.keys) - 1)
+            new &= self.keys[positions] != keys
+        self.keys = np.union1d(self.keys, keys[new])
+        return new
+
+
+def merge_counts(hashes, counts, new_hashes, new_counts):
+    """Add counts per hash to sorted (hashes, counts) arrays."""
+    hashes, inverse = np.unique(np.concatenate([hashes, new_hashes]), return_inverse=True)
+    counts = np.bincount(inverse, weights=np.concatenate([counts, new_counts]), minlength=len(hashes))
+    return hashes, counts.astype(np.int64)
+
+
+def structural_filter(chunk):
+    """Structural checks of filtering.ipynb: 7-character post ids, known subreddit, comment not deleted/removed."""
+    for column in TEXT_COLUMNS:
+        if column in chunk:
+            chunk[column] = chunk[column].str.replace("\n", " ", regex=False)
+    valid = (chunk["post_id"].str.len() == 7) & chunk["subreddit"].notna()
+    valid &= ~chunk["comment_body"].isin(["[deleted]", "[removed]"])
+    return chunk[valid]
+
+
+def count_repeats(input_csv, chunksize):
+    """Hashes of the comment bodies repeated more than MAX_COMMENT_REPEATS times (after the structural checks)."""
+    hashes, counts = np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64)
+    for chunk in read_chunks(input_csv, chunksize):
+        bodies = structural_filter(chunk)["comment_body"].dropna()
+        chunk_hashes, chunk_counts = np.unique(comment_hashes(bodies), return_counts=True)
+        hashes, counts = merge_counts(hashes, counts, chunk_hashes, chunk_counts)
+    return hashes[counts > MAX_COMMENT_REPEATS]
+
+
+def prepare_chunk(chunk, repeated):
+    """
+    Apply the row-level filters of filtering.ipynb in one vectorised pass, in the notebook's order:
+    structural checks, comments repeated more than MAX_COMMENT_REPEATS times, then bot/moderator comments.
+    """
+    chunk = structural_filter(chunk)
+    body = chunk["comment_body"]
+    keep = body.isna() | ~np.isin(comment_hashes(body), repeated)
+    keep &= ~body.fillna("").str.contains(BOT_COMMENT_PATTERN, regex=True)
+    chunk = chunk[keep]
+    chunk = chunk.assign(readable_datetime=pd.to_datetime(chunk["readable_datetime"], errors="coerce", format="mixed"))
+    chunk["number_of_upvotes"] = chunk["number_of_upvotes"].fillna(0)
+    return chunk
+
+
+def build_records(chunk, seen_posts, seen_comments, cutoff_date):
+    """
+    Build the comment records (text = comment body) and one post record per new post (text = title + body),
+    skipping records already emitted by earlier chunks, then drop the records older than the cutoff and
+    those without text.
+
+    A post record takes the fields (and date) of the first row of its post that passed the row filters,
+    before the date cutoff; rows whose comment is blank do not count. Unlike filtering.ipynb's
+    groupby().first(), missing fields are not filled from the post's later rows.
+    """
+    text = chunk["comment_body"].fillna("").str.strip()
+    chunk = chunk[chunk["comment_body"].isna() | (text != "")]
+    text = text[chunk.index]
+
+    comment_keys = pd.util.hash_pandas_object(chunk[["post_id", "comment_id"]], index=False).to_numpy()
+    is_new_comment = seen_comments.first_seen(comment_keys)
+    comments = chunk[is_new_comment & chunk["comment_body"].notna().to_numpy()].assign(text=text)
+
+    posts = chunk.drop_duplicates(subset="post_id")
+    posts = posts[seen_posts.first_seen(pd.util.hash_array(posts["post_id"].to_numpy(dtype=object)))]
+    posts = posts.assign(**{column: None for column in COMMENT_COLUMNS if column in posts})
+    # Missing titles and bodies are empty (the notebook's str() conversion turned them into "nan")
+    posts["text"] = (posts["post_title"].fillna("") + " " + posts["post_body"].fillna("")).str.strip()
+
+    records = pd.concat([posts, comments], ignore_index=True)
+    records = records[records["readable_datetime"] > cutoff_date]
+    return records[~records["text"].isin(EMPTY_TEXTS)]
+
+
+def word_bounds(histogram, min_words=3):
+    """Word count bounds (min_words, Q3 + 1.5 * IQR) from a histogram of word counts."""
+    cumulative = np.cumsum(histogram)
+    total = cumulative[-1]
+
+    def quantile(q):
+        # Linear interpolation between order statistics, as in pandas' Series.quantile
+        position = q * (total - 1)
+        lower, upper = int(np.floor(position)), int(np.ceil(position))
+        lower_value = np.searchsorted(cumulative, lower + 1)
+        upper_value = np.searchsorted(cumulative, upper + 1)
+        return lower_value + (upper_value - lower_value) * (position - lower)
+
+    q1, q3 = quantile(0.25), quantile(0.75)
+    return min_words, int(q3 + 1.5 * (q3 - q1))
+
+
+def to_table(records, schema):
+    """Convert a chunk of records to an Arrow table with the output types."""
+    records = records.reindex(columns=schema.names)
+    for column in ["number_of_comments", "number_of_upvotes"]:
+        if column in records:
+            records[column] = records[column].fillna(0).astype("int64")
+    return pa.Table.from_pandas(records, schema=schema, preserve_index=False)
+
+
+def filter_data(input_csv, output_file, years=5, min_words=3, chunksize=None, memory_mb=1024):
+    """
+    Filter the combined dataset as filtering.ipynb does, in streaming passes.
+
+    Pass 1 counts repeated comments; pass 2 applies the row filters, builds the post and comment
+    records, drops those older than the cutoff and writes them to a temporary Parquet file while
+    building the histogram of word counts; pass 3 applies the IQR-derived word count bounds and writes
+    typed output. Besides one chunk, memory holds 8 bytes per distinct post and comment (to skip
+    duplicates) and, while counting, 16 bytes per distinct comment body.
+    """
+    chunksize = chunksize or estimate_chunksize(input_csv, memory_mb)
+    cutoff_date = datetime.now() - timedelta(days=years * 365)
+    print("=" * 50)
+    print(f"Filtering {input_csv} in chunks of {chunksize:,} rows")
+
+    # ---- Pass 1: comments repeated too often
+    repeated = count_repeats(input_csv, chunksize)
+
+    # ---- Pass 2: row filters, post and comment records, date cutoff and word count histogram
+    records_file = f"{output_file}.records.parquet"
+    seen_posts, seen_comments = SeenKeys(), SeenKeys()
+    histogram = np.zeros(1, dtype=np.int64)
+    writer = None
+    try:
+        for chunk in read_chunks(input_csv, chunksize):
+            records = build_records(prepare_chunk(chunk, repeated), seen_posts, seen_comments, cutoff_date)
+            if records.empty:
+                continue
+            histogram = _add_histogram(histogram, records["text"].str.split().str.len().to_numpy())
+            if writer is None:
+                schema = pa.schema([(name, OUTPUT_TYPES.get(name, pa.string())) for name in records.columns])
+                writer = pq.ParquetWriter(records_file, schema)
+            writer.write_table(to_table(records, schema))
+        if writer is None:
+            print("No records left after filtering")
+            print("=" * 50)
+            return
+        writer.close()
+        min_words, max_words = word_bounds(histogram, min_words)
+        print(f"Word count bounds: {min_words} - {max_words}")
+
+        # ---- Pass 3: word count bounds, written to the output
+        if os.path.exists(output_file):
+            os.remove(output_file)
+        writer, total = None, 0
+        for batch in pq.ParquetFile(records_file).iter_batches(batch_size=chunksize):
+            words = pc.list_value_length(pc.utf8_split_whitespace(batch.column("text")))
+            batch = batch.filter(pc.and_(pc.greater_equal(words, min_words), pc.less_equal(words, max_words)))
+            total += batch.num_rows
+            if output_file.endswith(".parquet"):
+                writer = writer or pq.ParquetWriter(output_file, batch.schema)
+                writer.write_batch(batch)
+            else:
+                batch.to_pandas().to_csv(output_file, mode="a", header=not os.path.exists(output_file), index=False)
+    finally:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(records_file):
+            os.remove(records_file)
+
+    print(f"Records kept: {total:,}")
+    print(f"Filtered data saved to {output_file}")
+    print("=" * 50)
+
+
+def _add_histogram(histogram, values):
+    """Add integer values to a histogram, growing it if needed."""
+    if len(values) == 0:
+        return histogram
+    counts = np.bincount(values.astype(np.int64))
+    if len(counts) > len(histogram):
+        histogram = np.pad(histogram, (0, len(counts) - len(histogram)))
+    histogram[:len(counts)] += counts
+    return histogram
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Heuristically filter the combined Reddit dataset in streaming passes')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Path to the combined CSV file')
+    parser.add_argument('-o', '--output', type=str, default='filtered_data.parquet',
+                        help='Output file (.parquet for typed output, otherwise CSV)')
+    parser.add_argument('-y', '--years', type=int, default=5, help='Keep records from the past N years')
+    parser.add_argument('--min-words', type=int, default=3, help='Minimum number of words per record')
+    parser.add_argument('--chunksize', type=int, default=None, help='Rows per chunk (overrides --memory-mb)')
+    parser.add_argument('--memory-mb', type=int, default=1024, help='Approximate memory budget per chunk')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    filter_data(args.file, args.output, years=args.years, min_words=args.min_words,
+                chunksize=args.chunksize, memory_mb=args.memory_mb)
+
+if __name__ == "__main__":
+    main()
@@ -1,19 +1,24 @@
 import os
 import sys
 import pandas as pd
-
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python combine_csv.py <parent_folder>")
-        sys.exit(1)
-
-    parent_folder = sys.argv[1]
-
-    # List to collect all dataframes
-    all_dfs = []
-    print("="*50)
-
-    # Walk through parent_folder and find subfolders containing data_<x>.csv & query.txt
+from tracing import span, traced
+
+# Final column order of the combined data
+FINAL_COLUMNS = [
+    "post_id",
+    "comment_id",
+    "title",
+    "body",
+    "subreddit",
+    "upvotes",
+    "comments",
+    "date_time",
+    "author",
+    "query"
+]
+
+def find_scrape_folders(parent_folder):
+    """Yield (folder, csv_path, txt_path) for every subfolder containing data_<x>.csv & query.txt"""
     for root, dirs, files in os.walk(parent_folder):
         
 
@@ -22,24 +27,55 @@ def main():
 
         # We expect exactly one CSV (e.g. data_<x>.csv) and one query.txt in each subfolder
         if len(csv_files) == 1 and len(txt_files) == 1:
+            yield root, os.path.join(root, csv_files[0]), os.path.join(root, txt_files[0])
+
+def read_scrape_folder(csv_path, txt_path):
+    """Read one scrape folder's CSV with its query as a new column"""
+    # Read the query from the query.txt file
+    with open(txt_path, "r", encoding="utf-8") as txt_file:
+        query_text = txt_file.read().strip()
+
+    # Read the CSV into a DataFrame
+    with span("join.read_csv", bytes=os.path.getsize(csv_path)) as s:
+        df = pd.read_csv(csv_path, on_bad_lines='warn')
+        s.add(rows=len(df))
+
+    # Append the query text as a new column
+    df["query"] = query_text
+    return df
+
+@traced("join.combine")
+def combine_frames(all_dfs):
+    """Concatenate the scrape folders, drop duplicate records and reorder the columns"""
+    # Concatenate all dataframes
+    combined_df = pd.concat(all_dfs, ignore_index=True)
 
-            print(f"Processing folder: {root}...")
+    # Drop duplicates based on the composite key (post_id, comment_id)
+    combined_df.drop_duplicates(subset=["post_id", "comment_id"], inplace=True)
 
-            csv_path = os.path.join(root, csv_files[0])
-            txt_path = os.path.join(root, txt_files[0])
+    # Keep only the final columns (if they exist) in the correct order
+    # (In case some CSV might have extra columns, or missing columns raise error)
+    existing_columns = [col for col in FINAL_COLUMNS if col in combined_df.columns]
+    return combined_df[existing_columns]
 
-            # Read the query from the query.txt file
-            with open(txt_path, "r", encoding="utf-8") as txt_file:
-                query_text = txt_file.read().strip()
+@traced("dataJoiner.main")
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python combine_csv.py <parent_folder>")
+        sys.exit(1)
 
-            # Read the CSV into a DataFrame
-            df = pd.read_csv(csv_path, on_bad_lines='warn')
+    parent_folder = sys.argv[1]
 
-            # Append the query text as a new column
-            df["query"] = query_text
+    # List to collect all dataframes
+    all_dfs = []
+    print("="*50)
 
-            # Collect for later concatenation
-            all_dfs.append(df)
+    # Walk through parent_folder and find subfolders containing data_<x>.csv & query.txt
+    for root, csv_path, txt_path in find_scrape_folders(parent_folder):
+        print(f"Processing folder: {root}...")
+
+        # Collect for later concatenation
+        all_dfs.append(read_scrape_folder(csv_path, txt_path))
 
     if not all_dfs:
         print("No valid CSV/query pairs found. Exiting.")
@@ -47,29 +83,7 @@ def main():
 
     print("="*50)
 
-    # Concatenate all dataframes
-    combined_df = pd.concat(all_dfs, ignore_index=True)
-
-    # Drop duplicates based on the composite key (post_id, comment_id)
-    combined_df.drop_duplicates(subset=["post_id", "comment_id"], inplace=True)
-
-    # Reorder columns to match the final desired format
-    final_columns = [
-        "post_id",
-        "comment_id",
-        "title",
-        "body",
-        "subreddit",
-        "upvotes",
-        "comments",
-        "date_time",
-        "author",
-        "query"
-    ]
-    # Keep only these columns (if they exist) in the correct order
-    # (In case some CSV might have extra columns, or missing columns raise error)
-    existing_columns = [col for col in final_columns if col in combined_df.columns]
-    combined_df = combined_df[existing_columns]
+    combined_df = combine_frames(all_dfs)
 
     # Print no.of posts and comments
     num_of_posts = combined_df["post_id"].nunique()
@@ -81,7 +95,9 @@ def main():
 
     # Write combined data to CSV
     output_csv = "combined_data.csv"
-    combined_df.to_csv(output_csv, index=False)
+    with span("join.write_csv", rows=len(combined_df)) as s:
+        combined_df.to_csv(output_csv, index=False)
+        s.add(bytes=os.path.getsize(output_csv))
     print(f"Combined CSV successfully saved as {output_csv}")
     print(f"File size: {os.path.getsize(output_csv)/(1024*1024):.2f} MB")
     print("="*50)
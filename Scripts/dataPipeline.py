@@ -0,0 +1,532 @@
+import os
+import ast
+import json
+import time
+import shutil
+import inspect
+import hashlib
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+
+from dataJoiner import find_scrape_folders, read_scrape_folder, combine_frames
+from dataFilter import filter_data
+from nearDuplicates import deduplicate
+from textCleaner import clean_series
+from tfidfRetrieval import StreamingTfidf, top_k_per_query
+from partitioner import partition_csv
+from postContext import PostContextIndex
+from sentimentRollup import RollupStore
+
+# Default location of the stage artifacts (relative to the working directory)
+DEFAULT_CACHE_DIR = os.path.join(".cache", "pipeline")
+
+# Read size used when hashing source files
+HASH_BLOCK_SIZE = 1 << 20
+
+# Folder of the local modules whose source is part of the stage keys (this script's folder)
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Label ids used by the labelling notebooks
+LABEL2ID = {"positive": 1, "negative": -1, "neutral": 0}
+
+
+# ---- Content hashing
+
+class FileHasher:
+    """
+    Content hashes of files and folders.
+
+    Digests are remembered with the file size and modification time, so a file is only
+    re-read when it changed; a folder's hash combines the relative paths and hashes of its files.
+    """
+
+    def __init__(self, memo_file):
+        self.memo_file = memo_file
+        self.memo = {}
+        if os.path.exists(memo_file):
+            with open(memo_file) as f:
+                self.memo = json.load(f)
+
+    def file_hash(self, path):
+        stat = os.stat(path)
+        path = os.path.abspath(path)
+        cached = self.memo.get(path)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime_ns:
+            return cached[2]
+        hasher = hashlib.blake2b(digest_size=16)
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                hasher.update(block)
+        self.memo[path] = [stat.st_size, stat.st_mtime_ns, hasher.hexdigest()]
+        return self.memo[path][2]
+
+    def path_hash(self, path):
+        if os.path.isfile(path):
+            return self.file_hash(path)
+        hasher = hashlib.blake2b(digest_size=16)
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for name in sorted(files):
+                file_path = os.path.join(root, name)
+                hasher.update(os.path.relpath(file_path, path).encode())
+                hasher.update(self.file_hash(file_path).encode())
+        return hasher.hexdigest()
+
+    def save(self):
+        folder = os.path.dirname(self.memo_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        with open(self.memo_file, "w") as f:
+            json.dump(self.memo, f)
+
+
+# ---- DAG runner
+
+class Stage:
+    """
+    One step of the pipeline.
+
+    Parameters:
+    - name: Stage name (also the name of its artifact folder)
+    - func: Module-level function func(inputs, output_dir, **params) returning the path of its main artifact;
+            inputs maps each dependency (and source) name to its path
+    - deps: Names of the upstream stages
+    - sources: {name: path} of external files or folders, hashed by content
+    - params: Keyword arguments of func (must be JSON-serialisable)
+    """
+
+    def __init__(self, name, func, deps=(), sources=None, params=None):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.sources = sources or {}
+        self.params = params or {}
+
+
+def _local_module_file(name):
+    """Source file of a module of the Scripts folder (None for other modules)."""
+    path = os.path.join(SCRIPTS_DIR, f"{name.split('.')[0]}.py")
+    return path if os.path.isfile(path) else None
+
+
+def _code_names(code):
+    """Global names and imported modules used by a code object and the functions nested in it."""
+    names = set(code.co_names)
+    for const in code.co_consts:
+        if inspect.iscode(const):
+            names |= _code_names(const)
+    return names
+
+
+def code_dependencies(func):
+    """
+    Code a stage function depends on: the functions of its own module it calls (recursively), and the
+    source files of the local modules it uses (including those imported inside it) and of the local
+    modules they import.
+    """
+    functions, files, pending = [], set(), []
+    stack = [func]
+    while stack:
+        function = stack.pop()
+        if function in functions:
+            continue
+        functions.append(function)
+        for name in _code_names(function.__code__):
+            obj = function.__globals__.get(name)
+            if inspect.isfunction(obj) and obj.__module__ == func.__module__:
+                stack.append(obj)
+                continue
+            module = obj.__name__ if inspect.ismodule(obj) else getattr(obj, "__module__", None) if obj is not None else name
+            path = _local_module_file(module) if module and module != func.__module__ else None
+            if path:
+                pending.append(path)
+
+    while pending:
+        path = pending.pop()
+        if path in files:
+            continue
+        files.add(path)
+        with open(path, encoding="utf-8") as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                modules = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                modules = [node.module]
+            else:
+                continue
+            pending.extend(filter(None, map(_local_module_file, modules)))
+    return functions, sorted(files)
+
+
+def stage_key(stage, dep_keys, hasher):
+    """
+    Hash of the stage code (its function and the local modules it uses), its parameters, its upstream keys
+    and the content of its sources.
+    """
+    hasher_ = hashlib.blake2b(digest_size=16)
+    hasher_.update(stage.name.encode())
+    functions, files = code_dependencies(stage.func)
+    for function in functions:
+        hasher_.update(inspect.getsource(function).encode())
+    for path in files:
+        hasher_.update(os.path.basename(path).encode())
+        hasher_.update(hasher.file_hash(path).encode())
+    hasher_.update(json.dumps(stage.params, sort_keys=True, default=str).encode())
+    for dep in stage.deps:
+        hasher_.update(dep_keys[dep].encode())
+    for name, path in sorted(stage.sources.items()):
+        hasher_.update(name.encode())
+        hasher_.update(hasher.path_hash(path).encode())
+    return hasher_.hexdigest()
+
+
+def _run_stage(func, inputs, output_dir, params):
+    """Worker: run a stage into its artifact folder; stage.json is written last and marks it complete."""
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    start = time.perf_counter()
+    artifact = func(inputs, output_dir, **params)
+    record = {"artifact": os.path.relpath(artifact, output_dir), "seconds": time.perf_counter() - start}
+
+    # A stage interrupted before this point has no stage.json and is re-run
+    with open(os.path.join(output_dir, "stage.json.tmp"), "w") as f:
+        json.dump(record, f)
+    os.replace(os.path.join(output_dir, "stage.json.tmp"), os.path.join(output_dir, "stage.json"))
+    return record
+
+
+class Pipeline:
+    """
+    Runs a DAG of stages with content-hashed, cached artifacts.
+
+    Each stage's artifacts are stored in <cache_dir>/<stage>/<key>/, where key hashes the stage
+    code (and the local modules it uses), parameters, upstream keys and source contents (e.g. model folders). Stages whose key already has artifacts
+    are skipped; the others run in parallel processes as soon as their dependencies are done.
+    """
+
+    def __init__(self, stages, cache_dir=DEFAULT_CACHE_DIR, max_workers=None):
+        self.stages = {stage.name: stage for stage in stages}
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        for stage in stages:
+            missing = [dep for dep in stage.deps if dep not in self.stages]
+            if missing:
+                raise ValueError(f"Stage '{stage.name}' depends on unknown stage(s): {missing}")
+
+    def _selected(self, targets):
+        """The target stages and everything upstream of them."""
+        selected = set()
+        pending = list(targets or self.stages)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self.stages[name].deps)
+        return selected
+
+    def _output_dir(self, name, key):
+        return os.path.join(self.cache_dir, name, key)
+
+    def run(self, targets=None, force=()):
+        """Run the target stages (default: all), re-running the `force` stages even if cached."""
+        hasher = FileHasher(os.path.join(self.cache_dir, "file_hashes.json"))
+        selected = self._selected(targets)
+        keys, artifacts, report = {}, {}, {}
+        running = {}
+
+        with ProcessPoolExecutor(max_workers=self.max_workers) as executor:
+            while len(artifacts) < len(selected):
+                # Start (or skip) every stage whose dependencies are done
+                for name in sorted(selected):
+                    stage = self.stages[name]
+                    if name in artifacts or name in running.values() or any(dep not in artifacts for dep in stage.deps):
+                        continue
+                    keys[name] = stage_key(stage, keys, hasher)
+                    output_dir = self._output_dir(name, keys[name])
+                    record_file = os.path.join(output_dir, "stage.json")
+                    if os.path.exists(record_file) and name not in force:
+                        with open(record_file) as f:
+                            record = json.load(f)
+                        artifacts[name] = os.path.join(output_dir, record["artifact"])
+                        report[name] = ("cached", record["seconds"])
+                        continue
+
+                    inputs = {dep: artifacts[dep] for dep in stage.deps}
+                    inputs.update(stage.sources)
+                    print(f"Running stage '{name}'...")
+                    future = executor.submit(_run_stage, stage.func, inputs, output_dir, stage.params)
+                    running[future] = name
+
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    record = future.result()
+                    artifacts[name] = os.path.join(self._output_dir(name, keys[name]), record["artifact"])
+                    report[name] = ("ran", record["seconds"])
+
+        hasher.save()
+        self.print_report(report, keys)
+        return artifacts
+
+    def print_report(self, report, keys):
+        print("=" * 50)
+        for name in self.stages:
+            if name in report:
+                status, seconds = report[name]
+                print(f"{name:<10} {status:<7} {seconds:8.2f}s  {keys[name][:12]}")
+        print("=" * 50)
+
+
+# ---- Stages of the sentiment analysis workflow
+
+def join_stage(inputs, output_dir, folder_cache=os.path.join(DEFAULT_CACHE_DIR, "join_folders")):
+    """Combine the scrape folders (each folder is parsed once and cached by content)."""
+    hasher = FileHasher(os.path.join(folder_cache, "file_hashes.json"))
+    os.makedirs(folder_cache, exist_ok=True)
+    all_dfs = []
+    for root, csv_path, txt_path in find_scrape_folders(inputs["scrapes"]):
+        folder_key = hasher.file_hash(csv_path) + hasher.file_hash(txt_path)[:8]
+        cache_file = os.path.join(folder_cache, f"{folder_key}.parquet")
+        if os.path.exists(cache_file):
+            all_dfs.append(pd.read_parquet(cache_file))
+            continue
+        print(f"Processing folder: {root}...")
+        df = read_scrape_folder(csv_path, txt_path)
+        # Scrape CSVs mix numbers and text in some columns, so cache them as strings
+        df = df.astype({column: "string" for column in df.columns if df[column].dtype == object})
+        df.to_parquet(cache_file, index=False)
+        all_dfs.append(df)
+    hasher.save()
+
+    if not all_dfs:
+        raise ValueError(f"No valid CSV/query pairs found in {inputs['scrapes']}")
+    output_file = os.path.join(output_dir, "combined_data.parquet")
+    combine_frames(all_dfs).to_parquet(output_file, index=False)
+    return output_file
+
+
+def to_filter_schema(combined):
+    """
+    Convert the joined scrape (one row per post or comment with title/body/...) to the
+    post/comment schema used by the filtering stage: every comment row carries its post's fields.
+    """
+    is_post = combined["comment_id"].isna()
+    posts = combined[is_post].drop_duplicates("post_id").set_index("post_id")
+    comments = combined[~is_post]
+    post_fields = posts.reindex(comments["post_id"])
+
+    def post_rows(rows, fields, post_datetimes):
+        return pd.DataFrame({
+            "post_id": rows["post_id"].to_numpy(),
+            "post_title": fields["title"].to_numpy(),
+            "post_body": fields["body"].to_numpy(),
+            "post_author": fields["author"].to_numpy(),
+            "subreddit": rows["subreddit"].to_numpy(),
+            "query": rows["query"].to_numpy(),
+            "number_of_comments": fields["comments"].to_numpy(),
+            "number_of_upvotes": fields["upvotes"].to_numpy(),
+            "readable_datetime": post_datetimes,
+        })
+
+    comment_rows = post_rows(comments, post_fields, comments["date_time"].to_numpy()).assign(
+        comment_id=comments["comment_id"].to_numpy(),
+        comment_body=comments["body"].to_numpy(),
+        comment_author=comments["author"].to_numpy(),
+    )
+    # Posts without comments are kept as rows without comment fields
+    lonely = posts[~posts.index.isin(comments["post_id"])].reset_index()
+    lonely_rows = post_rows(lonely, lonely, lonely["date_time"].to_numpy())
+    return pd.concat([comment_rows, lonely_rows], ignore_index=True)
+
+
+def filter_stage(inputs, output_dir, years=5, min_words=3, memory_mb=1024):
+    """Heuristic filters of filtering.ipynb (see dataFilter.py)."""
+    combined_csv = os.path.join(output_dir, "combined_dataset.csv")
+    to_filter_schema(pd.read_parquet(inputs["join"])).to_csv(combined_csv, index=False)
+    output_file = os.path.join(output_dir, "filtered_data.parquet")
+    filter_data(combined_csv, output_file, years=years, min_words=min_words, memory_mb=memory_mb)
+    os.remove(combined_csv)
+    return output_file
+
+
+def clean_stage(inputs, output_dir, n_jobs=None):
+    """Add the "Cleaned Text" column (cleaned chunks are cached by textCleaner)."""
+    data = pd.read_parquet(inputs["filter"])
+    data["Cleaned Text"] = clean_series(data["text"], n_jobs=n_jobs).to_numpy()
+    output_file = os.path.join(output_dir, "cleaned_data.parquet")
+    data.to_parquet(output_file, index=False)
+    return output_file
+
+
+def dedup_stage(inputs, output_dir, threshold=0.8, n_jobs=None):
+    """Keep one representative per near-duplicate cluster, with its "cluster_size" (see nearDuplicates.py)."""
+    output_file = os.path.join(output_dir, "deduplicated_data.parquet")
+    deduplicate(inputs["clean"], output_file, threshold=threshold, n_jobs=n_jobs)
+    return output_file
+
+
+def select_stage(inputs, output_dir, queries=("OpenAI",), top_k=3000, min_df=5, block_size=50000):
+    """Keep the top_k records most similar to any of the queries (streaming TF-IDF)."""
+    data = pd.read_parquet(inputs["dedup"])
+    texts = data["Cleaned Text"].fillna("").astype(str)
+    model = StreamingTfidf(min_df=min_df)
+    for start in range(0, len(texts), block_size):
+        model.partial_fit(texts.iloc[start:start + block_size])
+    query_vectors = model.transform(list(queries), use_idf=True)
+
+    blocks = (model.transform(texts.iloc[start:start + block_size]) for start in range(0, len(texts), block_size))
+    scores, ids = top_k_per_query(query_vectors, blocks, k=top_k)
+
+    # A record's similarity is its best similarity over all the queries
+    best = pd.DataFrame({"id": ids.ravel(), "similarity": scores.ravel()}).groupby("id")["similarity"].max()
+    best = best.nlargest(top_k)
+    selected = data.iloc[best.index].assign(similarity=best.to_numpy())
+    output_file = os.path.join(output_dir, "selected_data.csv")
+    selected.to_csv(output_file, index=False)
+    return output_file
+
+
+def context_stage(inputs, output_dir):
+    """
+    Index of the parent post of every filtered record (see postContext.py), built in the stage folder from the
+    filtered data only (the new posts are merged with one sort and one write).
+    """
+    index = PostContextIndex(os.path.join(output_dir, "post_context"))
+    index.ingest_file(inputs["filter"])
+    return index.posts_file
+
+
+def label_stage(inputs, output_dir, model="cardiffnlp/twitter-roberta-base-sentiment-latest", batch_size=64,
+                cheap_model=None, cascade_threshold=None, post_context=False):
+    """
+    Label the selected records with the RoBERTa sentiment model, as label_data() in the labelling notebook,
+    or with a distilled student when model is a .joblib file (see distillStudent.py). With a cheap model,
+    only the records it scores below cascade_threshold go to the model (see cascadeLabeller.py).
+    With post_context, comments are labelled together with a summary of their parent post.
+    """
+    data = pd.read_csv(inputs["select"])
+    texts = data["text"].fillna("").astype(str).tolist()
+    if post_context:
+        index = PostContextIndex(os.path.dirname(inputs["context"]))
+        texts = index.build_inputs(data).tolist()
+    if cheap_model:
+        from cascadeLabeller import cascade_label
+        from sentimentService import load_model
+        data["roberta_label"], data["roberta_score"], data["tier"], _ = cascade_label(
+            texts, load_model(cheap_model), load_model(model), cascade_threshold, batch_size)
+    elif model.endswith(".joblib"):
+        from distillStudent import StudentModel
+        results = StudentModel.load(model)(texts)
+        data["roberta_label"] = [res["roberta_label"] for res in results]
+        data["roberta_score"] = [res["roberta_score"] for res in results]
+    else:
+        # transformers is only needed by this stage
+        from transformers import pipeline
+
+        sentiment_pipeline = pipeline("text-classification", model=model, tokenizer=model)
+        if post_context:
+            # The post summary and the comment are a sentence pair; only the summary is ever truncated
+            results = sentiment_pipeline(index.build_pairs(data), batch_size=batch_size, padding=True,
+                                         truncation="only_first", max_length=512)
+        else:
+            results = sentiment_pipeline(texts, batch_size=batch_size, padding=True, truncation=True, max_length=512)
+        data["roberta_label"] = [LABEL2ID[res["label"].lower()] for res in results]
+        data["roberta_score"] = [res["score"] for res in results]
+    data["label"] = data["roberta_label"]
+    output_file = os.path.join(output_dir, "labelled_data.csv")
+    data.to_csv(output_file, index=False)
+    return output_file
+
+
+def partition_stage(inputs, output_dir, shards=4, per_shard=None, reserve=0, stratify="roberta_label", seed=42):
+    """Stratified annotation shards (see partitioner.py)."""
+    output_files = [os.path.join(output_dir, f"labelling_shard_{i + 1}.csv") for i in range(shards)]
+    return partition_csv(inputs["label"], output_files, stratify=stratify, per_shard=per_shard,
+                         reserve=reserve, seed=seed)
+
+
+def aggregate_stage(inputs, output_dir):
+    """Sentiment counts per (day, subreddit, query, label) of the labelled records (see sentimentRollup.py)."""
+    store = RollupStore(os.path.join(output_dir, "sentiment_rollup.parquet"), label_column="roberta_label")
+    store.ingest_csv(inputs["label"])
+    store.save()
+    return store.store_file
+
+
+def build_stages(scrapes, queries, top_k=3000, years=5, shards=4, per_shard=None, reserve=0,
+                 model="cardiffnlp/twitter-roberta-base-sentiment-latest", dedup_threshold=0.8, cheap_model=None,
+                 cascade_threshold=None, post_context=False):
+    """join -> filter -> (context, clean -> dedup -> select) -> label -> (partition, aggregate)"""
+    # Local model folders are hashed by content, so a model retrained in place re-runs the label stage
+    models = {name: path for name, path in [("model", model), ("cheap_model", cheap_model)]
+              if path and os.path.exists(path)}
+    return [
+        Stage("join", join_stage, sources={"scrapes": scrapes}),
+        Stage("filter", filter_stage, deps=["join"], params={"years": years}),
+        Stage("context", context_stage, deps=["filter"]),
+        Stage("clean", clean_stage, deps=["filter"]),
+        Stage("dedup", dedup_stage, deps=["clean"], params={"threshold": dedup_threshold}),
+        Stage("select", select_stage, deps=["dedup"], params={"queries": list(queries), "top_k": top_k}),
+        Stage("label", label_stage, deps=["select"] + (["context"] if post_context else []), sources=models,
+              params={"model": model, "cheap_model": cheap_model, "cascade_threshold": cascade_threshold,
+                      "post_context": post_context}),
+        Stage("partition", partition_stage, deps=["label"],
+              params={"shards": shards, "per_shard": per_shard, "reserve": reserve}),
+        Stage("aggregate", aggregate_stage, deps=["label"]),
+    ]
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Run the sentiment analysis workflow with cached stages')
+    parser.add_argument('-d', '--scrapes', type=str, required=True, help='Parent folder of the scrape folders')
+    parser.add_argument('-q', '--query', type=str, action='append', default=None, help='Selection query (repeatable)')
+    parser.add_argument('-k', '--top-k', type=int, default=3000, help='Number of records to select')
+    parser.add_argument('-y', '--years', type=int, default=5, help='Keep records from the past N years')
+    parser.add_argument('-n', '--shards', type=int, default=4, help='Number of annotation shards')
+    parser.add_argument('--per-shard', type=int, default=None, help='Rows per label in each shard')
+    parser.add_argument('--reserve', type=int, default=0, help='Extra rows per label kept for top-ups')
+    parser.add_argument('-m', '--model', type=str, default='cardiffnlp/twitter-roberta-base-sentiment-latest',
+                        help='Sentiment model used by the label stage (or a distilled student .joblib)')
+    parser.add_argument('--cheap-model', type=str, default=None,
+                        help='Label with this cheap model first and send only uncertain records to --model')
+    parser.add_argument('--cascade-threshold', type=float, default=None,
+                        help='Cheap model score below which a record is escalated (default: from the calibration file)')
+    parser.add_argument('--calibration', type=str, default='Models/cascade_calibration.json',
+                        help='Calibration file written by cascadeLabeller.py --calibrate')
+    parser.add_argument('--post-context', action='store_true',
+                        help='Label comments together with a summary of their parent post')
+    parser.add_argument('--dedup-threshold', type=float, default=0.8,
+                        help='Minimum similarity of near-duplicates removed before selection')
+    parser.add_argument('-t', '--target', type=str, action='append', default=None,
+                        help='Run only this stage and its dependencies (repeatable)')
+    parser.add_argument('--force', type=str, action='append', default=[], help='Re-run this stage (repeatable)')
+    parser.add_argument('-w', '--workers', type=int, default=None, help='Number of parallel stage processes')
+    parser.add_argument('-o', '--output', type=str, default=None, help='Folder to copy the final artifacts to')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    cascade_threshold = args.cascade_threshold
+    if args.cheap_model and cascade_threshold is None:
+        with open(args.calibration) as f:
+            cascade_threshold = json.load(f)["threshold"]
+    stages = build_stages(args.scrapes, args.query or ["OpenAI"], top_k=args.top_k, years=args.years,
+                          shards=args.shards, per_shard=args.per_shard, reserve=args.reserve, model=args.model,
+                          dedup_threshold=args.dedup_threshold, cheap_model=args.cheap_model,
+                          cascade_threshold=cascade_threshold, post_context=args.post_context)
+    artifacts = Pipeline(stages, max_workers=args.workers).run(targets=args.target, force=set(args.force))
+
+    for name, artifact in artifacts.items():
+        print(f"{name:<10} {artifact}")
+        if args.output:
+            os.makedirs(args.output, exist_ok=True)
+            shutil.copytree(os.path.dirname(artifact), os.path.join(args.output, name), dirs_exist_ok=True)
+
+if __name__ == "__main__":
+    main()
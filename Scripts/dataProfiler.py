@@ -1,14 +1,20 @@
+import os
 import pandas as pd
 import argparse
+from tracing import span, traced
 
+@traced("count_unique_items")
 def count_unique_items(file_path):
     try:
         # Read the CSV file
-        df = pd.read_csv(file_path)
+        with span("profiler.read_csv", bytes=os.path.getsize(file_path)) as s:
+            df = pd.read_csv(file_path)
+            s.add(rows=len(df))
         
         # Count unique comment_ids and post_ids
-        unique_comments = len(df['comment_id'].unique()) if 'comment_id' in df.columns else 0
-        unique_posts = len(df['post_id'].unique()) if 'post_id' in df.columns else 0
+        with span("profiler.count_unique", rows=len(df)):
+            unique_comments = len(df['comment_id'].unique()) if 'comment_id' in df.columns else 0
+            unique_posts = len(df['post_id'].unique()) if 'post_id' in df.columns else 0
         
         # Print results
         print(f"Number of unique comments: {unique_comments}")
@@ -0,0 +1,305 @@
+import os
+import re
+import json
+import time
+import argparse
+
+import joblib
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.metrics import accuracy_score, f1_score
+
+from textCleaner import clean_series
+
+# Sentiment classes, in the order of the student's probability columns
+CLASSES = np.array([-1, 0, 1])
+
+# Manual rounds saved by the labeler: Data/Labelling/Manual/round<N>_manual_low_confidence.csv
+MANUAL_ROUND_RE = re.compile(r"^round(\d+)_manual_low_confidence\.csv$")
+
+# manual_label of the records marked irrelevant during manual labelling
+IRRELEVANT_LABEL = 2
+
+# Required throughput gain of the student over the teacher
+TARGET_SPEEDUP = 10
+
+
+def load_manual_labels(manual_dir, rounds=None):
+    """
+    Manual labels of the active learning rounds, as in process_manual_data(): the latest round's
+    label wins for a repeated text, and irrelevant (2) or missing labels are dropped.
+    """
+    files = {}
+    for name in os.listdir(manual_dir):
+        match = MANUAL_ROUND_RE.match(name)
+        if match and (rounds is None or int(match.group(1)) in rounds):
+            files[int(match.group(1))] = os.path.join(manual_dir, name)
+    frames = [pd.read_csv(files[round], usecols=["text", "manual_label"]) for round in sorted(files, reverse=True)]
+    if not frames:
+        return pd.DataFrame({"text": pd.Series(dtype=str), "manual_label": pd.Series(dtype=int)})
+    manual = pd.concat(frames, ignore_index=True).drop_duplicates("text", keep="first")
+    manual = manual[manual["manual_label"] != IRRELEVANT_LABEL].dropna()
+    return manual.astype({"manual_label": int}).reset_index(drop=True)
+
+
+def text_hashes(texts):
+    """64-bit hashes of texts (used to tell which texts a student was trained on)."""
+    return pd.util.hash_array(np.asarray([str(text) for text in texts], dtype=object))
+
+
+def teacher_probabilities(labels, scores):
+    """
+    Soft labels of the teacher from the columns written by label_data(): the top label gets its
+    roberta_score and the rest of the probability mass is shared by the other two classes.
+    """
+    labels = np.asarray(labels, dtype=np.int64)
+    scores = np.clip(np.asarray(scores, dtype=np.float64), 1 / len(CLASSES), 1.0)
+    probabilities = np.repeat(((1 - scores) / (len(CLASSES) - 1))[:, None], len(CLASSES), axis=1)
+    probabilities[np.arange(len(labels)), np.searchsorted(CLASSES, labels)] = scores
+    return probabilities
+
+
+class StudentModel:
+    """
+    Distilled student: cleaned text -> TF-IDF (word 1-2 grams) -> multinomial logistic regression.
+
+    It is trained on the teacher's soft labels (cross-entropy with soft targets, by repeating every
+    record once per class with the class probability as sample weight) plus the manual labels, and
+    scores texts like sentimentService.SentimentModel, so it can replace the teacher wherever a
+    batch of texts is labelled.
+
+    Parameters:
+    - max_features: Size of the TF-IDF vocabulary
+    - min_df: Ignore terms appearing in fewer records than this
+    - C: Inverse regularisation strength of the logistic regression
+    - name: Name reported by the scoring service
+    """
+
+    def __init__(self, max_features=200000, min_df=2, C=4.0, name="student"):
+        self.vectorizer = TfidfVectorizer(ngram_range=(1, 2), min_df=min_df, max_features=max_features,
+                                          sublinear_tf=True)
+        self.classifier = LogisticRegression(C=C, max_iter=1000)
+        self.name = name
+        # Sorted hashes of the training texts, so that calibration and evaluation can leave them out
+        self.train_hashes = None
+
+    def _features(self, texts, fit=False):
+        cleaned = clean_series(pd.Series(list(texts), dtype=object), n_jobs=1, cache_dir=None).fillna("")
+        return self.vectorizer.fit_transform(cleaned) if fit else self.vectorizer.transform(cleaned)
+
+    def fit(self, texts, probabilities, sample_weight=None):
+        """Fit on soft targets: probabilities is a (len(texts), 3) array over CLASSES."""
+        texts = list(texts)
+        X = self._features(texts, fit=True)
+        self.train_hashes = np.unique(text_hashes(texts))
+        n = X.shape[0]
+        weights = probabilities * (np.ones(n) if sample_weight is None else np.asarray(sample_weight))[:, None]
+        rows = np.tile(np.arange(n), len(CLASSES))
+        y = np.repeat(CLASSES, n)
+        weights = weights.T.ravel()
+        keep = weights > 0
+        self.classifier.fit(X[rows[keep]], y[keep], sample_weight=weights[keep])
+        return self
+
+    def predict_proba(self, texts):
+        """Probabilities over CLASSES (zero for a class absent from the training targets)."""
+        probabilities = np.zeros((len(texts), len(CLASSES)))
+        probabilities[:, np.searchsorted(CLASSES, self.classifier.classes_)] = \
+            self.classifier.predict_proba(self._features(texts))
+        return probabilities
+
+    def trained_on(self, texts):
+        """Mask of the texts the student was trained on (None if the student does not know its training texts)."""
+        if self.train_hashes is None:
+            return None
+        return np.isin(text_hashes(texts), self.train_hashes)
+
+    def predict(self, texts):
+        return self.classifier.classes_[self.classifier.predict_proba(self._features(texts)).argmax(axis=1)]
+
+    def __call__(self, texts):
+        """Score a batch of texts, returning the roberta_label/roberta_score columns of label_data()."""
+        probabilities = self.classifier.predict_proba(self._features(texts))
+        best = probabilities.argmax(axis=1)
+        return [{"roberta_label": int(label), "roberta_score": float(score)}
+                for label, score in zip(self.classifier.classes_[best], probabilities[np.arange(len(best)), best])]
+
+    def save(self, path):
+        folder = os.path.dirname(path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # The fitted components rather than the instance, so that a student trained by running this
+        # script (as __main__) loads from any module
+        joblib.dump({"vectorizer": self.vectorizer, "classifier": self.classifier, "name": self.name,
+                     "train_hashes": self.train_hashes}, f"{path}.tmp")
+        os.replace(f"{path}.tmp", path)
+
+    @staticmethod
+    def load(path):
+        state = joblib.load(path)
+        student = StudentModel(name=state["name"])
+        student.vectorizer, student.classifier = state["vectorizer"], state["classifier"]
+        student.train_hashes = state.get("train_hashes")
+        return student
+
+
+def throughput(score, texts, min_seconds=1.0):
+    """Texts scored per second by score(texts), repeating the batch for at least min_seconds."""
+    texts = list(texts)
+    count, start = 0, time.perf_counter()
+    while True:
+        score(texts)
+        count += len(texts)
+        elapsed = time.perf_counter() - start
+        if elapsed >= min_seconds:
+            return count / elapsed
+
+
+def evaluate(labels, predictions):
+    """Accuracy and weighted F1, as compute_metrics() in the labelling notebook."""
+    return {"accuracy": accuracy_score(labels, predictions), "f1": f1_score(labels, predictions, average="weighted")}
+
+
+def distill(teacher_files, manual_dir, val_file, output_file, teacher=None, manual_weight=3.0, max_teacher_rows=None,
+            throughput_rows=256, seed=42, **student_params):
+    """
+    Train a student on the teacher's soft labels and the manual labels, and compare it with the
+    teacher on the validation set (accuracy/F1 gap and throughput gain). Returns the report.
+
+    Parameters:
+    - teacher_files: CSVs labelled by label_data() (text, roberta_label, roberta_score)
+    - manual_dir: Folder of the round<N>_manual_low_confidence.csv files (None skips the manual labels)
+    - val_file: manual_val_set.csv (never used for training)
+    - output_file: Student model file (.joblib); the report is saved next to it
+    - teacher: Teacher model folder, to measure its throughput (and its validation metrics when
+      the validation set has no roberta_label column)
+    - manual_weight: Weight of a manual label relative to a teacher soft label
+    - max_teacher_rows: Sample at most this many teacher-labelled records
+    - throughput_rows: Validation texts scored when measuring throughput
+    """
+    print("=" * 50)
+    val = pd.read_csv(val_file)
+    val = val[val["manual_label"] != IRRELEVANT_LABEL].dropna(subset=["text", "manual_label"])
+    val_texts = set(val["text"])
+
+    # Teacher soft labels (records of the validation set are left out)
+    teacher_data = pd.concat([pd.read_csv(path, usecols=["text", "roberta_label", "roberta_score"])
+                              for path in teacher_files], ignore_index=True)
+    teacher_data = teacher_data.dropna().drop_duplicates("text", keep="last")
+    teacher_data = teacher_data[~teacher_data["text"].isin(val_texts)]
+    if max_teacher_rows and len(teacher_data) > max_teacher_rows:
+        teacher_data = teacher_data.sample(max_teacher_rows, random_state=seed)
+    soft = teacher_probabilities(teacher_data["roberta_label"], teacher_data["roberta_score"])
+
+    # Manual labels as one-hot targets, replacing the teacher's label of the same text
+    manual = load_manual_labels(manual_dir) if manual_dir else pd.DataFrame({"text": [], "manual_label": []})
+    manual = manual[~manual["text"].isin(val_texts)]
+    teacher_data_mask = ~teacher_data["text"].isin(set(manual["text"])).to_numpy()
+    hard = np.zeros((len(manual), len(CLASSES)))
+    hard[np.arange(len(manual)), np.searchsorted(CLASSES, manual["manual_label"].to_numpy())] = 1
+
+    texts = pd.concat([teacher_data["text"][teacher_data_mask], manual["text"]], ignore_index=True)
+    targets = np.vstack([soft[teacher_data_mask], hard])
+    weights = np.concatenate([np.ones(teacher_data_mask.sum()), np.full(len(manual), manual_weight)])
+    print(f"Training the student on {teacher_data_mask.sum():,} teacher labels and {len(manual):,} manual labels")
+
+    start = time.perf_counter()
+    student = StudentModel(**student_params).fit(texts, targets, weights)
+    train_seconds = time.perf_counter() - start
+    student.save(output_file)
+
+    # Validation metrics of the student and the teacher
+    labels = val["manual_label"].astype(int).to_numpy()
+    report = {"student": evaluate(labels, student.predict(val["text"])),
+              "train_rows": {"teacher": int(teacher_data_mask.sum()), "manual": len(manual)},
+              "train_seconds": train_seconds}
+    teacher_model = None
+    if teacher:
+        from sentimentService import SentimentModel
+        teacher_model = SentimentModel(teacher)
+    if "roberta_label" in val:
+        report["teacher"] = evaluate(labels, val["roberta_label"].astype(int).to_numpy())
+    elif teacher_model is not None:
+        report["teacher"] = evaluate(labels, [result["roberta_label"] for result in teacher_model(val["text"].tolist())])
+    if "teacher" in report:
+        report["gap"] = {metric: report["teacher"][metric] - report["student"][metric] for metric in report["student"]}
+
+    # Throughput on the same validation texts
+    sample = val["text"].astype(str).tolist()[:throughput_rows]
+    report["throughput"] = {"student_texts_per_s": throughput(student, sample)}
+    if teacher_model is not None:
+        teacher_speed = throughput(teacher_model, sample)
+        report["throughput"].update(teacher_texts_per_s=teacher_speed,
+                                    speedup=report["throughput"]["student_texts_per_s"] / teacher_speed)
+
+    report_file = f"{os.path.splitext(output_file)[0]}_eval_results.json"
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=4)
+
+    print(f"Student:  accuracy {report['student']['accuracy']:.4f}  F1 {report['student']['f1']:.4f}")
+    if "teacher" in report:
+        print(f"Teacher:  accuracy {report['teacher']['accuracy']:.4f}  F1 {report['teacher']['f1']:.4f}  "
+              f"(F1 gap {report['gap']['f1']:+.4f})")
+    speed = report["throughput"]
+    print(f"Student throughput: {speed['student_texts_per_s']:,.0f} texts/s")
+    if "speedup" in speed:
+        verdict = "meets" if speed["speedup"] >= TARGET_SPEEDUP else "misses"
+        print(f"Teacher throughput: {speed['teacher_texts_per_s']:,.1f} texts/s "
+              f"({speed['speedup']:,.1f}x, {verdict} the {TARGET_SPEEDUP}x target)")
+    print(f"Student saved to {output_file}, report saved to {report_file}")
+    print("=" * 50)
+    return report
+
+
+def label_file(input_file, student_file, output_file=None, batch_size=10000):
+    """
+    Label a CSV with a student, writing the roberta_label/roberta_score columns as label_data() does, to a new CSV
+    (<input>_student_labelled.csv by default). The input file is never overwritten.
+    """
+    output_file = output_file or f"{os.path.splitext(input_file)[0]}_student_labelled.csv"
+    if os.path.abspath(output_file) == os.path.abspath(input_file):
+        raise ValueError(f"The labelled output would overwrite the input file {input_file}")
+    student = StudentModel.load(student_file)
+    data = pd.read_csv(input_file)
+    texts = data["text"].fillna("").astype(str).tolist()
+    results = [result for start in range(0, len(texts), batch_size) for result in student(texts[start:start + batch_size])]
+    data["roberta_label"] = [result["roberta_label"] for result in results]
+    data["roberta_score"] = [result["roberta_score"] for result in results]
+    data.to_csv(output_file, index=False)
+    print(f"Labelled {len(data):,} records with {student_file} and saved to {output_file}")
+    return data
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Distil the RoBERTa labels and manual labels into a fast student classifier')
+    parser.add_argument('-t', '--teacher-labels', type=str, nargs='+', default=[],
+                        help='CSVs labelled by the teacher (text, roberta_label, roberta_score)')
+    parser.add_argument('--manual-dir', type=str, default='Data/Labelling/Manual',
+                        help='Folder of the round<N>_manual_low_confidence.csv files')
+    parser.add_argument('-v', '--val', type=str, default='Data/Labelling/Manual/manual_val_set.csv',
+                        help='Validation set (never used for training)')
+    parser.add_argument('--teacher', type=str, default=None, help='Teacher model folder, to measure the speedup')
+    parser.add_argument('-o', '--output', type=str, default='Models/student.joblib', help='Student model file')
+    parser.add_argument('--manual-weight', type=float, default=3.0, help='Weight of a manual label')
+    parser.add_argument('--max-teacher-rows', type=int, default=None, help='Sample at most this many teacher labels')
+    parser.add_argument('--label', type=str, default=None, help='Label this CSV with the student (-s) instead of training')
+    parser.add_argument('-s', '--student', type=str, default='Models/student.joblib', help='Student used by --label')
+    parser.add_argument('-l', '--label-output', type=str, default=None,
+                        help='Labelled CSV written by --label (defaults to <input>_student_labelled.csv)')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.label:
+        label_file(args.label, args.student, args.label_output)
+        return
+    if not args.teacher_labels:
+        parser.error("--teacher-labels is required for training")
+    distill(args.teacher_labels, args.manual_dir, args.val, args.output, teacher=args.teacher,
+            manual_weight=args.manual_weight, max_teacher_rows=args.max_teacher_rows)
+
+if __name__ == "__main__":
+    main()
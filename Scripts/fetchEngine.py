@@ -0,0 +1,641 @@
+import os
+import json
+import time
+import heapq
+import random
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+from tracing import span
+
+# Point the fetchers at a mock server (Scripts/redditMock.py) with REDDIT_API_URL=http://127.0.0.1:8080;
+# they talk to the real Reddit API otherwise.
+API_URL_ENV_VAR = "REDDIT_API_URL"
+
+# Real endpoints
+OAUTH_URL = "https://oauth.reddit.com"
+WWW_URL = "https://www.reddit.com"
+TOKEN_PATH = "api/v1/access_token"
+
+# Reddit returns at most 100 items per listing page and per morechildren call
+MAX_PAGE_SIZE = 100
+
+# Per-stage concurrency: listings fetched at once, posts whose comments are fetched at once,
+# concurrent "more" expansions (across all posts, and for a single post) and threads flattening comment trees
+DEFAULT_CONCURRENCY = {"listing": 2, "comments": 8, "more": 8, "more_per_post": 4, "flatten": 2}
+
+# Comment fields kept by the engine (Reddit returns about 60 per comment)
+COMMENT_FIELDS = ("id", "name", "parent_id", "link_id", "body", "author", "score", "created_utc",
+                  "subreddit", "permalink", "edited", "stickied", "distinguished")
+
+
+class Thing(dict):
+    """Post or comment data: a dict whose keys can also be read as attributes (post.title, comment.score)."""
+
+    __slots__ = ()
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name) from None
+
+
+# ---- API client
+
+class RedditClient:
+    """
+    Minimal Reddit API client over one pooled aiohttp session.
+
+    Authenticates with the password grant (like praw/asyncpraw script apps), follows the
+    x-ratelimit headers (every request waits once the window is used up), and retries 429s,
+    5xx responses and connection errors with exponential backoff. Set REDDIT_API_URL to send
+    every request to a local mock server (Scripts/redditMock.py).
+
+    Parameters:
+    - client_id, client_secret, username, password: Reddit script app credentials
+    - user_agent: User agent sent with every request
+    - api_url: Base URL replacing both Reddit endpoints (default: REDDIT_API_URL, if set)
+    - max_connections: Size of the connection pool
+    - max_retries: Retries per request before giving up
+    - timeout: Timeout of a request in seconds
+    """
+
+    def __init__(self, client_id, client_secret, username, password, user_agent="my user agent", api_url=None,
+                 max_connections=16, max_retries=5, timeout=60):
+        api_url = (api_url or os.getenv(API_URL_ENV_VAR) or "").rstrip("/")
+        self.oauth_url = api_url or OAUTH_URL
+        self.token_url = f"{api_url or WWW_URL}/{TOKEN_PATH}"
+        self.credentials = (client_id, client_secret, username, password)
+        self.user_agent = user_agent
+        self.max_connections = max_connections
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.backoff = 0.5
+        self.stats = {"requests": 0, "retries": 0, "throttled": 0}
+        self._session = None
+        self._token = None
+        self._token_expiry = 0
+        self._token_lock = None
+        self._resume_at = 0
+        self._in_flight = 0
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def _get_session(self):
+        # Created lazily: the session belongs to the event loop it is created in
+        if self._session is None:
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                timeout=aiohttp.ClientTimeout(total=self.timeout),
+                headers={"User-Agent": self.user_agent},
+            )
+            self._token_lock = asyncio.Lock()
+        return self._session
+
+    async def _authorize(self):
+        async with self._token_lock:
+            if self._token and time.monotonic() < self._token_expiry:
+                return self._token
+            client_id, client_secret, username, password = self.credentials
+            data = {"grant_type": "password", "username": username, "password": password}
+            async with self._session.post(self.token_url, data=data,
+                                          auth=aiohttp.BasicAuth(client_id, client_secret)) as response:
+                response.raise_for_status()
+                token = await response.json(content_type=None)
+            if "access_token" not in token:
+                raise ValueError(f"Reddit authentication failed: {token.get('error', token)}")
+            self._token = token["access_token"]
+            self._token_expiry = time.monotonic() + token.get("expires_in", 3600) - 60
+            return self._token
+
+    def _update_rate_limit(self, headers):
+        remaining = headers.get("x-ratelimit-remaining")
+        reset = headers.get("x-ratelimit-reset")
+        # Stop before the window is used up by the requests already in flight
+        if remaining is not None and reset is not None and float(remaining) < self._in_flight:
+            self._resume_at = max(self._resume_at, time.monotonic() + float(reset))
+
+    async def _wait(self, delay=0):
+        delay = max(delay, self._resume_at - time.monotonic())
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def _retry_delay(self, attempt):
+        return min(self.backoff * 2 ** attempt, 60) * random.uniform(0.5, 1.5)
+
+    async def request(self, method, path, params=None, data=None):
+        """JSON response of an API call, after waiting for the rate limit and retrying transient errors."""
+        session = self._get_session()
+        params = {key: str(value) for key, value in {"raw_json": 1, **(params or {})}.items() if value is not None}
+        delay = 0
+        for attempt in range(self.max_retries + 1):
+            await self._wait(delay)
+            token = await self._authorize()
+            self.stats["requests"] += 1
+            self._in_flight += 1
+            try:
+                async with session.request(method, f"{self.oauth_url}/{path}", params=params, data=data,
+                                           headers={"Authorization": f"bearer {token}"}) as response:
+                    self._update_rate_limit(response.headers)
+                    if response.status == 401:
+                        # Expired token: authenticate again
+                        self._token = None
+                    elif response.status == 429:
+                        self.stats["throttled"] += 1
+                        reset = float(response.headers.get("x-ratelimit-reset", 0))
+                        self._resume_at = max(self._resume_at, time.monotonic() + reset)
+                    elif response.status < 500:
+                        response.raise_for_status()
+                        return await response.json(content_type=None)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if attempt == self.max_retries:
+                    raise
+            finally:
+                self._in_flight -= 1
+            self.stats["retries"] += 1
+            delay = self._retry_delay(attempt)
+        raise RuntimeError(f"{method} /{path} still failing after {self.max_retries} retries")
+
+    async def listing(self, subreddit, sort="hot", query=None, time_filter="all", limit=100, params=None):
+        """Async generator of the posts of a subreddit listing (or search), one page of 100 at a time."""
+        params = dict(params or {})
+        if query:
+            path = f"r/{subreddit}/search"
+            params.update(q=query, sort=sort, t=time_filter, restrict_sr="on" if subreddit != "all" else None)
+        else:
+            path = f"r/{subreddit}/{sort}"
+            if sort in ("top", "controversial"):
+                params["t"] = time_filter
+        after, count = None, 0
+        while count < limit:
+            with span("reddit.listing", subreddit=subreddit, query=query) as s:
+                page = await self.request("GET", path, {**params, "limit": min(MAX_PAGE_SIZE, limit - count),
+                                                        "after": after, "count": count or None})
+                s.add(rows=len(page["data"]["children"]))
+            children = page["data"]["children"]
+            for child in children[:limit - count]:
+                yield Thing(child["data"])
+            count += len(children)
+            after = page["data"].get("after")
+            if not after or not children:
+                break
+
+    async def submission(self, post_id, limit=None, sort=None, comment=None):
+        """Post data and comment listing of a submission (or of the thread below one comment)."""
+        path = f"comments/{post_id}" + (f"/_/{comment}" if comment else "")
+        with span("reddit.comments", post_id=post_id):
+            post_listing, comment_listing = await self.request("GET", path, {"limit": limit, "sort": sort})
+        return Thing(post_listing["data"]["children"][0]["data"]), comment_listing
+
+    async def more_children(self, link_id, children, sort="confidence"):
+        """Things (comments and nested "more" nodes) hidden behind a "more" node (at most 100 children)."""
+        data = {"api_type": "json", "link_id": link_id, "children": ",".join(children), "sort": sort}
+        with span("reddit.morechildren", rows=len(children)):
+            response = await self.request("POST", "api/morechildren", data=data)
+        return response["json"]["data"]["things"]
+
+
+# ---- Comment trees
+
+def walk_listing(listing, comments, more):
+    """Collect the comments of a (nested) listing into `comments` (id -> data) and its "more" nodes into `more`."""
+    if not listing:
+        return
+    stack = list(reversed(listing["data"]["children"]))
+    while stack:
+        child = stack.pop()
+        data = child["data"]
+        if child["kind"] == "more":
+            more.append(data)
+        elif child["kind"] == "t1":
+            comments[data["id"]] = data
+            replies = data.get("replies")
+            if replies:
+                stack.extend(reversed(replies["data"]["children"]))
+
+
+def flatten_comments(post, comments):
+    """
+    Comments in thread order (each comment followed by its replies), with their depth,
+    as Things holding COMMENT_FIELDS. Comments whose parent was not fetched come last.
+    """
+    children = {}
+    for data in comments.values():
+        children.setdefault(data["parent_id"], []).append(data)
+
+    flat = []
+    stack = [(data, 0) for data in reversed(children.get(post["name"], []))]
+    while stack:
+        data, depth = stack.pop()
+        comment = Thing((field, data.get(field)) for field in COMMENT_FIELDS)
+        comment["depth"] = depth
+        flat.append(comment)
+        stack.extend((reply, depth + 1) for reply in reversed(children.get(data["name"], [])))
+
+    if len(flat) < len(comments):
+        placed = {comment["id"] for comment in flat}
+        for data in comments.values():
+            if data["id"] not in placed:
+                comment = Thing((field, data.get(field)) for field in COMMENT_FIELDS)
+                comment["depth"] = data.get("depth", 0)
+                flat.append(comment)
+    return flat
+
+
+def nest_comments(comments):
+    """Rebuild the hierarchy of flattened comments: top-level comments, each with a "replies" list."""
+    by_name, roots = {}, []
+    for comment in comments:
+        node = Thing(comment, replies=[])
+        by_name[comment["name"]] = node
+        parent = by_name.get(comment["parent_id"])
+        (parent["replies"] if parent is not None else roots).append(node)
+    return roots
+
+
+# ---- Sinks
+
+class Sink:
+    """Output of the engine: override write (accepted posts), reject (filtered posts) and close as needed."""
+
+    def write(self, post, comments):
+        pass
+
+    def reject(self, post, reasons):
+        pass
+
+    def close(self):
+        pass
+
+
+class CollectSink(Sink):
+    """Keeps the accepted posts (with their comments) and the rejected ones in memory."""
+
+    def __init__(self):
+        self.posts = []
+        self.rejected = []
+
+    def write(self, post, comments):
+        self.posts.append((post, comments))
+
+    def reject(self, post, reasons):
+        self.rejected.append((post, reasons))
+
+
+class JsonlSink(Sink):
+    """Writes one {"post": ..., "comments": [...]} line per accepted post."""
+
+    def __init__(self, file_path):
+        self.file = open(file_path, "a", encoding="utf-8")
+
+    def write(self, post, comments):
+        self.file.write(json.dumps({"post": post, "comments": comments}) + "\n")
+
+    def close(self):
+        self.file.close()
+
+
+# ---- Engine
+
+class CommentBudget:
+    """
+    Per-post limits of the "more" expansion, so that a few huge threads cannot stall a scrape.
+    The expansion stops at the first limit reached; what was left out is recorded by the engine.
+
+    Parameters:
+    - max_calls: API calls spent on "more" nodes (0 keeps the first page only, like replace_more(limit=0))
+    - max_depth: "more" nodes deeper than this are not expanded (top-level comments have depth 0)
+    - max_comments: No new expansion starts once the post has this many comments
+    - time_limit: Seconds spent expanding one post; calls still running at the deadline are cancelled
+
+    None disables a limit; the default budget expands everything.
+    """
+
+    def __init__(self, max_calls=None, max_depth=None, max_comments=None, time_limit=None):
+        self.max_calls = max_calls
+        self.max_depth = max_depth
+        self.max_comments = max_comments
+        self.time_limit = time_limit
+
+
+class Listing:
+    """A subreddit listing (or a search when query is set) to fetch."""
+
+    def __init__(self, subreddit="all", sort="hot", query=None, time_filter="all", limit=100, params=None):
+        self.subreddit = subreddit or "all"
+        self.sort = sort
+        self.query = query
+        self.time_filter = time_filter
+        self.limit = limit
+        self.params = params
+
+
+def _reasons(result):
+    """Normalise a filter result (None, a reason or a list of reasons) to a list."""
+    if not result:
+        return []
+    return [result] if isinstance(result, str) else list(result)
+
+
+class FetchEngine:
+    """
+    Fetches listings, then the comments of every post, through one RedditClient.
+
+    Posts stream from the listing tasks into a bounded queue consumed by the comment workers,
+    so comments are fetched while the next listing pages arrive. Each worker fetches the
+    submission, expands its "more" nodes concurrently, flattens the comment tree in a thread
+    and hands the result to the sinks. Filters can reject posts before their comments are
+    fetched (post_filters), once the comments are known (thread_filters), and drop single
+    comments (comment_filters).
+
+    Parameters:
+    - client: RedditClient
+    - sinks: Sink objects receiving the accepted and rejected posts
+    - post_filters: Functions post -> None, a reason or a list of reasons to reject the post
+    - thread_filters: Functions (post, comments) -> None or reasons, run before the comment filters
+    - comment_filters: Functions (comment, post) -> truthy to drop the comment
+    - concurrency: Per-stage limits, overriding DEFAULT_CONCURRENCY
+    - budget: CommentBudget of the "more" expansion of each post (default: expand everything)
+    - comment_limit, comment_sort: Comments returned with the submission (Reddit's limit and sort)
+    - min_comments: Reject posts left with fewer comments after the comment filters
+    - on_progress: Function (stage, done, total) called as listings and posts progress
+    - on_error: Function (post, exception) for posts that failed (default: print and continue)
+    """
+
+    def __init__(self, client, sinks=(), post_filters=(), thread_filters=(), comment_filters=(), concurrency=None,
+                 budget=None, comment_limit=None, comment_sort=None, min_comments=0, on_progress=None,
+                 on_error=None):
+        self.client = client
+        self.sinks = list(sinks)
+        self.post_filters = list(post_filters)
+        self.thread_filters = list(thread_filters)
+        self.comment_filters = list(comment_filters)
+        self.concurrency = {**DEFAULT_CONCURRENCY, **(concurrency or {})}
+        self.budget = budget or CommentBudget()
+        self.truncations = []
+        self.comment_limit = comment_limit
+        self.comment_sort = comment_sort
+        self.min_comments = min_comments
+        self.on_progress = on_progress or (lambda stage, done, total: None)
+        self.on_error = on_error or (lambda post, error: print(f"Error fetching post {post['id']}: {error}"))
+        self.stats = {}
+
+    async def run(self, *listings):
+        """Fetch the listings and the comments of their posts; returns the run statistics."""
+        self.stats = {"listed": 0, "accepted": 0, "rejected": 0, "errors": 0, "comments": 0, "more_calls": 0,
+                      "truncated": 0}
+        self.truncations = []
+        total = sum(listing.limit for listing in listings)
+        n_workers = self.concurrency["comments"]
+        queue = asyncio.Queue(maxsize=2 * n_workers)
+        listing_semaphore = asyncio.Semaphore(self.concurrency["listing"])
+        self._more_semaphore = asyncio.Semaphore(self.concurrency["more"])
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency["flatten"])
+        self._done = 0
+        self._total = total
+
+        async def produce(listing):
+            async with listing_semaphore:
+                async for post in self.client.listing(listing.subreddit, listing.sort, listing.query,
+                                                      listing.time_filter, listing.limit, listing.params):
+                    self.stats["listed"] += 1
+                    self.on_progress("listing", self.stats["listed"], total)
+                    reasons = [reason for check in self.post_filters for reason in _reasons(check(post))]
+                    if reasons:
+                        self._reject(post, reasons)
+                    else:
+                        await queue.put(post)
+
+        workers = [asyncio.create_task(self._worker(queue)) for _ in range(n_workers)]
+        try:
+            await asyncio.gather(*(produce(listing) for listing in listings))
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+            self._executor.shutdown(wait=False)
+            for sink in self.sinks:
+                sink.close()
+        return self.stats
+
+    def _reject(self, post, reasons):
+        self.stats["rejected"] += 1
+        self._advance()
+        for sink in self.sinks:
+            sink.reject(post, reasons)
+
+    def _advance(self):
+        self._done += 1
+        self.on_progress("posts", self._done, self._total)
+
+    async def _worker(self, queue):
+        while True:
+            post = await queue.get()
+            if post is None:
+                return
+            try:
+                await self._process(post)
+            except Exception as e:
+                self.stats["errors"] += 1
+                self._advance()
+                self.on_error(post, e)
+
+    async def _process(self, post):
+        loaded, listing = await self.client.submission(post["id"], limit=self.comment_limit, sort=self.comment_sort)
+        post = Thing(post, **loaded)
+        comments, more = {}, []
+        walk_listing(listing, comments, more)
+        post["expansion"] = await self.expand(post, comments, more)
+
+        loop = asyncio.get_running_loop()
+        with span("flatten", rows=len(comments)):
+            comments = await loop.run_in_executor(self._executor, flatten_comments, post, comments)
+
+        reasons = [reason for check in self.thread_filters for reason in _reasons(check(post, comments))]
+        if not reasons and self.comment_filters:
+            comments = [comment for comment in comments
+                        if not any(check(comment, post) for check in self.comment_filters)]
+        if not reasons and len(comments) < self.min_comments:
+            reasons.append(f"low comments ({len(comments)})")
+        if reasons:
+            self._reject(post, reasons)
+            return
+
+        self.stats["accepted"] += 1
+        self.stats["comments"] += len(comments)
+        self._advance()
+        with span("sink.write", rows=len(comments)):
+            for sink in self.sinks:
+                sink.write(post, comments)
+
+    async def expand(self, post, comments, more):
+        """
+        Replace "more" nodes by the comments behind them within the budget. The largest nodes
+        are expanded first (as PRAW does), up to more_per_post at once for one post and "more"
+        at once across posts. Returns the expansion record of the post: calls made, comments,
+        time spent and, when the budget cut it short, why and how much was left unexpanded.
+        """
+        budget = self.budget
+        start = time.monotonic()
+        # The index keeps the heap ordering stable between nodes of the same size
+        heap = [(-node.get("count", 0), i, node) for i, node in enumerate(more)]
+        heapq.heapify(heap)
+        counter, calls = len(heap), 0
+        skipped, reasons = [], set()
+
+        while heap:
+            remaining_time = budget.time_limit - (time.monotonic() - start) if budget.time_limit is not None else None
+            if budget.max_calls is not None and calls >= budget.max_calls:
+                reasons.add("calls")
+                break
+            if budget.max_comments is not None and len(comments) >= budget.max_comments:
+                reasons.add("comments")
+                break
+            if remaining_time is not None and remaining_time <= 0:
+                reasons.add("time")
+                break
+
+            # Fill a batch without overshooting the call and comment budgets
+            batch, expected = [], len(comments)
+            while heap and len(batch) < self.concurrency["more_per_post"] \
+                    and (budget.max_calls is None or calls + len(batch) < budget.max_calls) \
+                    and (budget.max_comments is None or expected < budget.max_comments):
+                node = heapq.heappop(heap)[2]
+                if budget.max_depth is not None and node.get("depth", 0) > budget.max_depth:
+                    reasons.add("depth")
+                    skipped.append(node)
+                    continue
+                batch.append(node)
+                expected += min(node.get("count") or 1, MAX_PAGE_SIZE)
+            if not batch:
+                continue
+            calls += len(batch)
+
+            tasks = [asyncio.ensure_future(self._expand_node(post, node)) for node in batch]
+            done, pending = await asyncio.wait(tasks, timeout=remaining_time)
+            if pending:
+                reasons.add("time")
+                for task in pending:
+                    task.cancel()
+                await asyncio.gather(*pending, return_exceptions=True)
+            # Results are merged in batch order, so the comment order does not depend on timing
+            for node, task in zip(batch, tasks):
+                if task in pending:
+                    skipped.append(node)
+                    continue
+                found, nested = task.result()
+                comments.update(found)
+                for nested_node in nested:
+                    heapq.heappush(heap, (-nested_node.get("count", 0), counter, nested_node))
+                    counter += 1
+
+        skipped += [node for *_, node in heap]
+        self.stats["more_calls"] += calls
+        record = {
+            "post_id": post["id"],
+            "more_calls": calls,
+            "comments": len(comments),
+            "elapsed_s": round(time.monotonic() - start, 3),
+            "truncated": bool(skipped),
+            "reasons": sorted(reasons) if skipped else [],
+            "skipped_nodes": len(skipped),
+            # Ids listed by the skipped nodes ("continue this thread" nodes list none and only count as nodes)
+            "skipped_comments": sum(len(node.get("children") or []) for node in skipped),
+        }
+        if skipped:
+            self.stats["truncated"] += 1
+            self.truncations.append(record)
+        return record
+
+    async def _expand_node(self, post, node):
+        """Fetch the comments behind one "more" node; returns them (id -> data) and the nested "more" nodes."""
+        found, more = {}, []
+        async with self._more_semaphore:
+            if node.get("children"):
+                things = await self.client.more_children(post["name"], node["children"][:MAX_PAGE_SIZE])
+                for thing in things:
+                    if thing["kind"] == "more":
+                        more.append(thing["data"])
+                    elif thing["kind"] == "t1":
+                        walk_listing({"data": {"children": [thing]}}, found, more)
+                if len(node["children"]) > MAX_PAGE_SIZE:
+                    more.append({**node, "children": node["children"][MAX_PAGE_SIZE:],
+                                 "count": node.get("count", 0) - MAX_PAGE_SIZE})
+            else:
+                # "Continue this thread": fetch the thread below the parent comment
+                parent = node["parent_id"].split("_", 1)[1]
+                _, listing = await self.client.submission(post["id"], comment=parent)
+                walk_listing(listing, found, more)
+                found.pop(parent, None)
+        return found, more
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Fetch Reddit posts and comments into a JSON lines file')
+    parser.add_argument('-s', '--subreddit', type=str, default='all', help='Subreddit to fetch')
+    parser.add_argument('-q', '--query', type=str, action='append', default=[], help='Search query (repeatable)')
+    parser.add_argument('--sort', type=str, default='hot', help='hot, new, top, relevance, comments...')
+    parser.add_argument('-t', '--time-filter', type=str, default='all', help='Time filter of top and search listings')
+    parser.add_argument('-n', '--limit', type=int, default=100, help='Posts per listing')
+    parser.add_argument('-o', '--output', type=str, required=True, help='Output JSON lines file')
+    parser.add_argument('--max-calls', type=int, default=None, help='"more" API calls per post (default: no limit)')
+    parser.add_argument('--max-depth', type=int, default=None, help='Deepest "more" nodes expanded')
+    parser.add_argument('--max-comments', type=int, default=None, help='Comments per post before expansion stops')
+    parser.add_argument('--time-limit', type=float, default=None, help='Seconds of expansion per post')
+    parser.add_argument('--truncation-log', type=str, default=None, help='JSON file listing the truncated posts')
+    parser.add_argument('--concurrency', type=str, nargs='*', default=[], help='Stage limits, e.g. comments=16 more=8')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    concurrency = {stage: int(value) for stage, value in (item.split("=") for item in args.concurrency)}
+    listings = [Listing(args.subreddit, args.sort, query, args.time_filter, args.limit) for query in args.query]
+    listings = listings or [Listing(args.subreddit, args.sort, None, args.time_filter, args.limit)]
+
+    budget = CommentBudget(args.max_calls, args.max_depth, args.max_comments, args.time_limit)
+
+    async def run():
+        async with RedditClient(os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'), os.getenv('USER'),
+                                os.getenv('PASSWORD')) as client:
+            engine = FetchEngine(client, sinks=[JsonlSink(args.output)], concurrency=concurrency, budget=budget)
+            start = time.perf_counter()
+            stats = await engine.run(*listings)
+            elapsed = time.perf_counter() - start
+        print("=" * 50)
+        print(f"Fetched {stats['accepted']} posts and {stats['comments']:,} comments in {elapsed:.1f}s "
+              f"({client.stats['requests']} requests, {client.stats['retries']} retries, "
+              f"{client.stats['throttled']} throttled)")
+        skipped = sum(record["skipped_comments"] for record in engine.truncations)
+        print(f"Truncated {stats['truncated']} posts ({skipped:,} comments left unexpanded)")
+        if args.truncation_log:
+            with open(args.truncation_log, "w") as f:
+                json.dump(engine.truncations, f, indent=4)
+            print(f"Truncated posts saved to {args.truncation_log}")
+        print("=" * 50)
+
+    asyncio.run(run())
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+import os
+import argparse
+
+import numpy as np
+from sklearn.base import BaseEstimator, TransformerMixin
+
+
+def store_paths(glove_file):
+    """Paths of the binary matrix and vocabulary files for a GloVe text file."""
+    prefix = os.path.splitext(glove_file)[0]
+    return f"{prefix}.f32.npy", f"{prefix}.vocab.txt"
+
+
+def convert_glove(glove_file, embedding_dim):
+    """
+    One-time conversion of a GloVe text file into a contiguous float32 matrix (.npy)
+    and a vocabulary file with one word per line (the line number is the row in the matrix).
+    """
+    matrix_file, vocab_file = store_paths(glove_file)
+
+    # First pass: count the valid lines so that the matrix can be written straight to disk
+    n_words = 0
+    with open(glove_file, encoding="utf8") as f:
+        for line in f:
+            if len(line.rstrip().split(" ")) == embedding_dim + 1:
+                n_words += 1
+
+    # Second pass: fill the memory-mapped matrix and write the vocabulary
+    matrix = np.lib.format.open_memmap(f"{matrix_file}.tmp", mode="w+", dtype=np.float32,
+                                       shape=(n_words, embedding_dim))
+    row = 0
+    with open(glove_file, encoding="utf8") as f, open(f"{vocab_file}.tmp", "w", encoding="utf8") as vocab:
+        for line in f:
+            values = line.rstrip().split(" ")
+            if len(values) != embedding_dim + 1:
+                continue
+            vocab.write(values[0] + "\n")
+            matrix[row] = np.asarray(values[1:], dtype=np.float32)
+            row += 1
+    matrix.flush()
+    del matrix
+
+    # Rename at the end so that an interrupted conversion is never picked up
+    os.replace(f"{matrix_file}.tmp", matrix_file)
+    os.replace(f"{vocab_file}.tmp", vocab_file)
+    print(f"Converted {n_words:,} GloVe vectors to {matrix_file}")
+    return matrix_file, vocab_file
+
+
+def load_glove(glove_file, embedding_dim):
+    """Load (converting once if needed) the memory-mapped GloVe matrix and its word -> row index."""
+    matrix_file, vocab_file = store_paths(glove_file)
+    if not (os.path.exists(matrix_file) and os.path.exists(vocab_file)):
+        convert_glove(glove_file, embedding_dim)
+
+    # The matrix is memory-mapped read-only, so its pages are shared by every process using it
+    matrix = np.load(matrix_file, mmap_mode="r")
+    with open(vocab_file, encoding="utf8") as f:
+        words = f.read().split("\n")[:matrix.shape[0]]
+    # Later duplicates win, as in the original dict-based loader
+    word_index = {word: i for i, word in enumerate(words)}
+    return matrix, word_index
+
+
+class GloveVectorizer(BaseEstimator, TransformerMixin):
+    """
+    Loading pre-trained GloVe embeddings and returns the average embedding vector for each document.
+    """
+    def __init__(self, glove_file='glove.twitter.27B.50d.txt', embedding_dim=50):
+        self.glove_file = glove_file
+        self.embedding_dim = embedding_dim
+
+    def fit(self, X, y=None):
+        self.embeddings_, self.word_index_ = load_glove(self.glove_file, self.embedding_dim)
+        return self
+
+    def __getstate__(self):
+        # Do not copy the store when pickling (e.g. for GridSearchCV workers); it is re-mapped on use
+        state = self.__dict__.copy()
+        state.pop("embeddings_", None)
+        state.pop("word_index_", None)
+        return state
+
+    def transform(self, X):
+        if not hasattr(self, "embeddings_"):
+            self.embeddings_, self.word_index_ = load_glove(self.glove_file, self.embedding_dim)
+
+        # Since TextPreprocessor returns a space-separated string of tokens,
+        # we can simply split on spaces and map the tokens to row ids.
+        word_index = self.word_index_
+        ids = []
+        counts = []
+        for doc in X:
+            doc_ids = [word_index[token] for token in doc.split() if token in word_index]
+            ids.extend(doc_ids)
+            counts.append(len(doc_ids))
+        ids = np.asarray(ids, dtype=np.int64)
+        counts = np.asarray(counts, dtype=np.int64)
+
+        # Gather all token vectors at once and average each document's contiguous segment
+        vectors = np.zeros((len(counts), self.embedding_dim), dtype=np.float32)
+        non_empty = counts > 0
+        if non_empty.any():
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))[non_empty]
+            sums = np.add.reduceat(self.embeddings_[ids], starts, axis=0)
+            vectors[non_empty] = sums / counts[non_empty, None]
+        return vectors
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Convert a GloVe text file to a memory-mapped binary store')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Path to the GloVe text file')
+    parser.add_argument('-d', '--dim', type=int, default=50, help='Embedding dimension')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    convert_glove(args.file, args.dim)
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,9 @@ import pandas as pd
 import os
 import glob
 from streamlit_shortcuts import button, add_keyboard_shortcuts
+from tracing import span, traced
+from postContext import PostContextIndex, DEFAULT_INDEX_DIR
+from recordIndex import RecordIndex, fingerprint
 
 # Configure full screen width
 st.set_page_config(page_title="Data Labelling Application", layout="wide")
@@ -11,6 +14,7 @@ st.set_page_config(page_title="Data Labelling Application", layout="wide")
 PASSWORD = "f20aa5"
 FILE = ""  # default; will be overwritten in main()
 
+@traced("labeler.find_next_contradiction")
 def find_next_contradiction(df, current_index):
     """Find the next contradicting record after the given index."""
     def check_contradiction(row):
@@ -26,6 +30,7 @@ def find_next_contradiction(df, current_index):
                 return i
     return len(df) - 1  # If no more contradictions found
 
+@traced("labeler.update_label")
 def update_label(label):
     """Callback to update the manual label, advance the index, and write to CSV."""
     idx = st.session_state.index  # current record index
@@ -33,17 +38,27 @@ def update_label(label):
     label_map = {"Positive": 1, "Neutral": 0, "Negative": -1, "Irrelevant": 2}
     
     # Read the complete original file
-    full_df = pd.read_csv(FILE, engine='pyarrow')
+    with span("labeler.read_csv", bytes=os.path.getsize(FILE)) as s:
+        full_df = pd.read_csv(FILE, engine='pyarrow')
+        s.add(rows=len(full_df))
     # Update the specific row in the complete dataset
     full_df.at[original_idx, "m_label_1"] = label_map.get(label, "None")
     # Save the complete dataset
-    full_df.to_csv(FILE, index=False)
+    with span("labeler.write_csv", rows=len(full_df)) as s:
+        full_df.to_csv(FILE, index=False)
+        s.add(bytes=os.path.getsize(FILE))
     
     # Update the working dataset
     st.session_state.df.at[idx, "m_label_1"] = label_map.get(label, "None")
+    if "record_index" in st.session_state:
+        st.session_state.record_index.mark_labelled(idx)
     
-    # Move to next record based on mode
-    if st.session_state.current_mode == "Contradiction Resolution":
+    # Move to next record based on mode (or to the next search result)
+    results = st.session_state.get("results")
+    if results is not None:
+        next_idx = RecordIndex.next_position(results, idx)
+        st.session_state.index = next_idx if next_idx is not None else len(st.session_state.df)
+    elif st.session_state.current_mode == "Contradiction Resolution":
         next_idx = find_next_contradiction(st.session_state.df, idx)
         if next_idx >= len(st.session_state.df):
             st.success("All contradictions reviewed!")
@@ -51,6 +66,102 @@ def update_label(label):
     else:
         st.session_state.index = idx + 1 if idx + 1 < len(st.session_state.df) else len(st.session_state.df)
 
+@st.cache_resource(max_entries=4)
+def load_post_context(index_dir, modified):
+    """
+    Post-context index built by postContext.py or the pipeline's context stage (None if there is none).
+    Keyed by the modification time of posts.arrow, so posts added to the index are picked up on the next rerun.
+    """
+    if modified is None:
+        return None
+    return PostContextIndex(index_dir)
+
+def display_post_context(df, index):
+    """Show the title and body of the parent post when the current record is a comment."""
+    index_dir = st.session_state.get("post_context_dir", DEFAULT_INDEX_DIR)
+    posts_file = os.path.join(index_dir, "posts.arrow")
+    post_context = load_post_context(index_dir, os.stat(posts_file).st_mtime_ns if os.path.exists(posts_file) else None)
+    if post_context is None or index >= len(df) or "post_id" not in df.columns:
+        return
+    row = df.iloc[index]
+    if pd.isna(row.get("comment_id")) or pd.isna(row["post_id"]):
+        return
+    parent = post_context.context([row["post_id"]]).iloc[0]
+    if pd.isna(parent["title"]):
+        return
+    st.markdown("### Parent Post:")
+    st.markdown(f"**{parent['title']}**")
+    if parent["body"]:
+        st.text_area("Parent Post", value=str(parent["body"]), height=100, disabled=True)
+
+@st.cache_resource
+def load_record_index(df_fingerprint, _df):
+    """
+    Search indexes of the working frame (see recordIndex.py), keyed by the content of its indexed columns.
+    The fingerprint is taken when the frame is loaded, so labels written by this app (mirrored with
+    mark_labelled) keep the index, while a file edited elsewhere gets a new index once it is reloaded.
+    """
+    return RecordIndex(_df)
+
+def label_name(value):
+    """Display name of an automated label value of the record index."""
+    label_mapping = {1: "Positive", 0: "Neutral", -1: "Negative", 2: "Irrelevant"}
+    try:
+        return label_mapping.get(int(float(value)), value)
+    except ValueError:
+        return value
+
+def step_result(step):
+    """Callback to move to the previous (-1) or next (1) search result."""
+    results = st.session_state.get("results")
+    if results is None:
+        return
+    if step > 0:
+        position = RecordIndex.next_position(results, st.session_state.index)
+    else:
+        position = RecordIndex.previous_position(results, st.session_state.index)
+    if position is not None:
+        st.session_state.index = position
+
+def search_controls():
+    """Keyword, score-range, label, subreddit and unlabelled filters; the matching records drive navigation."""
+    record_index = load_record_index(st.session_state.df_fingerprint, st.session_state.df)
+    st.session_state.record_index = record_index
+
+    st.sidebar.markdown("### Search")
+    keywords = st.sidebar.text_input("Keywords (all must match)")
+    score_range = None
+    if record_index.sorted_scores is not None and len(record_index.sorted_scores):
+        # The slider spans the scores of the file
+        low, high = float(record_index.sorted_scores[0]), float(record_index.sorted_scores[-1])
+        if high > low and st.sidebar.checkbox("Filter by score"):
+            score_range = st.sidebar.slider("Score range", low, high, (low, high), step=(high - low) / 100)
+    labels = []
+    if "label_1" in record_index.categories:
+        labels = st.sidebar.multiselect("Automated label", record_index.categories["label_1"][0], format_func=label_name)
+    subreddits = []
+    if "subreddit" in record_index.categories:
+        subreddits = st.sidebar.multiselect("Subreddit", sorted(record_index.categories["subreddit"][0]))
+    unlabelled_only = st.sidebar.checkbox("Unlabelled only")
+
+    query = (keywords.strip(), score_range, tuple(labels), tuple(subreddits), unlabelled_only)
+    if not any(query):
+        st.session_state.results = None
+        st.session_state.query = query
+        return
+    results = record_index.query(keywords, score_range, labels, subreddits=subreddits, unlabelled_only=unlabelled_only)
+    st.session_state.results = results
+    st.sidebar.write(f"{len(results):,} matching records")
+    if query != st.session_state.get("query"):
+        # A new query starts at the first match from the current record
+        st.session_state.query = query
+        if len(results) and st.session_state.index not in results:
+            next_idx = RecordIndex.next_position(results, st.session_state.index - 1)
+            st.session_state.index = next_idx if next_idx is not None else int(results[0])
+    cols = st.sidebar.columns(2)
+    cols[0].button("◀ Previous match", on_click=step_result, args=(-1,), key="btn_previous_match")
+    cols[1].button("Next match ▶", on_click=step_result, args=(1,), key="btn_next_match")
+
 def sidebar_controls():
     global FILE
     # --- Sidebar: File Selection & Data Update ---
@@ -88,11 +199,15 @@ def sidebar_controls():
         if "m_label_1" not in df_new.columns:
             df_new["m_label_1"] = ""
         st.session_state.df = df_new.copy()
+        st.session_state.df_fingerprint = fingerprint(st.session_state.df)
         not_labelled = st.session_state.df.index[
             (st.session_state.df["m_label_1"].isna()) | (st.session_state.df["m_label_1"] == "")
         ]
         st.session_state.index = int(not_labelled[0]) if len(not_labelled) > 0 else 0
 
+    # --- Sidebar: Parent post context of comments ---
+    st.session_state.post_context_dir = st.sidebar.text_input("Post context index", value=DEFAULT_INDEX_DIR)
+
     # --- Sidebar: Title Toggle ---
     # if st.sidebar.checkbox("Show Title", value=True):
     st.title("Data Labelling Application")
@@ -133,6 +248,9 @@ def sidebar_controls():
         export_filename = os.path.basename(FILE)  # Get just the filename from the full path
         st.sidebar.download_button(label="Export CSV", data=csv_data, file_name=export_filename, mime="text/csv")
 
+    # --- Sidebar: Indexed search ---
+    search_controls()
+
     # --- Sidebar: Jump-to-Record Control (1-indexed) ---
     total_records = len(st.session_state.df)
     jump = st.sidebar.number_input(
@@ -218,6 +336,7 @@ def display_full_labeling():
     # --- Grid Layout: Left (Text Areas) & Right (Labels) ---
     col_left, col_right = st.columns(2)
     with col_left:
+        display_post_context(df, index)
         if "Cleaned Text" in df.columns:
             st.markdown("### Cleaned Text:")
             st.text_area("Cleaned Text", value=str(df.iloc[index]["Cleaned Text"]), height=150, disabled=True)
@@ -309,6 +428,8 @@ def display_contradiction_resolution():
     col_left, col_right = st.columns(2)
     
     with col_left:
+        display_post_context(df, index)
+
         # Display Cleaned Text
         st.markdown("### Cleaned Text:")
         cleaned_text = str(df.iloc[index].get("Cleaned Text", "Field not available"))
@@ -430,6 +551,7 @@ def main():
         df["m_label_1"] = ""
     if "df" not in st.session_state:
         st.session_state.df = df.copy()
+        st.session_state.df_fingerprint = fingerprint(st.session_state.df)
         not_labelled = st.session_state.df.index[(st.session_state.df["m_label_1"].isna()) | (st.session_state.df["m_label_1"] == "")]
         st.session_state.index = int(not_labelled[0]) if len(not_labelled) > 0 else 0
 
@@ -0,0 +1,207 @@
+import os
+import time
+import inspect
+import hashlib
+
+import joblib
+import numpy as np
+import pandas as pd
+from joblib import Memory
+from sklearn.base import clone
+from sklearn.pipeline import Pipeline
+from sklearn.model_selection import GridSearchCV, ParameterGrid, cross_val_score, cross_val_predict
+
+from textCleaner import CLEANER_VERSION
+
+# Default location of the preprocessing and vectorizer caches (relative to the working directory)
+DEFAULT_CACHE_DIR = os.path.join(".cache", "model_search")
+
+PREPROCESSOR_STEP = "preprocessor"
+
+
+def _bytecode(code):
+    """Bytecode and constants of a code object, recursing into nested functions and comprehensions."""
+    consts = [_bytecode(const) if inspect.iscode(const) else repr(const) for const in code.co_consts]
+    return f"{code.co_code.hex()}:{code.co_names}:{consts}"
+
+
+def _code_fingerprint(cls):
+    """
+    Source of the methods and the plain class attributes of a preprocessor class and its bases.
+
+    Classes defined in a notebook have no source file, so a method whose source cannot be found
+    is fingerprinted by its bytecode and constants instead.
+    """
+    parts = []
+    for klass in cls.__mro__:
+        if klass.__module__.split(".")[0] in ("builtins", "sklearn"):
+            continue
+        parts.append(klass.__qualname__)
+        for name, value in sorted(vars(klass).items()):
+            if inspect.isfunction(value):
+                # sklearn wraps transform methods (set_output), the wrapped method is the preprocessor's code
+                value = inspect.unwrap(value)
+                try:
+                    parts.append(inspect.getsource(value))
+                except (OSError, TypeError):
+                    parts.append(f"{name}:{_bytecode(value.__code__)}")
+            elif not name.startswith("_") and not callable(value):
+                # e.g. TextPreprocessorNoPunct only overrides remove_punctuation
+                parts.append(f"{name}={value!r}")
+    return "\n".join(parts)
+
+
+def _preprocessor_key(preprocessor, X):
+    """Hash of the preprocessor code, its parameters, the text cleaner version and the input texts."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{CLEANER_VERSION}|".encode())
+    hasher.update(_code_fingerprint(type(preprocessor)).encode())
+    hasher.update(repr(sorted(preprocessor.get_params(deep=False).items())).encode())
+    hasher.update(pd.util.hash_pandas_object(pd.Series(X), index=True).values.tobytes())
+    return hasher.hexdigest()
+
+
+def cached_preprocess(preprocessor, X, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Run a (stateless) text preprocessor once and cache its output on disk.
+
+    TextPreprocessor.fit does nothing, so its output for a document does not depend on the fold;
+    preprocessing the whole training set once is identical to preprocessing every fold separately.
+    """
+    cache_file = None
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_file = os.path.join(cache_dir, f"preprocessed_{_preprocessor_key(preprocessor, X)}.pkl")
+        if os.path.exists(cache_file):
+            return joblib.load(cache_file)
+
+    X_preprocessed = clone(preprocessor).fit(X).transform(X)
+
+    if cache_file:
+        joblib.dump(X_preprocessed, cache_file)
+    return X_preprocessed
+
+
+def _split_pipeline(pipeline, cache_dir):
+    """Split a pipeline into its preprocessor and the remaining steps (with a vectorizer cache)."""
+    if pipeline.steps[0][0] != PREPROCESSOR_STEP:
+        raise ValueError(f"The first pipeline step must be named '{PREPROCESSOR_STEP}'.")
+    preprocessor = pipeline.steps[0][1]
+    # Pipeline(memory=...) caches the fitted vectorizer (and SVD) for each fold and parameter set
+    memory = Memory(os.path.join(cache_dir, "pipeline"), verbose=0) if cache_dir else None
+    # type(pipeline) keeps imblearn pipelines (with samplers) as imblearn pipelines
+    rest = type(pipeline)(pipeline.steps[1:], memory=memory)
+    return preprocessor, rest
+
+
+def _split_grid(param_grid):
+    """Split each grid into (preprocessor parameters, remaining parameters)."""
+    grids = param_grid if isinstance(param_grid, list) else [param_grid]
+    prefix = PREPROCESSOR_STEP + "__"
+    for grid in grids:
+        prep_grid = {key[len(prefix):]: values for key, values in grid.items() if key.startswith(prefix)}
+        rest_grid = {key: values for key, values in grid.items() if not key.startswith(prefix)}
+        yield prep_grid, rest_grid
+
+
+class CachedGridSearch:
+    """
+    Drop-in replacement for GridSearchCV over Pipeline([preprocessor, vectorizer, (svd), classifier]).
+
+    - The preprocessor runs once per preprocessor parameter set (not once per fold and candidate),
+      and its output is cached on disk, so re-running a notebook does not re-clean or re-tokenize.
+    - The vectorizer/SVD outputs are cached per fold with Pipeline(memory=...).
+    - Candidates are evaluated in parallel with joblib (n_jobs=-1 uses all CPUs).
+    - timings_ reports the time spent in each stage.
+    """
+
+    def __init__(self, pipeline, param_grid, cv=5, scoring='f1_weighted', n_jobs=-1, verbose=0,
+                 cache_dir=DEFAULT_CACHE_DIR):
+        self.pipeline = pipeline
+        self.param_grid = param_grid
+        self.cv = cv
+        self.scoring = scoring
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        self.cache_dir = cache_dir
+
+    def fit(self, X, y):
+        preprocessor, rest = _split_pipeline(self.pipeline, self.cache_dir)
+        self.timings_ = {"preprocessing": 0.0, "search": 0.0, "refit": 0.0}
+        results = []
+        best = None
+
+        for prep_grid, rest_grid in _split_grid(self.param_grid):
+            for prep_params in ParameterGrid(prep_grid):
+                # 1. Preprocess the whole training set once (cached on disk)
+                start = time.perf_counter()
+                prep = clone(preprocessor).set_params(**prep_params)
+                X_preprocessed = cached_preprocess(prep, X, self.cache_dir)
+                self.timings_["preprocessing"] += time.perf_counter() - start
+
+                # 2. Search the remaining steps in parallel
+                start = time.perf_counter()
+                search = GridSearchCV(rest, rest_grid, cv=self.cv, scoring=self.scoring,
+                                      n_jobs=self.n_jobs, verbose=self.verbose, refit=False)
+                search.fit(X_preprocessed, y)
+                self.timings_["search"] += time.perf_counter() - start
+
+                cv_results = pd.DataFrame(search.cv_results_)
+                cv_results["params"] = [
+                    {**{f"{PREPROCESSOR_STEP}__{key}": value for key, value in prep_params.items()}, **params}
+                    for params in cv_results["params"]
+                ]
+                results.append(cv_results)
+
+                best_index = search.cv_results_["rank_test_score"].argmin()
+                score = search.cv_results_["mean_test_score"][best_index]
+                if best is None or score > best[0]:
+                    best = (score, prep, X_preprocessed, search.cv_results_["params"][best_index], prep_params)
+
+        self.cv_results_ = pd.concat(results, ignore_index=True)
+        self.best_score_, prep, X_preprocessed, rest_params, prep_params = best
+        self.best_params_ = {
+            **{f"{PREPROCESSOR_STEP}__{key}": value for key, value in prep_params.items()},
+            **rest_params
+        }
+
+        # 3. Refit the best candidate on the whole (already preprocessed) training set
+        start = time.perf_counter()
+        best_rest = clone(rest).set_params(**rest_params)
+        best_rest.set_params(memory=None)
+        best_rest.fit(X_preprocessed, y)
+        self.best_estimator_ = Pipeline([(PREPROCESSOR_STEP, prep), ("model", best_rest)])
+        self.timings_["refit"] = time.perf_counter() - start
+
+        self.timings_["mean_fit_per_candidate"] = float(self.cv_results_["mean_fit_time"].mean())
+        self.timings_["mean_score_per_candidate"] = float(self.cv_results_["mean_score_time"].mean())
+        self.print_timings()
+        return self
+
+    def predict(self, X):
+        return self.best_estimator_.predict(X)
+
+    def print_timings(self):
+        """Print the time spent in each stage of the search."""
+        print("=" * 50)
+        print(f"Candidates evaluated: {len(self.cv_results_)}")
+        print(f"Preprocessing:  {self.timings_['preprocessing']:.2f}s")
+        print(f"Search:         {self.timings_['search']:.2f}s")
+        print(f"Refit:          {self.timings_['refit']:.2f}s")
+        print(f"Mean fit time per candidate/fold:   {self.timings_['mean_fit_per_candidate']:.3f}s")
+        print(f"Mean score time per candidate/fold: {self.timings_['mean_score_per_candidate']:.3f}s")
+        print("=" * 50)
+
+
+def cached_cross_val_score(pipeline, X, y, cv=10, scoring='f1_weighted', n_jobs=-1, cache_dir=DEFAULT_CACHE_DIR):
+    """cross_val_score with the preprocessor run once (and cached) and folds evaluated in parallel."""
+    preprocessor, rest = _split_pipeline(pipeline, cache_dir)
+    X_preprocessed = cached_preprocess(preprocessor, X, cache_dir)
+    return np.asarray(cross_val_score(rest, X_preprocessed, y, cv=cv, scoring=scoring, n_jobs=n_jobs))
+
+
+def cached_cross_val_predict(pipeline, X, y, cv=10, n_jobs=-1, cache_dir=DEFAULT_CACHE_DIR):
+    """cross_val_predict with the preprocessor run once (and cached) and folds evaluated in parallel."""
+    preprocessor, rest = _split_pipeline(pipeline, cache_dir)
+    X_preprocessed = cached_preprocess(preprocessor, X, cache_dir)
+    return cross_val_predict(rest, X_preprocessed, y, cv=cv, n_jobs=n_jobs)
@@ -0,0 +1,314 @@
+import os
+import re
+import json
+import time
+import zlib
+import argparse
+from collections import deque
+from functools import lru_cache
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from tracing import span
+
+# Near-duplicates are records whose shingle sets have an (estimated) Jaccard similarity above this
+DEFAULT_THRESHOLD = 0.8
+
+# MinHash signature length, split into bands of NUM_PERM / BANDS rows for LSH.
+# 16 bands of 8 rows make records with Jaccard ~0.7 or more collide in at least one band
+NUM_PERM = 128
+BANDS = 16
+
+# Words per shingle (texts shorter than this are a single shingle)
+SHINGLE_SIZE = 3
+
+# Prime just above 2**32 for the universal hash functions h(x) = (a * x + b) % PRIME
+PRIME = 4294967311
+MAX_HASH = 0xFFFFFFFF
+
+# Shingle hashes hashed at once by one vectorised step (bounds the (shingles, NUM_PERM) matrix to ~32 MB)
+SHINGLE_BLOCK = 32768
+
+# Rough number of characters per model token, to estimate the inference volume saved
+CHARS_PER_TOKEN = 4
+
+TOKEN_RE = re.compile(r"\w+")
+
+
+# ---- MinHash signatures
+
+def shingle_hashes(text, shingle_size=SHINGLE_SIZE):
+    """32-bit hashes of the distinct word shingles of a text (lowercased, punctuation ignored)."""
+    tokens = TOKEN_RE.findall(text.lower()) if isinstance(text, str) else []
+    if not tokens:
+        return np.empty(0, dtype=np.uint64)
+    shingles = {" ".join(tokens[i:i + shingle_size]) for i in range(max(len(tokens) - shingle_size + 1, 1))}
+    return np.fromiter((zlib.crc32(shingle.encode()) for shingle in shingles), dtype=np.uint64, count=len(shingles))
+
+
+@lru_cache(maxsize=None)
+def permutations(num_perm=NUM_PERM, seed=1):
+    """Parameters (a, b) of the num_perm hash functions (identical in every process for a seed)."""
+    rng = np.random.RandomState(seed)
+    # a < 2**32 keeps a * x + b below 2**64 for 32-bit x
+    a = rng.randint(1, MAX_HASH, size=num_perm, dtype=np.uint64)
+    b = rng.randint(0, MAX_HASH, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(texts, num_perm=NUM_PERM, shingle_size=SHINGLE_SIZE, seed=1):
+    """
+    MinHash signatures of a list of texts, as a (len(texts), num_perm) uint32 array.
+
+    The shingle hashes of all the texts are permuted in blocks of SHINGLE_BLOCK and reduced
+    per text with np.minimum.reduceat. Texts without words get an all-MAX_HASH signature.
+    """
+    a, b = permutations(num_perm, seed)
+    hashes = [shingle_hashes(text, shingle_size) for text in texts]
+    signatures = np.full((len(texts), num_perm), MAX_HASH, dtype=np.uint32)
+
+    lengths = np.fromiter((len(h) for h in hashes), dtype=np.int64, count=len(hashes))
+    rows = np.flatnonzero(lengths)
+    ends = np.cumsum(lengths[rows])
+    start = 0
+    while start < len(rows):
+        # Texts [start, stop) are permuted together; a single text longer than a block is still one step
+        stop = max(int(np.searchsorted(ends, ends[start] - lengths[rows[start]] + SHINGLE_BLOCK, side="right")),
+                   start + 1)
+        block = np.concatenate([hashes[row] for row in rows[start:stop]])
+        permuted = (block[:, None] * a + b) % PRIME & MAX_HASH
+        offsets = np.concatenate([[0], np.cumsum(lengths[rows[start:stop]])[:-1]])
+        signatures[rows[start:stop]] = np.minimum.reduceat(permuted, offsets, axis=0)
+        start = stop
+    return signatures
+
+
+def band_keys(signatures, bands=BANDS):
+    """One 64-bit key per (record, band): a hash of the band's rows of the signature."""
+    rows = signatures.shape[1] // bands
+    banded = signatures[:, :bands * rows].reshape(len(signatures), bands, rows).astype(np.uint64)
+    multipliers = permutations(rows, seed=bands)[0] | np.uint64(1)
+    # Arithmetic wraps around modulo 2**64, which is fine for a hash
+    return (banded * multipliers).sum(axis=2, dtype=np.uint64)
+
+
+def _signature_chunk(args):
+    """Worker: signatures, band keys and emptiness of one chunk of texts."""
+    texts, num_perm, bands, shingle_size, seed = args
+    signatures = minhash_signatures(texts, num_perm, shingle_size, seed)
+    empty = (signatures == MAX_HASH).all(axis=1)
+    return signatures, band_keys(signatures, bands), empty
+
+
+# ---- LSH index
+
+class LshIndex:
+    """
+    Banded MinHash LSH index that assigns every record to a cluster as it is added.
+
+    Only cluster representatives (the first record of each cluster) are indexed, so memory grows
+    with the number of distinct records rather than the number of rows. A record joins the most
+    similar representative sharing a band with it whose estimated Jaccard similarity reaches the
+    threshold; otherwise it becomes the representative of a new cluster.
+
+    Parameters:
+    - num_perm: Signature length
+    - bands: Number of LSH bands
+    - threshold: Minimum estimated Jaccard similarity with the representative
+    """
+
+    def __init__(self, num_perm=NUM_PERM, bands=BANDS, threshold=DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self.buckets = [{} for _ in range(bands)]
+        self.signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self.representatives = []
+
+    def add(self, signatures, keys, empty, first_row):
+        """Assign rows first_row, first_row + 1, ... and return the row of their representatives."""
+        assigned = np.arange(first_row, first_row + len(signatures), dtype=np.int64)
+        for i in np.flatnonzero(~empty):
+            candidates = set()
+            for bucket, key in zip(self.buckets, keys[i].tolist()):
+                candidates.update(bucket.get(key, ()))
+            if candidates:
+                candidates = sorted(candidates)
+                similarity = (self.signatures[candidates] == signatures[i]).mean(axis=1)
+                best = int(np.argmax(similarity))
+                if similarity[best] >= self.threshold:
+                    assigned[i] = self.representatives[candidates[best]]
+                    continue
+            self._insert(signatures[i], keys[i].tolist(), first_row + i)
+        return assigned
+
+    def _insert(self, signature, keys, row):
+        slot = len(self.representatives)
+        if slot == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.empty_like(self.signatures)])
+        self.signatures[slot] = signature
+        self.representatives.append(row)
+        for bucket, key in zip(self.buckets, keys):
+            bucket.setdefault(key, []).append(slot)
+
+
+# ---- Streaming input/output
+
+def read_column_chunks(input_file, column, chunksize):
+    """Stream one column of a Parquet or CSV file as lists of values."""
+    if input_file.endswith(".parquet"):
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunksize, columns=[column]):
+            yield batch.column(0).to_pylist()
+    else:
+        for chunk in pd.read_csv(input_file, usecols=[column], dtype=str, chunksize=chunksize):
+            yield chunk[column].tolist()
+
+
+def read_chunks(input_file, chunksize):
+    """Stream every column of a Parquet or CSV file as DataFrames."""
+    if input_file.endswith(".parquet"):
+        for batch in pq.ParquetFile(input_file).iter_batches(batch_size=chunksize):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(input_file, dtype=str, chunksize=chunksize)
+
+
+def find_clusters(input_file, text_column="text", threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM, bands=BANDS,
+                  shingle_size=SHINGLE_SIZE, chunksize=20000, n_jobs=None, seed=1):
+    """
+    Pass 1: the representative row of every row of input_file (rows are numbered from 0).
+
+    Signatures are computed in worker processes, a few chunks ahead of the index, and the chunks are
+    added to the index in file order, so the first occurrence of a cluster is always its representative.
+    """
+    index = LshIndex(num_perm, bands, threshold)
+    assigned = []
+    rows = 0
+
+    def add(result):
+        nonlocal rows
+        with span("dedup.index", rows=len(result[0])):
+            assigned.append(index.add(*result, first_row=rows))
+        rows += len(result[0])
+
+    tasks = ((texts, num_perm, bands, shingle_size, seed) for texts in read_column_chunks(input_file, text_column, chunksize))
+    if n_jobs == 1:
+        for task in tasks:
+            with span("dedup.signatures", rows=len(task[0])):
+                add(_signature_chunk(task))
+    else:
+        n_jobs = n_jobs or os.cpu_count()
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            # Keep a bounded number of chunks in flight so that memory does not grow with the file
+            window = deque()
+            for task in tasks:
+                window.append(executor.submit(_signature_chunk, task))
+                if len(window) > 2 * n_jobs:
+                    add(window.popleft().result())
+            while window:
+                add(window.popleft().result())
+
+    return np.concatenate(assigned) if assigned else np.empty(0, dtype=np.int64)
+
+
+def deduplicate(input_file, output_file, text_column="text", threshold=DEFAULT_THRESHOLD, num_perm=NUM_PERM,
+                bands=BANDS, shingle_size=SHINGLE_SIZE, chunksize=20000, n_jobs=None, seed=1):
+    """
+    Keep one representative per near-duplicate cluster, in two streaming passes.
+
+    Pass 1 clusters the rows with MinHash LSH over word shingles of text_column, pass 2 writes the
+    representatives with "cluster_id" (row of the representative in the input) and "cluster_size"
+    (number of rows of the cluster) columns. A report of the rows and estimated tokens that no
+    longer need to be embedded or labelled is printed and saved next to the output.
+    """
+    print("=" * 50)
+    print(f"Finding near-duplicates in {input_file} (threshold {threshold})")
+    start_time = time.perf_counter()
+    representatives = find_clusters(input_file, text_column, threshold, num_perm, bands, shingle_size,
+                                    chunksize, n_jobs, seed)
+    cluster_sizes = np.bincount(representatives, minlength=len(representatives))
+
+    # ---- Pass 2: write the representatives
+    writer = None
+    row = 0
+    chars_in = chars_kept = 0
+    if os.path.exists(output_file):
+        os.remove(output_file)
+
+    for chunk in read_chunks(input_file, chunksize):
+        rows = np.arange(row, row + len(chunk))
+        row += len(chunk)
+        lengths = chunk[text_column].fillna("").astype(str).str.len().to_numpy()
+        keep = representatives[rows] == rows
+        chars_in += int(lengths.sum())
+        chars_kept += int(lengths[keep].sum())
+
+        kept = chunk[keep].assign(cluster_id=rows[keep], cluster_size=cluster_sizes[rows[keep]])
+        if kept.empty:
+            continue
+        with span("dedup.write", rows=len(kept)):
+            if output_file.endswith(".parquet"):
+                table = pa.Table.from_pandas(kept, preserve_index=False)
+                if writer is None:
+                    writer = pq.ParquetWriter(output_file, table.schema)
+                writer.write_table(table.cast(writer.schema))
+            else:
+                kept.to_csv(output_file, mode="a", header=not os.path.exists(output_file), index=False)
+
+    if writer is not None:
+        writer.close()
+
+    kept_rows = int((representatives == np.arange(len(representatives))).sum())
+    report = {
+        "input_file": input_file,
+        "output_file": output_file,
+        "threshold": threshold,
+        "rows_in": len(representatives),
+        "rows_kept": kept_rows,
+        "rows_removed": len(representatives) - kept_rows,
+        "removed_fraction": (len(representatives) - kept_rows) / max(len(representatives), 1),
+        "duplicate_clusters": int((cluster_sizes > 1).sum()),
+        "largest_cluster": int(cluster_sizes.max()) if len(cluster_sizes) else 0,
+        "chars_in": chars_in,
+        "chars_saved": chars_in - chars_kept,
+        "tokens_saved_estimate": (chars_in - chars_kept) // CHARS_PER_TOKEN,
+        "seconds": time.perf_counter() - start_time,
+    }
+    report_file = f"{os.path.splitext(output_file)[0]}_dedup_report.json"
+    with open(report_file, "w") as f:
+        json.dump(report, f, indent=2)
+
+    print(f"Rows kept: {report['rows_kept']:,} of {report['rows_in']:,} "
+          f"({report['rows_removed']:,} near-duplicates, {report['removed_fraction']:.1%})")
+    print(f"Clusters with duplicates: {report['duplicate_clusters']:,} (largest: {report['largest_cluster']:,} rows)")
+    print(f"Inference volume saved: {report['rows_removed']:,} records, ~{report['tokens_saved_estimate']:,} tokens")
+    print(f"Deduplicated data saved to {output_file}")
+    print("=" * 50)
+    return report
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Remove near-duplicate records (copypasta, reposts, quoted replies) with MinHash LSH')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Input file (.parquet or CSV)')
+    parser.add_argument('-o', '--output', type=str, default='deduplicated_data.parquet',
+                        help='Output file (.parquet for typed output, otherwise CSV)')
+    parser.add_argument('-c', '--column', type=str, default='text', help='Column containing the text')
+    parser.add_argument('-t', '--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help='Minimum estimated Jaccard similarity of near-duplicates')
+    parser.add_argument('--num-perm', type=int, default=NUM_PERM, help='MinHash signature length')
+    parser.add_argument('--bands', type=int, default=BANDS, help='Number of LSH bands')
+    parser.add_argument('--shingle-size', type=int, default=SHINGLE_SIZE, help='Words per shingle')
+    parser.add_argument('--chunksize', type=int, default=20000, help='Rows per chunk')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    deduplicate(args.file, args.output, text_column=args.column, threshold=args.threshold, num_perm=args.num_perm,
+                bands=args.bands, shingle_size=args.shingle_size, chunksize=args.chunksize, n_jobs=args.jobs)
+
+if __name__ == "__main__":
+    main()
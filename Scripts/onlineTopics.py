@@ -0,0 +1,270 @@
+import os
+import argparse
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import joblib
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.decomposition import LatentDirichletAllocation
+from sklearn.feature_extraction.text import CountVectorizer, HashingVectorizer
+from sklearn.utils import murmurhash3_32
+
+# Default location of the persisted topic models (relative to the working directory)
+DEFAULT_STATE_DIR = os.path.join(".cache", "topic_models")
+
+# Parameters fixed when a model is created (they define its vocabulary and topics): a persisted model
+# cannot be loaded with different values
+MODEL_PARAMS = ["n_components", "max_features", "max_df", "stop_words", "n_hash_features", "random_state"]
+
+# Parameters of the online updates only: a persisted model takes the new values
+UPDATE_PARAMS = ["batch_size", "total_samples"]
+
+
+def _identity(tokens):
+    """Analyzer for texts that are already lists of tokens."""
+    return tokens
+
+
+def document_keys(texts, ids=None):
+    """
+    64-bit key of every document: the hash of its id, or of its text and occurrence number, so that
+    repeated texts count separately and the documents of a grown input keep their keys.
+    """
+    if ids is not None:
+        return pd.util.hash_pandas_object(pd.Series(list(ids), dtype="string"), index=False).to_numpy(dtype=np.uint64)
+    texts = pd.Series(list(texts), dtype="string").fillna("")
+    documents = pd.DataFrame({"text": texts, "occurrence": texts.groupby(texts).cumcount()})
+    return pd.util.hash_pandas_object(documents, index=False).to_numpy(dtype=np.uint64)
+
+
+class OnlineTopicModel:
+    """
+    Online LDA over a fixed vocabulary, updated with partial_fit on mini-batches.
+
+    The vocabulary (max_features most frequent terms below max_df) is fixed on the first batch,
+    so the topic-word matrix keeps its shape as new batches arrive. Terms outside the vocabulary
+    are not dropped: they are hashed into n_hash_features extra buckets, each named after the most
+    frequent term seen in it. The model (vocabulary, LDA state and keys of the ingested documents) is
+    saved with joblib, so new comments only cost a partial_fit instead of a full refit.
+
+    Parameters:
+    - n_components: Number of topics
+    - max_features, max_df, stop_words: Vocabulary settings, as in CountVectorizer
+    - n_hash_features: Number of buckets for out-of-vocabulary terms (0 disables the fallback)
+    - batch_size: Number of documents per mini-batch
+    - total_samples: Expected corpus size, used by online LDA to weight each mini-batch
+    - random_state: Random seed of the LDA model
+    """
+
+    def __init__(self, n_components=10, max_features=10000, max_df=0.2, stop_words="english",
+                 n_hash_features=2 ** 12, batch_size=1024, total_samples=1e6, random_state=0):
+        self.n_components = n_components
+        self.max_features = max_features
+        self.max_df = max_df
+        self.stop_words = stop_words
+        self.n_hash_features = n_hash_features
+        self.batch_size = batch_size
+        self.total_samples = total_samples
+        self.random_state = random_state
+
+        self.analyzer = CountVectorizer(stop_words=stop_words).build_analyzer()
+        self.vocabulary_ = None
+        self.lda_ = LatentDirichletAllocation(n_components=n_components, learning_method="online",
+                                              batch_size=batch_size, total_samples=total_samples,
+                                              random_state=random_state)
+        self.bucket_terms_ = np.full(n_hash_features, "", dtype=object)
+        self.bucket_counts_ = np.zeros(n_hash_features, dtype=np.int64)
+        self.document_keys_ = np.empty(0, dtype=np.uint64)
+        self.n_documents_ = 0
+
+    def fit_vocabulary(self, texts):
+        """
+        Fix the vocabulary from a sample of texts (called automatically on the first batch).
+        When max_df prunes every term, which happens on small first batches, max_df is not applied.
+        """
+        vectorizer = CountVectorizer(max_features=self.max_features, max_df=self.max_df, stop_words=self.stop_words)
+        try:
+            vectorizer.fit(texts)
+        except ValueError:
+            # Raised when no term is left after pruning (or the texts have no terms at all, which the
+            # refit reports again)
+            vectorizer = CountVectorizer(max_features=self.max_features, stop_words=self.stop_words)
+            vectorizer.fit(texts)
+            print(f"Every term is in more than max_df={self.max_df} of the {len(texts):,} documents: "
+                  "the vocabulary is fixed without max_df")
+        self.vocabulary_ = {term: i for i, term in enumerate(vectorizer.get_feature_names_out())}
+        return self
+
+    def _bucket(self, term):
+        # Same bucket as HashingVectorizer(alternate_sign=False)
+        return abs(murmurhash3_32(term, seed=0)) % self.n_hash_features
+
+    def _update_bucket_terms(self, oov_tokens):
+        """Name each hash bucket after the most frequent out-of-vocabulary term seen in it."""
+        for term, count in Counter(token for doc in oov_tokens for token in doc).items():
+            bucket = self._bucket(term)
+            if self.bucket_terms_[bucket] == term:
+                self.bucket_counts_[bucket] += count
+            elif count > self.bucket_counts_[bucket]:
+                self.bucket_terms_[bucket] = term
+                self.bucket_counts_[bucket] = count
+
+    def vectorize(self, texts, update_buckets=False):
+        """Document-term counts: vocabulary terms followed by the hashed out-of-vocabulary buckets."""
+        if self.vocabulary_ is None:
+            self.fit_vocabulary(texts)
+        tokens = [self.analyzer(text) for text in texts]
+        X = CountVectorizer(analyzer=_identity, vocabulary=self.vocabulary_).transform(tokens)
+        if not self.n_hash_features:
+            return X
+
+        vocabulary = self.vocabulary_
+        oov_tokens = [[token for token in doc if token not in vocabulary] for doc in tokens]
+        if update_buckets:
+            self._update_bucket_terms(oov_tokens)
+        hashed = HashingVectorizer(analyzer=_identity, n_features=self.n_hash_features,
+                                   alternate_sign=False, norm=None).transform(oov_tokens)
+        return sp.hstack([X, hashed], format="csr")
+
+    def partial_fit(self, texts):
+        """Update the topics with one mini-batch of texts."""
+        X = self.vectorize(texts, update_buckets=True)
+        self.lda_.partial_fit(X)
+        return self
+
+    def fit_stream(self, texts, passes=1, state_file=None, ids=None):
+        """
+        Update the model with mini-batches of the documents it has not ingested yet (optionally several
+        passes over them). Documents are identified by ids (e.g. comment ids) or, without ids, by their
+        text and occurrence number, so re-running on a grown input only fits the new documents.
+        """
+        texts = list(texts)
+        keys = document_keys(texts, ids)
+        new = ~np.isin(keys, self.document_keys_) & ~pd.Series(keys).duplicated().to_numpy()
+        texts = [text for text, is_new in zip(texts, new) if is_new]
+        if texts and self.vocabulary_ is None:
+            self.fit_vocabulary(texts)
+
+        for _ in range(passes):
+            for start in range(0, len(texts), self.batch_size):
+                self.partial_fit(texts[start:start + self.batch_size])
+        self.document_keys_ = np.union1d(self.document_keys_, keys[new])
+        self.n_documents_ += len(texts)
+
+        if state_file:
+            self.save(state_file)
+        return self
+
+    def transform(self, texts):
+        """Topic distribution of each text."""
+        return self.lda_.transform(self.vectorize(texts))
+
+    @property
+    def components_(self):
+        return self.lda_.components_
+
+    def get_feature_names_out(self):
+        """Vocabulary terms followed by the names of the hash buckets (so the model can be used as a vectorizer)."""
+        names = sorted(self.vocabulary_, key=self.vocabulary_.get)
+        buckets = [term or f"<oov_{i}>" for i, term in enumerate(self.bucket_terms_)]
+        return np.array(names + buckets, dtype=object)
+
+    def top_words(self, n_words=20):
+        """The n_words highest-weighted terms of each topic."""
+        feature_names = self.get_feature_names_out()
+        sorting = np.argsort(self.components_, axis=1)[:, ::-1][:, :n_words]
+        return [list(feature_names[topic]) for topic in sorting]
+
+    def save(self, state_file):
+        folder = os.path.dirname(state_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # Write to a temporary file first so that an interrupted save never corrupts the state
+        joblib.dump(self, f"{state_file}.tmp")
+        os.replace(f"{state_file}.tmp", state_file)
+
+
+def load_model(state_file, **params):
+    """
+    Load a persisted topic model, or create a new one with the given parameters.
+    A persisted model takes the given batch_size and total_samples, and raises a ValueError when one of
+    its MODEL_PARAMS differs (delete the state file or use another state folder to train a new model).
+    """
+    if not (state_file and os.path.exists(state_file)):
+        return OnlineTopicModel(**params)
+
+    model = joblib.load(state_file)
+    changed = [f"{name}={getattr(model, name)!r} (requested {params[name]!r})"
+               for name in MODEL_PARAMS if name in params and getattr(model, name) != params[name]]
+    if changed:
+        raise ValueError(f"The topic model in {state_file} was created with {', '.join(changed)}. "
+                         "Delete it or use another state folder to train a new model.")
+    for name in UPDATE_PARAMS:
+        if name in params:
+            setattr(model, name, params[name])
+            setattr(model.lda_, name, params[name])
+    return model
+
+
+def _fit_slice(state_file, texts, passes, ids, params):
+    """Worker: load (or create) the model of one slice, update it and persist it."""
+    model = load_model(state_file, **params)
+    return model.fit_stream(texts, passes=passes, state_file=state_file, ids=ids)
+
+
+def fit_slices(slices, state_dir=DEFAULT_STATE_DIR, passes=1, n_jobs=None, ids=None, **params):
+    """
+    Update one topic model per slice (e.g. {"positive": texts, "negative": texts}) in parallel processes.
+    ids optionally gives the document ids of each slice (same keys as slices).
+    Each model is persisted as <state_dir>/<name>.joblib and returned in a dict keyed by slice name.
+    """
+    n_jobs = n_jobs or min(len(slices), os.cpu_count() or 1)
+    ids = ids or {}
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = {
+            name: executor.submit(_fit_slice, os.path.join(state_dir, f"{name}.joblib"), list(texts), passes,
+                                  None if ids.get(name) is None else list(ids[name]), params)
+            for name, texts in slices.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Update the per-sentiment online LDA topic models with labelled data')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Labelled CSV file')
+    parser.add_argument('-c', '--column', type=str, default='Cleaned_Text', help='Column holding the cleaned text')
+    parser.add_argument('-s', '--state-dir', type=str, default=DEFAULT_STATE_DIR, help='Folder of the persisted models')
+    parser.add_argument('-n', '--n-topics', type=int, default=10, help='Number of topics')
+    parser.add_argument('-p', '--passes', type=int, default=1, help='Passes over the new data')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    df = pd.read_csv(args.file)
+    if args.column not in df:
+        from textCleaner import clean_series
+        df[args.column] = clean_series(df['text'].fillna(''))
+    df = df[df[args.column].notna()]
+    # Documents are identified by their post and comment ids when the file has them
+    record_ids = None
+    if {'post_id', 'comment_id'} <= set(df.columns):
+        record_ids = df['post_id'].astype(str) + "_" + df['comment_id'].astype(str)
+    slices, ids = {}, {}
+    for name, label in [("positive", 1), ("negative", -1)]:
+        mask = df['label'] == label
+        slices[name] = df.loc[mask, args.column]
+        ids[name] = None if record_ids is None else record_ids[mask]
+    models = fit_slices(slices, args.state_dir, passes=args.passes, ids=ids, n_components=args.n_topics)
+
+    for name, model in models.items():
+        print("=" * 50)
+        print(f"{name.capitalize()} topics ({model.n_documents_:,} documents seen)")
+        for topic_idx, words in enumerate(model.top_words(10)):
+            print(f"Topic {topic_idx + 1}: {' '.join(words)}")
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
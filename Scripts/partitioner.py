@@ -0,0 +1,197 @@
+import os
+import json
+import argparse
+
+import numpy as np
+import pandas as pd
+
+KEY_COLUMN = "_partition_key"
+
+
+def _hash_key(seed):
+    """16-character hash key derived from the seed (pandas row hashing needs exactly 16 characters)."""
+    return f"{seed:016d}"[-16:]
+
+
+def row_keys(chunk, seed):
+    """
+    Deterministic random key of each row: a seeded hash of its content.
+
+    Keys do not depend on the chunk size or on the position of the row in the file,
+    so the same file and seed always give the same sample and the same shards.
+    """
+    return pd.util.hash_pandas_object(chunk, index=False, hash_key=_hash_key(seed)).to_numpy()
+
+
+def read_strata(file_path, stratify, seed, query=None, chunksize=50000):
+    """Stream (stratum, rows with their keys) pairs from a CSV, optionally filtered with DataFrame.query."""
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        if query:
+            chunk = chunk.query(query)
+        chunk = chunk.assign(**{KEY_COLUMN: row_keys(chunk, seed)})
+        for stratum, rows in chunk.groupby(stratify, dropna=False, sort=False):
+            yield stratum, rows
+
+
+def reservoir_sample(file_path, stratify, size, seed=42, query=None, chunksize=50000):
+    """
+    One-pass reservoir sample of `size` rows per stratum.
+
+    Each stratum keeps the `size` rows with the smallest keys seen so far, which is a uniform
+    sample without replacement; memory is bounded by size x number of strata, not by the file.
+    Returns {stratum: rows sorted by key}.
+    """
+    reservoirs = {}
+    for stratum, rows in read_strata(file_path, stratify, seed, query, chunksize):
+        if stratum in reservoirs:
+            rows = pd.concat([reservoirs[stratum], rows])
+        reservoirs[stratum] = rows.nsmallest(size, KEY_COLUMN)
+    return {stratum: rows.sort_values(KEY_COLUMN) for stratum, rows in reservoirs.items()}
+
+
+def _write_rows(rows, file_path, append=False):
+    rows = rows.drop(columns=KEY_COLUMN)
+    header = not (append and os.path.exists(file_path))
+    rows.to_csv(file_path, mode="a" if append else "w", header=header, index=False)
+
+
+def _empty_rows(file_path):
+    """Header-only rows of a CSV (with the key column), written when no row reaches a shard."""
+    return pd.read_csv(file_path, nrows=0).assign(**{KEY_COLUMN: np.array([], dtype=np.uint64)})
+
+
+def _manifest_paths(output_files, manifest_file):
+    manifest_file = manifest_file or os.path.join(os.path.dirname(output_files[0]), "partition_manifest.json")
+    return manifest_file, os.path.splitext(manifest_file)[0] + "_reserve.csv"
+
+
+def partition_csv(file_path, output_files, stratify="roberta_label", per_shard=None, reserve=0, seed=42,
+                  query=None, chunksize=50000, manifest_file=None):
+    """
+    Write len(output_files) stratified shards of a CSV without loading it in memory.
+
+    - per_shard=None splits every row: rows of each stratum are dealt to the shards in key order,
+      so each shard gets the same share (+/- 1) of every stratum.
+    - per_shard=n draws a balanced sample of n rows per stratum for every shard with reservoir
+      sampling; `reserve` extra rows per stratum are kept for top_up().
+
+    A manifest (seed, strata, shard files, reserve usage) is saved next to the shards.
+    """
+    n_shards = len(output_files)
+    manifest_file, reserve_file = _manifest_paths(output_files, manifest_file)
+    counts = {}
+
+    if per_shard is None:
+        # Single pass: deal the rows of each stratum round-robin, continuing across chunks
+        written = [False] * n_shards
+        offsets = {}
+        for stratum, rows in read_strata(file_path, stratify, seed, query, chunksize):
+            rows = rows.sort_values(KEY_COLUMN)
+            offset = offsets.get(stratum, int(rows[KEY_COLUMN].iloc[0] % n_shards))
+            shards = (offset + np.arange(len(rows))) % n_shards
+            offsets[stratum] = (offset + len(rows)) % n_shards
+            for shard in range(n_shards):
+                _write_rows(rows[shards == shard], output_files[shard], append=written[shard])
+                written[shard] = True
+            counts[str(stratum)] = counts.get(str(stratum), 0) + len(rows)
+        # Shards that got no rows (empty or fully filtered input) still get the header
+        for shard in range(n_shards):
+            if not written[shard]:
+                _write_rows(_empty_rows(file_path), output_files[shard])
+        reserve = 0
+    else:
+        reservoirs = reservoir_sample(file_path, stratify, per_shard * n_shards + reserve, seed, query, chunksize)
+        shard_rows = [[] for _ in range(n_shards)]
+        reserve_rows = []
+        for stratum, rows in reservoirs.items():
+            if len(rows) < per_shard * n_shards:
+                print(f"Stratum {stratum!r} only has {len(rows)} rows ({per_shard * n_shards} requested)")
+            sampled = rows.iloc[:per_shard * n_shards]
+            for shard in range(n_shards):
+                shard_rows[shard].append(sampled.iloc[shard::n_shards])
+            reserve_rows.append(rows.iloc[per_shard * n_shards:])
+            counts[str(stratum)] = len(rows)
+
+        # Rows of a shard are ordered by key, which mixes the strata like a shuffle
+        for shard, parts in enumerate(shard_rows):
+            rows = pd.concat(parts).sort_values(KEY_COLUMN) if parts else _empty_rows(file_path)
+            _write_rows(rows, output_files[shard])
+        if reserve:
+            (pd.concat(reserve_rows) if reserve_rows else _empty_rows(file_path)).to_csv(reserve_file, index=False)
+
+    manifest = {
+        "source": file_path,
+        "stratify": stratify,
+        "seed": seed,
+        "query": query,
+        "per_shard": per_shard,
+        "shards": list(output_files),
+        "strata_counts": counts,
+        "reserve_file": reserve_file if reserve else None,
+        "reserve_used": [],
+    }
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    if not counts:
+        print(f"No rows to partition in {file_path}")
+    for output_file in output_files:
+        print(f"Saved {output_file}")
+    return manifest_file
+
+
+def top_up(manifest_file, shard, per_stratum):
+    """
+    Append per_stratum more rows of every stratum to a shard (e.g. when an annotator finishes early).
+    Rows come from the reserve in key order and are never handed out twice.
+    """
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    if not manifest["reserve_file"]:
+        raise ValueError("The partition has no reserve; run partition_csv with reserve > 0.")
+
+    output_file = manifest["shards"][shard] if isinstance(shard, int) else shard
+    reserve = pd.read_csv(manifest["reserve_file"])
+    available = reserve.drop(index=manifest["reserve_used"])
+    selected = available.groupby(manifest["stratify"], dropna=False, sort=False).head(per_stratum)
+    if selected.empty:
+        print("The reserve is exhausted.")
+        return selected
+
+    _write_rows(selected.sort_values(KEY_COLUMN), output_file, append=True)
+    manifest["reserve_used"] += selected.index.tolist()
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    print(f"Added {len(selected)} rows to {output_file} ({len(available) - len(selected)} left in reserve)")
+    return selected.drop(columns=KEY_COLUMN)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Stream a labelled CSV into stratified annotation shards')
+    parser.add_argument('-f', '--file', type=str, help='Path to the CSV file to partition')
+    parser.add_argument('-o', '--output', type=str, nargs='+', help='Shard files (one per annotator)')
+    parser.add_argument('-s', '--stratify', type=str, default='roberta_label', help='Column to stratify on')
+    parser.add_argument('-n', '--per-shard', type=int, default=None,
+                        help='Rows per stratum in each shard (default: split every row)')
+    parser.add_argument('-r', '--reserve', type=int, default=0, help='Extra rows per stratum kept for top-ups')
+    parser.add_argument('-q', '--query', type=str, default=None, help='Row filter, e.g. "similarity > 0"')
+    parser.add_argument('--seed', type=int, default=42, help='Random seed')
+    parser.add_argument('--top-up', type=str, default=None, help='Shard file to top up from the reserve')
+    parser.add_argument('-m', '--manifest', type=str, default=None, help='Manifest file')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    if args.top_up:
+        manifest_file = args.manifest or os.path.join(os.path.dirname(args.top_up), "partition_manifest.json")
+        top_up(manifest_file, args.top_up, args.per_shard or 10)
+    else:
+        if not args.file or not args.output:
+            parser.error("--file and --output are required to partition")
+        partition_csv(args.file, args.output, stratify=args.stratify, per_shard=args.per_shard,
+                      reserve=args.reserve, seed=args.seed, query=args.query, manifest_file=args.manifest)
+
+if __name__ == "__main__":
+    main()
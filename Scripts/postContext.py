@@ -0,0 +1,227 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from trainingStore import tokenizer_fingerprint
+
+# Default location of the index (relative to the working directory)
+DEFAULT_INDEX_DIR = os.path.join(".cache", "post_context")
+
+# Characters of the post body kept in its summary, and tokens of the tokenised summary
+SUMMARY_CHARS = 400
+SUMMARY_TOKENS = 64
+
+# Separator of the post summary and the comment in joined inputs
+CONTEXT_SEPARATOR = " || "
+
+POSTS_SCHEMA = pa.schema([("post_id", pa.string()), ("title", pa.string()), ("body", pa.string())])
+SUMMARY_SCHEMA = pa.schema([("post_id", pa.string()), ("summary_ids", pa.list_(pa.int32()))])
+
+
+def write_table(path, table):
+    """Write a table as an Arrow IPC file (random access, memory-mappable), atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with pa.OSFile(f"{path}.tmp", "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_table(path):
+    """Memory-mapped table of an Arrow IPC file (no copy of the data)."""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_file(source).read_all()
+
+
+def read_posts(file_path, chunksize=100000):
+    """Chunks of the post columns (post_id, post_title, post_body) of a CSV or Parquet file."""
+    columns = ["post_id", "post_title", "post_body"]
+    if file_path.endswith(".parquet"):
+        for batch in pq.ParquetFile(file_path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(file_path, usecols=columns, dtype=str, chunksize=chunksize)
+
+
+class PostContextIndex:
+    """
+    Persistent index of the parent post of every record: post_id -> title and body, plus the token ids of
+    a truncated summary (title and the start of the body) cached per tokenizer.
+
+    Posts are kept sorted by post_id, so the context of a whole column of records is gathered with one
+    vectorised search instead of a DataFrame merge or a groupby("post_id").first().
+
+    Parameters:
+    - index_dir: Folder of the index
+    """
+
+    def __init__(self, index_dir=DEFAULT_INDEX_DIR):
+        self.index_dir = index_dir
+        self.posts_file = os.path.join(index_dir, "posts.arrow")
+        self.posts = read_table(self.posts_file) if os.path.exists(self.posts_file) else POSTS_SCHEMA.empty_table()
+        self._load()
+
+    def _load(self):
+        self.post_ids = np.asarray(self.posts.column("post_id").to_numpy(zero_copy_only=False), dtype=str)
+        self._summaries = None
+
+    def __len__(self):
+        return self.posts.num_rows
+
+    def positions(self, post_ids):
+        """Row of every post id in the index (-1 for unknown or missing ids)."""
+        post_ids = pd.Series(post_ids, dtype=object)
+        known = post_ids.notna().to_numpy()
+        post_ids = np.asarray(post_ids.fillna("").astype(str), dtype=str)
+        if len(self.post_ids) == 0:
+            return np.full(len(post_ids), -1)
+        rows = np.searchsorted(self.post_ids, post_ids).clip(0, len(self.post_ids) - 1)
+        return np.where(known & (self.post_ids[rows] == post_ids), rows, -1)
+
+    def _new_posts(self, frame):
+        """Posts of a frame with post_id, post_title and post_body that are not in the index yet."""
+        posts = frame[["post_id", "post_title", "post_body"]].dropna(subset=["post_id"]).drop_duplicates("post_id")
+        posts = posts[self.positions(posts["post_id"]) < 0]
+        return pa.Table.from_pandas(
+            pd.DataFrame({"post_id": posts["post_id"].astype(str), "title": posts["post_title"].fillna("").astype(str),
+                          "body": posts["post_body"].fillna("").astype(str)}),
+            schema=POSTS_SCHEMA, preserve_index=False)
+
+    def _merge(self, runs):
+        """Merge tables of new posts into the index with a single sort and write. Returns the number added."""
+        new = pa.concat_tables([POSTS_SCHEMA.empty_table()] + list(runs))
+        if new.num_rows == 0:
+            return 0
+        # The sort is stable, so a post found in several runs keeps its first occurrence
+        new = new.take(pc.sort_indices(new, sort_keys=[("post_id", "ascending")]))
+        post_ids = np.asarray(new.column("post_id").to_numpy(zero_copy_only=False), dtype=str)
+        first = np.ones(len(post_ids), bool)
+        first[1:] = post_ids[1:] != post_ids[:-1]
+        new = new.filter(pa.array(first))
+        merged = pa.concat_tables([self.posts, new])
+        self.posts = merged.take(pc.sort_indices(merged, sort_keys=[("post_id", "ascending")]))
+        write_table(self.posts_file, self.posts)
+        self.posts = read_table(self.posts_file)
+        self._load()
+        return new.num_rows
+
+    def update(self, frame):
+        """Add the posts of a frame with post_id, post_title and post_body (posts already indexed are kept). Returns the number added."""
+        return self._merge([self._new_posts(frame)])
+
+    def ingest_file(self, file_path, chunksize=100000):
+        """
+        Add the posts of a CSV or Parquet file of records (e.g. the filtered data). The new posts of every chunk
+        are collected first, then merged into the index with one sort and one write.
+        """
+        return self._merge([self._new_posts(chunk) for chunk in read_posts(file_path, chunksize)])
+
+    def context(self, post_ids):
+        """Title and body of the parent post of every record (missing for unknown posts)."""
+        rows = self.positions(post_ids)
+        taken = self.posts.take(pa.array(rows, mask=rows < 0))
+        return pd.DataFrame({"title": taken.column("title").to_numpy(zero_copy_only=False),
+                             "body": taken.column("body").to_numpy(zero_copy_only=False)})
+
+    def summaries(self):
+        """Summary of every post: its title and the first SUMMARY_CHARS characters of its body."""
+        if self._summaries is None:
+            titles = pd.Series(self.posts.column("title").to_numpy(zero_copy_only=False), dtype=object)
+            bodies = pd.Series(self.posts.column("body").to_numpy(zero_copy_only=False), dtype=object)
+            self._summaries = (titles + " " + bodies.str.slice(0, SUMMARY_CHARS)).str.strip().to_numpy(dtype=object)
+        return self._summaries
+
+    def _comment_rows(self, frame):
+        """Rows of a frame that are comments of an indexed post, and the position of their post."""
+        rows = self.positions(frame["post_id"])
+        is_comment = (frame["comment_id"].notna().to_numpy() if "comment_id" in frame else np.ones(len(frame), bool))
+        return np.flatnonzero(is_comment & (rows >= 0)), rows
+
+    def build_inputs(self, frame, text_column="text", separator=CONTEXT_SEPARATOR):
+        """
+        "post summary || comment" inputs of the records of a frame: comments get the summary of their post
+        prepended, posts (and comments of unknown posts) keep their text.
+        """
+        inputs = frame[text_column].fillna("").astype(str).to_numpy(dtype=object).copy()
+        comments, rows = self._comment_rows(frame)
+        inputs[comments] = self.summaries()[rows[comments]] + separator + inputs[comments]
+        return inputs
+
+    def build_pairs(self, frame, text_column="text"):
+        """
+        Inputs of a text-classification pipeline: {"text": post summary, "text_pair": comment} for comments,
+        the plain text for posts (truncate with "only_first" so that the comment is never cut).
+        """
+        inputs = frame[text_column].fillna("").astype(str).tolist()
+        comments, rows = self._comment_rows(frame)
+        summaries = self.summaries()
+        for i in comments:
+            inputs[i] = {"text": summaries[rows[i]], "text_pair": inputs[i]}
+        return inputs
+
+    def summary_ids(self, tokenizer, max_tokens=SUMMARY_TOKENS):
+        """
+        Token ids (without special tokens) of every post summary, truncated to max_tokens. They are cached
+        per tokenizer, and only posts added since the last call are tokenised.
+        """
+        path = os.path.join(self.index_dir, "summaries", f"{tokenizer_fingerprint(tokenizer, max_tokens)}.arrow")
+        cached = read_table(path) if os.path.exists(path) else SUMMARY_SCHEMA.empty_table()
+        if cached.num_rows == len(self):
+            return cached.column("summary_ids").combine_chunks()
+
+        # Posts are only ever added, so every cached post is still in the index
+        cached_rows = self.positions(cached.column("post_id").to_numpy(zero_copy_only=False))
+        missing = np.setdiff1d(np.arange(len(self)), cached_rows)
+        encoded = tokenizer(self.summaries()[missing].tolist(), add_special_tokens=False, truncation=True,
+                            max_length=max_tokens)["input_ids"]
+        ids = pa.concat_arrays([cached.column("summary_ids").combine_chunks().cast(pa.list_(pa.int32())),
+                                pa.array(encoded, type=pa.list_(pa.int32()))])
+        ids = ids.take(np.argsort(np.concatenate([cached_rows, missing])))
+        write_table(path, pa.table([self.posts.column("post_id"), ids], schema=SUMMARY_SCHEMA))
+        return ids
+
+    def encode(self, tokenizer, frame, text_column="text", max_length=512, max_tokens=SUMMARY_TOKENS):
+        """
+        Model input ids of "post summary + comment" pairs, from the cached summary ids: the comment keeps
+        the rest of max_length after its post's summary and the special tokens.
+        """
+        texts = frame[text_column].fillna("").astype(str).tolist()
+        encoded = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=max_length)["input_ids"]
+        comments, rows = self._comment_rows(frame)
+        summary_ids = self.summary_ids(tokenizer, max_tokens).take(rows[comments]).to_pylist()
+        single_budget = max_length - tokenizer.num_special_tokens_to_add(pair=False)
+        pair_budget = max_length - tokenizer.num_special_tokens_to_add(pair=True)
+        input_ids = [tokenizer.build_inputs_with_special_tokens(ids[:single_budget]) for ids in encoded]
+        for i, summary in zip(comments, summary_ids):
+            input_ids[i] = tokenizer.build_inputs_with_special_tokens(summary, encoded[i][:pair_budget - len(summary)])
+        return input_ids
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Add the posts of record files to the post-context index')
+    parser.add_argument('-f', '--files', type=str, nargs='+', required=True,
+                        help='CSV or Parquet files with post_id, post_title and post_body')
+    parser.add_argument('-i', '--index', type=str, default=DEFAULT_INDEX_DIR, help='Index folder')
+    parser.add_argument('-t', '--tokenizer', type=str, default=None, help='Also tokenise the post summaries')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    index = PostContextIndex(args.index)
+    print("=" * 50)
+    for file_path in args.files:
+        print(f"{file_path}: {index.ingest_file(file_path):,} new posts")
+    print(f"Posts in the index: {len(index):,}")
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        index.summary_ids(AutoTokenizer.from_pretrained(args.tokenizer))
+        print(f"Summaries tokenised with {args.tokenizer}")
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
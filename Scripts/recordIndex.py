@@ -0,0 +1,158 @@
+import hashlib
+
+import numpy as np
+import pandas as pd
+from sklearn.feature_extraction.text import CountVectorizer
+
+# Text columns covered by the keyword index
+TEXT_COLUMNS = ("text", "Cleaned Text")
+
+# Columns with an equality index (automated labels and, when present, the subreddit)
+CATEGORICAL_COLUMNS = ("label_1", "label_2", "subreddit")
+
+# Every column an index is built from (the content hashed by fingerprint)
+INDEXED_COLUMNS = TEXT_COLUMNS + ("score_1",) + CATEGORICAL_COLUMNS + ("m_label_1",)
+
+
+def is_unlabelled(values):
+    """Mask of the records without a manual label (missing or empty m_label_1)."""
+    values = pd.Series(values, dtype=object)
+    return np.array(values.isna() | (values.astype(str).str.strip() == ""))
+
+
+def fingerprint(df):
+    """Content hash of the indexed columns of a frame, used as the cache key of its RecordIndex."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(str(len(df)).encode())
+    for column in INDEXED_COLUMNS:
+        if column in df.columns:
+            hasher.update(column.encode())
+            values = df[column].astype(str).where(df[column].notna())
+            hasher.update(pd.util.hash_pandas_object(values, index=False).values.tobytes())
+    return hasher.hexdigest()
+
+
+class RecordIndex:
+    """
+    Query indexes over a labelling file, built once so that filters do not scan the frame on every
+    Streamlit rerun:
+    - an inverted index (term -> sorted record positions) over text and Cleaned Text
+    - a sorted index of score_1 for score ranges
+    - a sorted index of every categorical column for label (or subreddit) filters
+    - a mask of the records without a manual label, kept up to date with mark_labelled()
+
+    Queries return sorted positions (as used with df.iloc), so the result set can drive navigation.
+
+    Parameters:
+    - df: Records of the labelling file
+    """
+
+    def __init__(self, df):
+        self.size = len(df)
+        self._build_terms(df)
+        self.score_order, self.sorted_scores = None, None
+        if "score_1" in df.columns:
+            scores = pd.to_numeric(df["score_1"], errors="coerce").to_numpy(dtype=np.float64)
+            known = np.flatnonzero(~np.isnan(scores))
+            self.score_order = known[np.argsort(scores[known], kind="stable")]
+            self.sorted_scores = scores[self.score_order]
+        self.categories = {}
+        for column in CATEGORICAL_COLUMNS:
+            if column in df.columns:
+                codes, values = pd.factorize(df[column].astype(str).where(df[column].notna()))
+                order = np.argsort(codes, kind="stable")
+                self.categories[column] = (list(values), order, codes[order])
+        self.unlabelled = is_unlabelled(df["m_label_1"]) if "m_label_1" in df.columns else np.ones(self.size, bool)
+
+    def _build_terms(self, df):
+        texts = pd.Series([""] * self.size, index=df.index)
+        for column in TEXT_COLUMNS:
+            if column in df.columns:
+                texts = texts + " " + df[column].fillna("").astype(str)
+        self.vectorizer = CountVectorizer(binary=True, token_pattern=r"(?u)\b\w+\b", dtype=np.int8)
+        try:
+            # Columns of a CSC matrix are the posting lists (row positions, already sorted)
+            self.postings = self.vectorizer.fit_transform(texts).tocsc()
+        except ValueError:
+            # No terms at all (empty texts)
+            self.postings = None
+        self.analyzer = self.vectorizer.build_analyzer()
+
+    def keyword(self, query):
+        """Positions of the records containing every term of the query."""
+        terms = set(self.analyzer(query))
+        if not terms:
+            return np.arange(self.size)
+        if self.postings is None:
+            return np.array([], dtype=np.int64)
+        vocabulary = self.vectorizer.vocabulary_
+        postings = []
+        for term in terms:
+            if term not in vocabulary:
+                return np.array([], dtype=np.int64)
+            column = vocabulary[term]
+            postings.append(self.postings.indices[self.postings.indptr[column]:self.postings.indptr[column + 1]])
+        # Intersect the shortest posting lists first
+        postings.sort(key=len)
+        result = postings[0]
+        for posting in postings[1:]:
+            result = np.intersect1d(result, posting, assume_unique=True)
+        return result.astype(np.int64)
+
+    def score_range(self, low=None, high=None):
+        """Positions of the records with low <= score_1 <= high."""
+        if self.score_order is None:
+            return np.array([], dtype=np.int64)
+        start = 0 if low is None else np.searchsorted(self.sorted_scores, low, side="left")
+        end = len(self.sorted_scores) if high is None else np.searchsorted(self.sorted_scores, high, side="right")
+        return np.sort(self.score_order[start:end])
+
+    def equals(self, column, values):
+        """Positions of the records whose column is one of the values (compared as strings)."""
+        if column not in self.categories:
+            return np.array([], dtype=np.int64)
+        names, order, sorted_codes = self.categories[column]
+        parts = []
+        for value in values:
+            if str(value) in names:
+                code = names.index(str(value))
+                parts.append(order[np.searchsorted(sorted_codes, code, side="left"):
+                                   np.searchsorted(sorted_codes, code, side="right")])
+        return np.sort(np.concatenate(parts)) if parts else np.array([], dtype=np.int64)
+
+    def mark_labelled(self, position, labelled=True):
+        """Keep the unlabelled mask in step with a manual label written by the labeler."""
+        self.unlabelled[position] = not labelled
+
+    def query(self, keywords="", score_range=None, labels=None, label_column="label_1", subreddits=None,
+              unlabelled_only=False):
+        """Sorted positions of the records matching every given filter (all records when none is given)."""
+        result = None
+        if keywords and keywords.strip():
+            result = self.keyword(keywords)
+        if score_range is not None:
+            scores = self.score_range(*score_range)
+            result = scores if result is None else np.intersect1d(result, scores, assume_unique=True)
+        if labels:
+            matches = self.equals(label_column, labels)
+            result = matches if result is None else np.intersect1d(result, matches, assume_unique=True)
+        if subreddits:
+            matches = self.equals("subreddit", subreddits)
+            result = matches if result is None else np.intersect1d(result, matches, assume_unique=True)
+        if result is None:
+            result = np.arange(self.size)
+        if unlabelled_only:
+            result = result[self.unlabelled[result]]
+        return result
+
+    @staticmethod
+    def next_position(result, position):
+        """First result after position (None when there is none)."""
+        i = np.searchsorted(result, position, side="right")
+        return int(result[i]) if i < len(result) else None
+
+    @staticmethod
+    def previous_position(result, position):
+        """Last result before position (None when there is none)."""
+        i = np.searchsorted(result, position, side="left")
+        return int(result[i - 1]) if i > 0 else None
@@ -0,0 +1,715 @@
+import os
+import re
+import json
+import time
+import zlib
+import heapq
+import bisect
+import random
+import asyncio
+import hashlib
+import argparse
+import itertools
+import threading
+import functools
+from contextlib import contextmanager
+
+from aiohttp import web, ClientSession
+
+# Endpoints and page size of the real API (the real endpoints are used when recording)
+from fetchEngine import API_URL_ENV_VAR, OAUTH_URL, WWW_URL, TOKEN_PATH, MAX_PAGE_SIZE
+
+# Response headers worth keeping in a fixture (prawcore reads the rate-limit headers)
+KEPT_HEADERS = ("content-type", "x-ratelimit-used", "x-ratelimit-remaining", "x-ratelimit-reset")
+
+BASE36 = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+WORDS = (
+    "openai chatgpt gpt model ai api release update research safety policy compute price plan team users "
+    "great good love useful impressive helpful fast better amazing works thanks nice cool "
+    "bad terrible hate broken slow worse useless annoying wrong scary expensive censored "
+    "the a is it this that i you we they and but or so not really just very think feel know see use "
+    "code answer question prompt image voice search app feature bug issue limit context token"
+).split()
+
+
+def endpoint_overrides():
+    """praw/asyncpraw Reddit() keyword arguments sending every request to REDDIT_API_URL, if it is set."""
+    url = os.getenv(API_URL_ENV_VAR)
+    if not url:
+        return {}
+    url = url.rstrip("/")
+    return {"oauth_url": url, "reddit_url": url, "short_url": url}
+
+
+def reddit_kwargs(url):
+    """Complete praw/asyncpraw Reddit() keyword arguments (with dummy credentials) for a mock server."""
+    return {
+        "client_id": "mock",
+        "client_secret": "mock",
+        "user_agent": "mock reddit client",
+        "username": "mock",
+        "password": "mock",
+        "oauth_url": url,
+        "reddit_url": url,
+        "short_url": url,
+    }
+
+
+def to_base36(number, width=0):
+    digits = ""
+    while number:
+        number, remainder = divmod(number, 36)
+        digits = BASE36[remainder] + digits
+    return digits.rjust(width, "0") or "0"
+
+
+def _json_response(data, status=200):
+    return web.Response(text=json.dumps(data, separators=(",", ":")), status=status, content_type="application/json")
+
+
+def _error(status, message):
+    return _json_response({"message": message, "error": status}, status)
+
+
+class SyntheticReddit:
+    """
+    Deterministic synthetic subreddits, generated on demand (nothing is stored up front).
+
+    Every subreddit has the same number of posts; post i gets a 7-character base36 id and
+    an exponentially distributed number of comments, except for a fraction of "megathreads".
+    Comment trees are built from the seed and the post id, so the same request always returns
+    the same data. Comments past `initial_comments` are hidden behind "more" nodes, as on Reddit.
+
+    Parameters:
+    - posts: Number of posts per subreddit
+    - comments: Mean number of comments per post
+    - megathread_rate: Fraction of posts with `megathread_comments` comments
+    - megathread_comments: Number of comments of a megathread
+    - initial_comments: Comments returned with a submission before "more" nodes take over
+    - max_depth: Maximum depth of a reply
+    - deleted_rate: Fraction of comments that are [deleted] or [removed]
+    - subreddits: Subreddits registered up front, so that their post ids resolve before any listing
+    - seed: Random seed
+    """
+
+    def __init__(self, posts=1000, comments=50, megathread_rate=0.0, megathread_comments=50000,
+                 initial_comments=200, max_depth=5, deleted_rate=0.05, subreddits=(), seed=0):
+        self.posts = posts
+        self.comments = comments
+        self.megathread_rate = megathread_rate
+        self.megathread_comments = megathread_comments
+        self.initial_comments = initial_comments
+        self.max_depth = max_depth
+        self.deleted_rate = deleted_rate
+        self.seed = seed
+        self.start_utc = 1704067200  # 2024-01-01
+        # Post ids encode (subreddit slot, post index): 36^6 posts for each of 35 subreddits
+        self.slots = {}
+        self.names = {}
+        for subreddit in subreddits:
+            self._slot(subreddit)
+
+    def _slot(self, subreddit):
+        key = subreddit.lower()
+        if key not in self.slots:
+            if len(self.slots) == 35:
+                raise ValueError("The synthetic Reddit holds at most 35 subreddits.")
+            slot = zlib.crc32(key.encode()) % 35 + 1
+            while slot in self.names:
+                slot = slot % 35 + 1
+            self.slots[key] = slot
+            self.names[slot] = subreddit
+        return self.slots[key]
+
+    def post_id(self, subreddit, index):
+        return to_base36(self._slot(subreddit) * 36 ** 6 + index, 7)
+
+    def locate(self, post_id):
+        """(subreddit, index) of a post id, or None for an unknown id."""
+        try:
+            number = int(post_id, 36)
+        except ValueError:
+            return None
+        slot, index = divmod(number, 36 ** 6)
+        if slot not in self.names or index >= self.posts:
+            return None
+        return self.names[slot], index
+
+    def _rng(self, *key):
+        return random.Random(f"{self.seed}:" + ":".join(map(str, key)))
+
+    def _text(self, rng, low, high):
+        return " ".join(rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+    def comment_count(self, post_id):
+        rng = self._rng("count", post_id)
+        if rng.random() < self.megathread_rate:
+            return self.megathread_comments
+        return int(rng.expovariate(1 / self.comments)) if self.comments else 0
+
+    @functools.lru_cache(maxsize=64)
+    def tree(self, post_id):
+        """Parent index (-1 for top-level comments) and depth of every comment of a post."""
+        rng = self._rng("tree", post_id)
+        parents, depths = [], []
+        for i in range(self.comment_count(post_id)):
+            parent = rng.randrange(i) if i and rng.random() < 0.6 else -1
+            if parent >= 0 and depths[parent] + 1 >= self.max_depth:
+                parent = -1
+            parents.append(parent)
+            depths.append(depths[parent] + 1 if parent >= 0 else 0)
+        return parents, depths
+
+    def comment_id(self, post_id, index):
+        return post_id + to_base36(index)
+
+    def comment_index(self, post_id, comment_id):
+        return int(comment_id[len(post_id):], 36)
+
+    def post(self, subreddit, index):
+        post_id = self.post_id(subreddit, index)
+        rng = self._rng("post", post_id)
+        # Newest post first, about 1 post per 10 minutes
+        created = self.start_utc + (self.posts - index) * 600 + rng.randrange(600)
+        return {"kind": "t3", "data": {
+            "id": post_id,
+            "name": f"t3_{post_id}",
+            "title": self._text(rng, 4, 15).capitalize(),
+            "selftext": self._text(rng, 0, 120),
+            "subreddit": subreddit,
+            "subreddit_name_prefixed": f"r/{subreddit}",
+            "author": f"user_{rng.randrange(100000)}",
+            "score": int(rng.paretovariate(1.2)) - 1,
+            "num_comments": self.comment_count(post_id),
+            "created_utc": float(created),
+            "link_flair_text": rng.choice([None, "Discussion", "News", "Review", "Support", "Meme"]),
+            "over_18": False,
+            "is_self": True,
+            "permalink": f"/r/{subreddit}/comments/{post_id}/",
+            "url": f"https://www.reddit.com/r/{subreddit}/comments/{post_id}/",
+        }}
+
+    def comment(self, post, index, replies=""):
+        post_id = post["id"]
+        parents, depths = self.tree(post_id)
+        rng = self._rng("comment", post_id, index)
+        parent = parents[index]
+        deleted = rng.random() < self.deleted_rate
+        comment_id = self.comment_id(post_id, index)
+        return {"kind": "t1", "data": {
+            "id": comment_id,
+            "name": f"t1_{comment_id}",
+            "body": rng.choice(["[deleted]", "[removed]"]) if deleted else self._text(rng, 3, 60),
+            "author": "[deleted]" if deleted else f"user_{rng.randrange(100000)}",
+            "score": int(rng.paretovariate(1.5)) - 1,
+            "created_utc": post["created_utc"] + 60 * (index + 1),
+            "parent_id": f"t1_{self.comment_id(post_id, parent)}" if parent >= 0 else post["name"],
+            "link_id": post["name"],
+            "subreddit": post["subreddit"],
+            "depth": depths[index],
+            "replies": replies,
+            "permalink": f"{post['permalink']}_/{comment_id}/",
+        }}
+
+    def listing(self, subreddit, limit=25, after=None):
+        """A page of posts (the sort order is the same for every listing)."""
+        start = 0
+        if after:
+            located = self.locate(after.split("_", 1)[-1])
+            start = located[1] + 1 if located else self.posts
+        indices = range(start, min(start + min(limit, MAX_PAGE_SIZE), self.posts))
+        children = [self.post(subreddit, i) for i in indices]
+        next_after = children[-1]["data"]["name"] if children and indices[-1] + 1 < self.posts else None
+        return _listing(children, next_after)
+
+    def submission(self, post_id, limit=None):
+        """The [post listing, comment listing] pair returned by /comments/{id}."""
+        subreddit, index = self.locate(post_id)
+        post = self.post(subreddit, index)
+        data = post["data"]
+        parents, _ = self.tree(post_id)
+        visible = min(len(parents), limit or self.initial_comments, self.initial_comments)
+
+        # Visible comments are nested as on Reddit; hidden ones are grouped under "more" nodes
+        # attached to their closest visible ancestor
+        replies = {i: [] for i in range(-1, visible)}
+        hidden = {}
+        for i, parent in enumerate(parents):
+            if i < visible:
+                replies[parent].append(i)
+            else:
+                ancestor = parent
+                while ancestor >= visible:
+                    ancestor = parents[ancestor]
+                hidden.setdefault(ancestor, []).append(i)
+
+        def build(parent):
+            children = [self.comment(data, i, build(i)) for i in replies[parent]]
+            children += self._more_nodes(data, parent, hidden.get(parent, []))
+            return _listing(children) if children else ""
+
+        return [_listing([post]), build(-1) or _listing([])]
+
+    def _more_nodes(self, post, parent, indices):
+        """
+        "more" nodes of at most 100 comments (in index order, so parents come before replies).
+        Counts decrease from one node to the next, which is the order PRAW expands them in.
+        """
+        post_id = post["id"]
+        parent_id = f"t1_{self.comment_id(post_id, parent)}" if parent >= 0 else post["name"]
+        depth = self.tree(post_id)[1][parent] + 1 if parent >= 0 else 0
+        nodes = []
+        for start in range(0, len(indices), MAX_PAGE_SIZE):
+            children = [self.comment_id(post_id, i) for i in indices[start:start + MAX_PAGE_SIZE]]
+            nodes.append({"kind": "more", "data": {
+                "id": children[0],
+                "name": f"t1_{children[0]}",
+                "parent_id": parent_id,
+                "count": len(indices) - start,
+                "depth": depth,
+                "children": children,
+            }})
+        return nodes
+
+    def more_children(self, link_id, children):
+        """Comments requested by /api/morechildren (flat, with their parent_id)."""
+        post_id = link_id.split("_", 1)[-1]
+        located = self.locate(post_id)
+        if located is None:
+            return []
+        post = self.post(*located)["data"]
+        n_comments = len(self.tree(post_id)[0])
+        indices = sorted(self.comment_index(post_id, child) for child in children if child.startswith(post_id))
+        return [self.comment(post, i) for i in indices if i < n_comments]
+
+    def about(self, subreddit):
+        return {"kind": "t5", "data": {
+            "id": to_base36(self._slot(subreddit)),
+            "name": f"t5_{to_base36(self._slot(subreddit))}",
+            "display_name": subreddit,
+            "subscribers": self.posts * 100,
+            "over18": False,
+        }}
+
+
+class LiveFeed:
+    """
+    Stand-in event source for streaming: the posts of the synthetic subreddits appear one by one
+    (oldest first) at posts_per_minute per subreddit, and their comments at comments_per_minute
+    per subreddit, a comment never before its post. /r/{subreddit}/new and /r/{subreddit}/comments
+    list what has appeared so far, newest first as on Reddit, and "a+b" combines subreddits.
+
+    Parameters:
+    - reddit: SyntheticReddit the posts and comments come from
+    - posts_per_minute, comments_per_minute: Arrival rates per subreddit
+    - clock: Function returning the current time in seconds (e.g. a fake clock in tests)
+    """
+
+    def __init__(self, reddit, posts_per_minute=6, comments_per_minute=60, clock=time.monotonic):
+        self.reddit = reddit
+        self.posts_per_minute = posts_per_minute
+        self.comments_per_minute = comments_per_minute
+        self.clock = clock
+        self.start = clock()
+        # Cumulative comment counts of the live posts of each subreddit
+        self._cumulative = {}
+
+    def _elapsed(self):
+        return max(self.clock() - self.start, 0)
+
+    def _post_index(self, i):
+        """SyntheticReddit index of the i-th live post (the oldest synthetic post comes first)."""
+        return self.reddit.posts - 1 - i
+
+    def posts_appeared(self):
+        return min(int(self._elapsed() * self.posts_per_minute / 60), self.reddit.posts)
+
+    def _comment_offsets(self, subreddit, n_posts):
+        offsets = self._cumulative.setdefault(subreddit.lower(), [0])
+        while len(offsets) <= n_posts:
+            post_id = self.reddit.post_id(subreddit, self._post_index(len(offsets) - 1))
+            offsets.append(offsets[-1] + self.reddit.comment_count(post_id))
+        return offsets
+
+    def comments_appeared(self, subreddit):
+        n_posts = self.posts_appeared()
+        return min(int(self._elapsed() * self.comments_per_minute / 60), self._comment_offsets(subreddit, n_posts)[n_posts])
+
+    def _name(self, subreddit, kind, k):
+        if kind == "posts":
+            return f"t3_{self.reddit.post_id(subreddit, self._post_index(k))}"
+        offsets = self._cumulative[subreddit.lower()]
+        i = bisect.bisect_right(offsets, k) - 1
+        post_id = self.reddit.post_id(subreddit, self._post_index(i))
+        return f"t1_{self.reddit.comment_id(post_id, k - offsets[i])}"
+
+    def _thing(self, subreddit, kind, k):
+        if kind == "posts":
+            return self.reddit.post(subreddit, self._post_index(k))
+        offsets = self._cumulative[subreddit.lower()]
+        i = bisect.bisect_right(offsets, k) - 1
+        post = self.reddit.post(subreddit, self._post_index(i))["data"]
+        comment = self.reddit.comment(post, k - offsets[i])
+        # Comment listings carry the title and permalink of the post
+        comment["data"].update(link_title=post["title"], link_author=post["author"],
+                               link_permalink=post["permalink"])
+        return comment
+
+    def listing(self, subreddits, kind="posts", limit=25, after=None):
+        """A page of the newest posts or comments of the subreddits, after the `after` fullname."""
+        counts = [self.posts_appeared() if kind == "posts" else self.comments_appeared(subreddit)
+                  for subreddit in subreddits]
+        # Items that appeared at the same time are ordered by subreddit
+        newest = heapq.merge(*(zip(range(1 - count, 1), itertools.repeat(position)) for position, count in enumerate(counts)))
+        if after:
+            for k, position in newest:
+                if self._name(subreddits[position], kind, -k) == after:
+                    break
+        page = [next(newest, None) for _ in range(min(limit, MAX_PAGE_SIZE))]
+        children = [self._thing(subreddits[position], kind, -k) for k, position in filter(None, page)]
+        more = page[-1] is not None and next(newest, None) is not None
+        return _listing(children, children[-1]["data"]["name"] if children and more else None)
+
+
+def _listing(children, after=None):
+    return {"kind": "Listing", "data": {"after": after, "before": None, "dist": len(children), "children": children}}
+
+
+class RateLimiter:
+    """Reddit-style fixed-window rate limit: x-ratelimit-* headers, then 429 once the window is used up."""
+
+    def __init__(self, requests_per_window=None, window_seconds=60):
+        self.requests_per_window = requests_per_window
+        self.window_seconds = window_seconds
+        self.window_start = time.monotonic()
+        self.used = 0
+
+    def check(self):
+        """Count a request; returns (allowed, headers)."""
+        if not self.requests_per_window:
+            return True, {}
+        now = time.monotonic()
+        if now - self.window_start >= self.window_seconds:
+            self.window_start = now
+            self.used = 0
+        self.used += 1
+        reset = self.window_seconds - (now - self.window_start)
+        headers = {
+            "x-ratelimit-used": str(self.used),
+            "x-ratelimit-remaining": f"{max(self.requests_per_window - self.used, 0):.1f}",
+            "x-ratelimit-reset": str(int(reset) + 1),
+        }
+        return self.used <= self.requests_per_window, headers
+
+
+def request_key(method, path, query, form=None):
+    """Fixture key of a request: method, normalised path and sorted query/form parameters."""
+    path = path.strip("/")
+    query = sorted((k, v) for k, v in query if k != "raw_json")
+    form = sorted(form or [])
+    return json.dumps([method.upper(), path, query, form])
+
+
+def fixture_path(fixtures_dir, key):
+    return os.path.join(fixtures_dir, hashlib.sha1(key.encode()).hexdigest()[:20] + ".json")
+
+
+class MockRedditServer:
+    """
+    Local stand-in for the Reddit API, in one of three modes:
+
+    - "synthetic": serves a SyntheticReddit
+    - "record": proxies every request to the real API and saves the responses as fixtures
+      (token requests are forwarded but never saved, so no credentials end up in fixtures)
+    - "replay": serves the recorded fixtures (unknown requests get a 404)
+
+    Every mode adds the configured latency, rate limit and random server errors, and counts
+    requests, in-flight concurrency and throttled responses (GET /_mock/stats).
+
+    Parameters:
+    - mode: "synthetic", "record" or "replay"
+    - reddit: SyntheticReddit served in synthetic mode (default: SyntheticReddit())
+    - live: LiveFeed serving /r/{subreddit}/new and /r/{subreddit}/comments in synthetic mode (streaming)
+    - fixtures_dir: Folder of the fixtures (record and replay modes)
+    - latency_ms, jitter_ms: Added latency per request (uniform jitter of +/- jitter_ms)
+    - recorded_latency: In replay mode, wait as long as the recorded request took instead
+    - requests_per_window, window_seconds: Rate limit (None disables it)
+    - error_rate: Fraction of requests answered with a 503
+    - host, port: Address to listen on (port 0 picks a free port)
+    - seed: Seed of the latency jitter and of the errors
+    """
+
+    def __init__(self, mode="synthetic", reddit=None, fixtures_dir=None, latency_ms=0, jitter_ms=0,
+                 recorded_latency=False, requests_per_window=None, window_seconds=60, error_rate=0.0,
+                 host="127.0.0.1", port=0, seed=0, live=None):
+        if mode not in ("synthetic", "record", "replay"):
+            raise ValueError(f"Unknown mode: {mode}")
+        if mode != "synthetic" and not fixtures_dir:
+            raise ValueError(f"The {mode} mode needs a fixtures folder.")
+        self.mode = mode
+        self.reddit = reddit or SyntheticReddit()
+        self.live = live
+        self.fixtures_dir = fixtures_dir
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.recorded_latency = recorded_latency
+        self.rate_limiter = RateLimiter(requests_per_window, window_seconds)
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self.rng = random.Random(seed)
+        self.url = None
+        self.stats = {"requests": 0, "by_route": {}, "throttled": 0, "errors": 0, "missing": 0,
+                      "in_flight": 0, "peak_in_flight": 0}
+        self._runner = None
+        self._session = None
+
+    def app(self):
+        app = web.Application(middlewares=[self._middleware])
+        app.router.add_get("/_mock/stats", self._stats)
+        app.router.add_route("*", "/{path:.*}", self._dispatch)
+        return app
+
+    async def start(self):
+        if self.mode == "record":
+            self._session = ClientSession()
+        if self.fixtures_dir:
+            os.makedirs(self.fixtures_dir, exist_ok=True)
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{self.host}:{self.port}"
+        return self.url
+
+    async def stop(self):
+        if self._session is not None:
+            await self._session.close()
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    @web.middleware
+    async def _middleware(self, request, handler):
+        if request.path.startswith("/_mock/"):
+            return await handler(request)
+        stats = self.stats
+        stats["requests"] += 1
+        route = _route_name(request.path)
+        stats["by_route"][route] = stats["by_route"].get(route, 0) + 1
+        stats["in_flight"] += 1
+        stats["peak_in_flight"] = max(stats["peak_in_flight"], stats["in_flight"])
+        try:
+            delay = self.latency_ms + self.rng.uniform(-self.jitter_ms, self.jitter_ms)
+            if delay > 0:
+                await asyncio.sleep(delay / 1000)
+
+            allowed, headers = self.rate_limiter.check()
+            if not allowed:
+                stats["throttled"] += 1
+                response = _error(429, "Too Many Requests")
+            elif self.error_rate and self.rng.random() < self.error_rate:
+                stats["errors"] += 1
+                response = _error(503, "Service Unavailable")
+            else:
+                response = await handler(request)
+            response.headers.update(headers)
+            return response
+        finally:
+            stats["in_flight"] -= 1
+
+    async def _stats(self, request):
+        return _json_response(self.stats)
+
+    async def _dispatch(self, request):
+        path = request.match_info["path"].strip("/")
+        try:
+            form = list((await request.post()).items()) if request.method == "POST" else []
+        except ConnectionResetError:
+            # The client gave up on the request (e.g. a cancelled call)
+            return _error(400, "Connection lost")
+        if path == TOKEN_PATH and self.mode != "record":
+            return _json_response({"access_token": "mock-token", "token_type": "bearer",
+                                   "expires_in": 86400, "scope": "*"})
+        if self.mode == "record":
+            return await self._record(request, path, form)
+        if self.mode == "replay":
+            return await self._replay(request, path, form)
+        return self._synthetic(request, path, form)
+
+    def _synthetic(self, request, path, form):
+        reddit = self.reddit
+        query = request.query
+        limit = int(query.get("limit", 25))
+
+        if path == "api/v1/me":
+            return _json_response({"name": "mock", "id": "mock"})
+        if path == "api/morechildren":
+            form = dict(form)
+            children = [child for child in form.get("children", query.get("children", "")).split(",") if child]
+            things = reddit.more_children(form.get("link_id", query.get("link_id", "")), children)
+            return _json_response({"json": {"errors": [], "data": {"things": things}}})
+        if path == "api/info":
+            posts = [reddit.locate(name.split("_", 1)[-1]) for name in query.get("id", "").split(",")]
+            return _json_response(_listing([reddit.post(*located) for located in posts if located]))
+
+        match = re.fullmatch(r"(?:r/[^/]+/)?comments/([0-9a-z]+)(?:/.*)?", path)
+        if match:
+            if reddit.locate(match.group(1)) is None:
+                return _error(404, "Not Found")
+            return _json_response(reddit.submission(match.group(1), limit=int(query.get("limit", 0)) or None))
+
+        match = re.fullmatch(r"r/([^/]+)/(new|comments)", path)
+        if match and self.live is not None:
+            kind = "posts" if match.group(2) == "new" else "comments"
+            return _json_response(self.live.listing(match.group(1).split("+"), kind, limit=limit,
+                                                    after=query.get("after")))
+
+        match = re.fullmatch(r"r/([^/]+)/about", path)
+        if match:
+            return _json_response(reddit.about(match.group(1)))
+
+        match = re.fullmatch(r"r/([^/]+)(?:/(hot|new|top|rising|controversial|search))?", path)
+        if match:
+            # Every listing (and every search) returns the posts in the same order
+            return _json_response(reddit.listing(match.group(1), limit=limit, after=query.get("after")))
+
+        return _error(404, "Not Found")
+
+    async def _record(self, request, path, form):
+        upstream = WWW_URL if path == TOKEN_PATH else OAUTH_URL
+        headers = {name: request.headers[name] for name in ("Authorization", "User-Agent") if name in request.headers}
+        start = time.perf_counter()
+        async with self._session.request(request.method, f"{upstream}/{path}", params=list(request.query.items()),
+                                         data=form or None, headers=headers) as upstream_response:
+            body = await upstream_response.text()
+            kept = {name: upstream_response.headers[name] for name in KEPT_HEADERS if name in upstream_response.headers}
+            status = upstream_response.status
+        elapsed_ms = (time.perf_counter() - start) * 1000
+
+        if path != TOKEN_PATH:
+            key = request_key(request.method, path, request.query.items(), form)
+            fixture = {"key": json.loads(key), "status": status, "headers": kept, "elapsed_ms": elapsed_ms, "body": body}
+            file_path = fixture_path(self.fixtures_dir, key)
+            with open(f"{file_path}.tmp", "w", encoding="utf-8") as f:
+                json.dump(fixture, f)
+            os.replace(f"{file_path}.tmp", file_path)
+
+        content_type = kept.pop("content-type", "application/json").split(";")[0]
+        return web.Response(text=body, status=status, headers=kept, content_type=content_type)
+
+    async def _replay(self, request, path, form):
+        key = request_key(request.method, path, request.query.items(), form)
+        file_path = fixture_path(self.fixtures_dir, key)
+        if not os.path.exists(file_path):
+            self.stats["missing"] += 1
+            return _error(404, f"No fixture recorded for {request.method} /{path}")
+        with open(file_path, encoding="utf-8") as f:
+            fixture = json.load(f)
+        if self.recorded_latency:
+            await asyncio.sleep(fixture["elapsed_ms"] / 1000)
+        headers = dict(fixture["headers"])
+        content_type = headers.pop("content-type", "application/json").split(";")[0]
+        # Rate-limit headers come from the mock's own limiter, not from the recording
+        for name in KEPT_HEADERS[1:]:
+            headers.pop(name, None)
+        return web.Response(text=fixture["body"], status=fixture["status"], headers=headers, content_type=content_type)
+
+
+def _route_name(path):
+    """Group request paths for the statistics (listing, comments, morechildren, ...)."""
+    path = path.strip("/")
+    if re.fullmatch(r"(?:r/[^/]+/)?comments/.*", path):
+        return "comments"
+    match = re.fullmatch(r"r/[^/]+(?:/(\w+))?", path)
+    if match:
+        return match.group(1) or "hot"
+    return path
+
+
+@contextmanager
+def serve_in_thread(**params):
+    """
+    Run a MockRedditServer on a background event loop, for synchronous code (e.g. PRAW):
+
+        with serve_in_thread(latency_ms=50) as server:
+            reddit = praw.Reddit(**reddit_kwargs(server.url))
+    """
+    server = MockRedditServer(**params)
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever, daemon=True)
+    thread.start()
+    try:
+        asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+        yield server
+    finally:
+        asyncio.run_coroutine_threadsafe(server.stop(), loop).result()
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join()
+        loop.close()
+
+
+async def _serve(server):
+    async with server:
+        print(f"Mock Reddit API ({server.mode}) listening on {server.url}")
+        print(f"Run the fetchers with {API_URL_ENV_VAR}={server.url}")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print("=" * 50)
+            print(json.dumps(server.stats, indent=4))
+            print("=" * 50)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Local mock of the Reddit API (synthetic data, recording or replay)')
+    parser.add_argument('-m', '--mode', type=str, default='synthetic', choices=['synthetic', 'record', 'replay'],
+                        help='Serve synthetic subreddits, record real traffic into fixtures, or replay fixtures')
+    parser.add_argument('-d', '--fixtures', type=str, default=None, help='Fixtures folder (record and replay modes)')
+    parser.add_argument('-p', '--port', type=int, default=8080, help='Port to listen on')
+    parser.add_argument('-s', '--subreddits', type=str, nargs='*', default=[], help='Subreddits to register up front')
+    parser.add_argument('--posts', type=int, default=1000, help='Posts per synthetic subreddit')
+    parser.add_argument('--comments', type=int, default=50, help='Mean comments per synthetic post')
+    parser.add_argument('--megathread-rate', type=float, default=0.0, help='Fraction of posts that are megathreads')
+    parser.add_argument('--megathread-comments', type=int, default=50000, help='Comments per megathread')
+    parser.add_argument('--live', action='store_true',
+                        help='Make posts and comments appear over time in /new and /comments (for streaming)')
+    parser.add_argument('--posts-per-minute', type=float, default=6, help='Live posts per subreddit per minute')
+    parser.add_argument('--comments-per-minute', type=float, default=60,
+                        help='Live comments per subreddit per minute')
+    parser.add_argument('--latency-ms', type=float, default=0, help='Latency added to every request')
+    parser.add_argument('--jitter-ms', type=float, default=0, help='Random latency jitter (+/-)')
+    parser.add_argument('--recorded-latency', action='store_true', help='Replay with the recorded latencies')
+    parser.add_argument('--rate-limit', type=int, default=None, help='Requests allowed per window (default: no limit)')
+    parser.add_argument('--window', type=float, default=60, help='Rate limit window in seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with a 503')
+    parser.add_argument('--seed', type=int, default=0, help='Random seed')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    reddit = SyntheticReddit(posts=args.posts, comments=args.comments, megathread_rate=args.megathread_rate,
+                             megathread_comments=args.megathread_comments, subreddits=args.subreddits,
+                             seed=args.seed)
+    live = LiveFeed(reddit, args.posts_per_minute, args.comments_per_minute) if args.live else None
+    server = MockRedditServer(mode=args.mode, reddit=reddit, fixtures_dir=args.fixtures, latency_ms=args.latency_ms,
+                              jitter_ms=args.jitter_ms, recorded_latency=args.recorded_latency,
+                              requests_per_window=args.rate_limit, window_seconds=args.window,
+                              error_rate=args.error_rate, port=args.port, seed=args.seed,
+                              live=live)
+    try:
+        asyncio.run(_serve(server))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
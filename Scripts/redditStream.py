@@ -0,0 +1,455 @@
+import os
+import csv
+import time
+import asyncio
+import argparse
+from collections import OrderedDict, deque, Counter
+from datetime import datetime, timezone
+
+import numpy as np
+import pandas as pd
+import aiohttp
+
+from fetchEngine import RedditClient, Thing, _reasons, MAX_PAGE_SIZE
+from tracing import span
+
+# Columns of the scrape CSVs written by RedditFetcher.save_data, plus the scores of label_data()
+STREAM_COLUMNS = ["post_id", "comment_id", "title", "body", "subreddit", "upvotes", "comments", "date_time",
+                  "author", "query", "roberta_label", "roberta_score"]
+
+# Names of the posts and comments already seen by a stream (the newest ones are kept)
+SEEN_CAPACITY = 3000
+
+
+def format_time(created_utc):
+    return datetime.fromtimestamp(created_utc, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+
+class BoundedSet:
+    """Set keeping only the `capacity` most recently added items."""
+
+    def __init__(self, capacity=SEEN_CAPACITY):
+        self.capacity = capacity
+        self._items = OrderedDict()
+
+    def __contains__(self, item):
+        return item in self._items
+
+    def add(self, item):
+        self._items[item] = None
+        self._items.move_to_end(item)
+        if len(self._items) > self.capacity:
+            self._items.popitem(last=False)
+
+
+async def follow(client, subreddits, kind="submissions", pause=1.0, max_pause=16.0, catch_up_pages=10,
+                 skip_existing=False, stats=None, seen=()):
+    """
+    Async generator of the new posts ("submissions") or comments ("comments") of the subreddits,
+    oldest first, as PRAW's subreddit.stream does: the newest page is polled, items not seen yet
+    are yielded and the pause between polls doubles (up to max_pause) while nothing new arrives.
+    When a whole page is new, older pages are fetched (up to catch_up_pages) until a seen item
+    is found, so a burst between two polls is not lost.
+
+    seen holds the names (fullnames, e.g. "t1_abc") already ingested by a previous run: they are not
+    yielded again, and the first poll catches up to them instead of stopping after one page.
+    """
+    path = f"r/{'+'.join(subreddits)}/{'new' if kind == 'submissions' else 'comments'}"
+    stats = stats if stats is not None else Counter()
+    prefix = "t3_" if kind == "submissions" else "t1_"
+    seen_names = [name for name in seen if name.startswith(prefix)]
+    resumed = bool(seen_names)
+    seen = BoundedSet()
+    for name in seen_names[-seen.capacity:]:
+        seen.add(name)
+    first, delay = True, pause
+    while True:
+        new, after = [], None
+        for _ in range(catch_up_pages + 1):
+            with span(f"stream.poll_{kind}") as s:
+                page = await client.request("GET", path, {"limit": MAX_PAGE_SIZE, "after": after})
+                children = page["data"]["children"]
+                s.add(rows=len(children))
+            stats["polls"] += 1
+            unseen = [child["data"] for child in children if child["data"]["name"] not in seen]
+            new.extend(unseen)
+            after = page["data"].get("after")
+            # Stop at the first seen item, and on the first poll of a new stream (everything is new then)
+            if (first and not resumed) or len(unseen) < len(children) or not after:
+                break
+        else:
+            stats["gaps"] += 1
+
+        for data in reversed(new):
+            seen.add(data["name"])
+            if not (first and skip_existing):
+                yield Thing(data)
+        first = False
+        delay = pause if new else min(delay * 2, max_pause)
+        await asyncio.sleep(delay)
+
+
+def keyword_filter(keywords=(), exclude=()):
+    """
+    Relevance filter of a streamed item: it must mention one of the keywords (in its text or, for a
+    comment, in its post's title) and none of the excluded words. Returns None or the reason to drop it.
+    """
+    keywords = [keyword.lower() for keyword in keywords]
+    exclude = [word.lower() for word in exclude]
+
+    def check(item):
+        text = " ".join(filter(None, [item.get("title"), item.get("selftext"), item.get("body"),
+                                      item.get("link_title")])).lower()
+        if keywords and not any(keyword in text for keyword in keywords):
+            return "no relevant keywords"
+        if any(word in text for word in exclude):
+            return "excluded keyword"
+        return None
+    return check
+
+
+def deleted_filter(item):
+    if item.get("body") in ("[deleted]", "[removed]") or item.get("selftext") in ("[deleted]", "[removed]"):
+        return "deleted"
+    return None
+
+
+def to_record(item, keywords=()):
+    """Row of the scrape CSV schema for a streamed post or comment ("query" is the first matching keyword)."""
+    is_comment = item["name"].startswith("t1_")
+    text = item.get("body") if is_comment else f"{item.get('title', '')} {item.get('selftext', '')}".strip()
+    lowered = f"{text} {item.get('link_title') or ''}".lower()
+    return {
+        "post_id": item["link_id"].split("_", 1)[-1] if is_comment else item["id"],
+        "comment_id": item["id"] if is_comment else None,
+        "title": item.get("link_title") if is_comment else item.get("title"),
+        "body": item.get("body") if is_comment else item.get("selftext"),
+        "subreddit": item.get("subreddit"),
+        "upvotes": item.get("score"),
+        "comments": 0 if is_comment else item.get("num_comments"),
+        "date_time": format_time(item["created_utc"]),
+        "author": item.get("author") if item.get("author") != "[deleted]" else "[Deleted]",
+        "query": next((keyword for keyword in keywords if keyword.lower() in lowered), None),
+        "text": text,
+    }
+
+
+# ---- Scorers
+
+class ServiceScorer:
+    """Scores batches of texts through a running scoring service (Scripts/sentimentService.py)."""
+
+    def __init__(self, url, timeout=60):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+        self._session = None
+
+    async def __call__(self, texts):
+        if self._session is None:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout))
+        async with self._session.post(f"{self.url}/score", json={"texts": texts}) as response:
+            response.raise_for_status()
+            return (await response.json())["results"]
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class ModelScorer:
+    """Scores batches of texts with a model loaded in this process (see sentimentService.load_model)."""
+
+    def __init__(self, model, max_length=512, threads=None):
+        from sentimentService import load_model
+        self.model = load_model(model, max_length=max_length, threads=threads)
+
+    async def __call__(self, texts):
+        return await asyncio.get_running_loop().run_in_executor(None, self.model, texts)
+
+    async def close(self):
+        pass
+
+
+# ---- Sinks
+
+class CsvStreamSink:
+    """Appends every scored batch to a CSV file (STREAM_COLUMNS), flushed after each batch."""
+
+    def __init__(self, file_path):
+        folder = os.path.dirname(file_path)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        exists = os.path.isfile(file_path)
+        self.file_path = file_path
+        self.file = open(file_path, "a", newline="", encoding="utf-8")
+        self.writer = csv.DictWriter(self.file, fieldnames=STREAM_COLUMNS, extrasaction="ignore")
+        if not exists:
+            self.writer.writeheader()
+
+    def seen_names(self, limit=SEEN_CAPACITY):
+        """Names of the last `limit` posts and `limit` comments already in the file (read before appending)."""
+        if os.path.getsize(self.file_path) == 0:
+            return []
+        posts, comments = deque(maxlen=limit), deque(maxlen=limit)
+        for chunk in pd.read_csv(self.file_path, usecols=["post_id", "comment_id"], dtype=str, chunksize=100000):
+            is_comment = chunk["comment_id"].notna()
+            posts.extend("t3_" + chunk.loc[~is_comment, "post_id"].dropna())
+            comments.extend("t1_" + chunk.loc[is_comment, "comment_id"])
+        return list(posts) + list(comments)
+
+    def write(self, records):
+        self.writer.writerows(records)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class RollupSink:
+    """Merges every scored batch into the sentiment rollup (see sentimentRollup.py), so that fresh counts are queryable."""
+
+    def __init__(self, store_file=None):
+        from sentimentRollup import RollupStore, DEFAULT_STORE_FILE
+        self.store = RollupStore(store_file or DEFAULT_STORE_FILE, label_column="roberta_label")
+
+    def write(self, records):
+        batch = pd.DataFrame(records)
+        if "roberta_label" not in batch or batch["roberta_label"].isna().all():
+            return
+        self.store.update(batch.assign(readable_datetime=batch["date_time"]))
+
+    def close(self):
+        pass
+
+
+# ---- Pipeline
+
+class StreamPipeline:
+    """
+    Long-running ingestion of the new posts and comments of a set of subreddits.
+
+    Stages are connected by bounded queues: the stream followers put items on the filter queue,
+    relevant items are turned into records and batched for scoring, and every scored batch is
+    appended by the sinks. When scoring or writing falls behind, the queues fill up and the
+    followers stop polling until there is room again (backpressure), so memory stays bounded
+    however fast the subreddits move.
+
+    Parameters:
+    - client: RedditClient
+    - subreddits: Subreddits to follow
+    - kinds: "submissions" and/or "comments"
+    - filters: Functions item -> None, a reason or a list of reasons to drop the item
+    - keywords: Keywords recorded in the "query" column (the first one an item mentions)
+    - scorer: Async function texts -> [{"roberta_label", "roberta_score"}] (None writes unscored records)
+    - sinks: Objects with write(records) and close(); sinks with seen_names() (CsvStreamSink) list the items
+      already written, which are not ingested again when the stream restarts
+    - queue_size: Capacity of each queue between stages
+    - batch_size, max_wait: A batch is scored once it has batch_size records or its first record waited max_wait seconds
+    - poll_pause, max_poll_pause: Pause between polls while items keep arriving, and its upper bound when idle
+    - skip_existing: Do not ingest the items already listed when the stream starts
+    """
+
+    def __init__(self, client, subreddits, kinds=("submissions", "comments"), filters=(), keywords=(), scorer=None,
+                 sinks=(), queue_size=1000, batch_size=32, max_wait=2.0, poll_pause=1.0, max_poll_pause=16.0,
+                 skip_existing=False):
+        self.client = client
+        self.subreddits = list(subreddits)
+        self.kinds = list(kinds)
+        self.filters = [deleted_filter, *filters]
+        self.keywords = list(keywords)
+        self.scorer = scorer
+        self.sinks = list(sinks)
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+        self.poll_pause = poll_pause
+        self.max_poll_pause = max_poll_pause
+        self.skip_existing = skip_existing
+        self.stats = Counter()
+        self.dropped = Counter()
+        self._latencies = deque(maxlen=10000)
+        self._stop = None
+
+    def stop(self):
+        """Stop following the subreddits; the records already queued are still scored and written."""
+        if self._stop is not None:
+            self._stop.set()
+
+    async def run(self, duration=None, max_records=None):
+        """Run until stop(), duration seconds or max_records written records; returns the statistics."""
+        self._stop = asyncio.Event()
+        self.stats, self.dropped = Counter(), Counter()
+        self._max_records = max_records
+        items = asyncio.Queue(maxsize=self.queue_size)
+        records = asyncio.Queue(maxsize=self.queue_size)
+        batches = asyncio.Queue(maxsize=max(self.queue_size // self.batch_size, 2))
+
+        seen = [name for sink in self.sinks if hasattr(sink, "seen_names") for name in sink.seen_names()]
+        followers = [asyncio.create_task(self._follow(kind, items, seen)) for kind in self.kinds]
+        stages = [asyncio.create_task(self._filter(items, records)),
+                  asyncio.create_task(self._score(records, batches)),
+                  asyncio.create_task(self._write(batches))]
+        try:
+            try:
+                await asyncio.wait_for(self._stop.wait(), duration)
+            except asyncio.TimeoutError:
+                pass
+            for follower in followers:
+                follower.cancel()
+            await asyncio.gather(*followers, return_exceptions=True)
+            # Drain: each stage passes the end marker on once its queue is empty
+            await items.put(None)
+            await asyncio.gather(*stages)
+        finally:
+            for task in followers + stages:
+                task.cancel()
+            for sink in self.sinks:
+                sink.close()
+            if self.scorer is not None and hasattr(self.scorer, "close"):
+                await self.scorer.close()
+        return self.summary()
+
+    async def _follow(self, kind, items, seen=()):
+        try:
+            async for item in follow(self.client, self.subreddits, kind, self.poll_pause, self.max_poll_pause,
+                                     skip_existing=self.skip_existing, stats=self.stats, seen=seen):
+                self.stats[f"new_{kind}"] += 1
+                # Blocks while the filter queue is full
+                await items.put((item, time.monotonic()))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            print(f"Stream of {kind} stopped: {e}")
+            self.stats["errors"] += 1
+            self._stop.set()
+
+    async def _filter(self, items, records):
+        while True:
+            entry = await items.get()
+            if entry is None:
+                await records.put(None)
+                return
+            item, received = entry
+            reasons = [reason for check in self.filters for reason in _reasons(check(item))]
+            if reasons:
+                self.dropped.update(reasons)
+                continue
+            await records.put((to_record(item, self.keywords), received))
+
+    async def _score(self, records, batches):
+        done = False
+        while not done:
+            entry = await records.get()
+            if entry is None:
+                break
+            batch = [entry]
+            deadline = time.monotonic() + self.max_wait
+            while len(batch) < self.batch_size:
+                try:
+                    entry = await asyncio.wait_for(records.get(), max(deadline - time.monotonic(), 0))
+                except asyncio.TimeoutError:
+                    break
+                if entry is None:
+                    done = True
+                    break
+                batch.append(entry)
+
+            rows = [record for record, _ in batch]
+            if self.scorer is not None:
+                try:
+                    with span("stream.score", rows=len(rows)):
+                        scores = await self.scorer([record["text"] for record in rows])
+                    for record, score in zip(rows, scores):
+                        record.update(score)
+                except Exception as e:
+                    print(f"Scoring failed ({e}), writing the batch unscored")
+                    self.stats["score_errors"] += 1
+            await batches.put(batch)
+        await batches.put(None)
+
+    async def _write(self, batches):
+        while True:
+            batch = await batches.get()
+            if batch is None:
+                return
+            rows = [record for record, _ in batch]
+            with span("stream.write", rows=len(rows)):
+                for sink in self.sinks:
+                    sink.write(rows)
+            now = time.monotonic()
+            self._latencies.extend(now - received for _, received in batch)
+            self.stats["written"] += len(rows)
+            self.stats["batches"] += 1
+            if self._max_records is not None and self.stats["written"] >= self._max_records:
+                self._stop.set()
+
+    def summary(self):
+        latencies = np.fromiter(self._latencies, dtype=np.float64, count=len(self._latencies))
+        return {
+            **self.stats,
+            "dropped": dict(self.dropped),
+            "latency_s": {f"p{p}": round(float(np.percentile(latencies, p)), 3) if len(latencies) else None
+                          for p in (50, 99)},
+        }
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Follow new posts and comments of subreddits, score them and append them to a CSV')
+    parser.add_argument('-s', '--subreddits', type=str, nargs='+', required=True, help='Subreddits to follow')
+    parser.add_argument('-k', '--keywords', type=str, nargs='*', default=[], help='Keep items mentioning one of these')
+    parser.add_argument('-x', '--exclude', type=str, nargs='*', default=[], help='Drop items mentioning one of these')
+    parser.add_argument('--kinds', type=str, nargs='+', default=['submissions', 'comments'],
+                        choices=['submissions', 'comments'], help='Follow posts, comments or both')
+    parser.add_argument('-o', '--output', type=str, default='data_stream/stream.csv', help='CSV file to append to')
+    parser.add_argument('--service', type=str, default=None, help='URL of a running scoring service')
+    parser.add_argument('-m', '--model', type=str, default=None, help='Model folder to score with in this process')
+    parser.add_argument('--rollup', action='store_true', help='Also merge the scores into the sentiment rollup')
+    parser.add_argument('-b', '--batch-size', type=int, default=32, help='Records per scoring batch')
+    parser.add_argument('-w', '--max-wait', type=float, default=2.0, help='Maximum seconds a record waits for a batch')
+    parser.add_argument('--queue-size', type=int, default=1000, help='Capacity of the queues between stages')
+    parser.add_argument('-d', '--duration', type=float, default=None, help='Stop after this many seconds')
+    parser.add_argument('--skip-existing', action='store_true', help='Only ingest items posted after the start')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    scorer = ServiceScorer(args.service) if args.service else ModelScorer(args.model) if args.model else None
+    sinks = [CsvStreamSink(args.output)] + ([RollupSink()] if args.rollup else [])
+
+    async def run():
+        async with RedditClient(os.getenv('CLIENT_ID'), os.getenv('CLIENT_SECRET'), os.getenv('USER'),
+                                os.getenv('PASSWORD')) as client:
+            pipeline = StreamPipeline(client, args.subreddits, kinds=args.kinds,
+                                      filters=[keyword_filter(args.keywords, args.exclude)], keywords=args.keywords,
+                                      scorer=scorer, sinks=sinks, queue_size=args.queue_size,
+                                      batch_size=args.batch_size, max_wait=args.max_wait,
+                                      skip_existing=args.skip_existing)
+            print(f"Following r/{'+'.join(args.subreddits)} ({', '.join(args.kinds)}), appending to {args.output}")
+            run_task = asyncio.ensure_future(pipeline.run(duration=args.duration))
+            try:
+                return await asyncio.shield(run_task)
+            except asyncio.CancelledError:
+                # Ctrl+C: stop following and let the queued records drain
+                pipeline.stop()
+                return await run_task
+
+    try:
+        stats = asyncio.run(run())
+    except KeyboardInterrupt:
+        return
+    print("=" * 50)
+    print(f"Written {stats['written']:,} records in {stats['batches']:,} batches "
+          f"(p50 ingest latency {stats['latency_s']['p50']}s)")
+    print(f"Dropped: {stats['dropped']}")
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
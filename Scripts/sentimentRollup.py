@@ -0,0 +1,242 @@
+import os
+import argparse
+
+import numpy as np
+import pandas as pd
+
+# Default location of the rollup store (relative to the working directory)
+DEFAULT_STORE_FILE = os.path.join(".cache", "sentiment_rollup.parquet")
+
+ROLLUP_KEYS = ["day", "subreddit", "query", "label"]
+ROLLUP_VALUES = ["count", "score_sum", "score_count"]
+
+# Current contribution of every ingested record, stored next to its key
+RECORD_FIELDS = ROLLUP_KEYS + ["score"]
+
+# Columns identifying a record; files without them are keyed by their other (non-label) columns
+RECORD_KEY_COLUMNS = ["post_id", "comment_id"]
+LABEL_COLUMNS = ["label", "roberta_label", "roberta_score", "score_1", "label_1", "m_label_1", "manual_label"]
+
+# Pandas period aliases accepted by aggregate()
+FREQUENCIES = {"year": "Y", "quarter": "Q", "month": "M", "week": "W", "day": "D"}
+
+
+def parse_days(datetimes):
+    """
+    Day of each readable_datetime value.
+
+    Most values are "YYYY-MM-DD HH:MM:SS", so the date prefix is parsed with a fixed format;
+    only the values that do not match fall back to the (slow) mixed-format parser.
+    """
+    datetimes = datetimes.astype("string")
+    days = pd.to_datetime(datetimes.str.slice(0, 10), format="%Y-%m-%d", errors="coerce")
+    unparsed = days.isna() & datetimes.notna()
+    if unparsed.any():
+        days[unparsed] = pd.to_datetime(datetimes[unparsed], format="mixed", errors="coerce").dt.normalize()
+    return days
+
+
+def record_keys(batch, label_column="label", score_column="roberta_score"):
+    """
+    64-bit key of every record: the hash of (post_id, comment_id), or of the columns other than the labels
+    when the batch has no ids (so a re-labelled record keeps its key).
+    """
+    columns = [column for column in RECORD_KEY_COLUMNS if column in batch]
+    if "post_id" not in columns:
+        excluded = set(LABEL_COLUMNS) | {label_column, score_column}
+        columns = [column for column in batch.columns if column not in excluded]
+    keys = batch[columns].astype("string")
+    return pd.util.hash_pandas_object(keys, index=False).to_numpy(dtype=np.uint64)
+
+
+def record_fields(batch, label_column="label", score_column="roberta_score"):
+    """Day, subreddit, query, label and score of every record of a labelled batch."""
+    return pd.DataFrame({
+        "day": parse_days(batch["readable_datetime"]).to_numpy(),
+        "subreddit": batch["subreddit"].astype("string").to_numpy() if "subreddit" in batch else pd.NA,
+        "query": batch["query"].astype("string").to_numpy() if "query" in batch else pd.NA,
+        "label": batch[label_column].to_numpy(),
+        "score": (pd.to_numeric(batch[score_column], errors="coerce").to_numpy(dtype=np.float64)
+                  if score_column in batch else np.nan),
+    })
+
+
+def rollup_records(records):
+    """Counts and score sums per (day, subreddit, query, label) of records with RECORD_FIELDS."""
+    rollup = records[ROLLUP_KEYS].copy()
+    rollup["count"] = 1
+    rollup["score_sum"] = records["score"].fillna(0).to_numpy()
+    rollup["score_count"] = records["score"].notna().astype(np.int64).to_numpy()
+    rollup = rollup.dropna(subset=["day", "label"])
+    return rollup.groupby(ROLLUP_KEYS, dropna=False, as_index=False)[ROLLUP_VALUES].sum()
+
+
+def rollup_batch(batch, label_column="label", score_column="roberta_score"):
+    """Counts and score sums per (day, subreddit, query, label) for a batch of labelled records."""
+    return rollup_records(record_fields(batch, label_column, score_column))
+
+
+def _changed(old, new):
+    """Mask of the rows whose fields differ (missing values compare equal)."""
+    changed = np.zeros(len(new), bool)
+    for column in RECORD_FIELDS:
+        a, b = old[column].to_numpy(dtype=object), new[column].to_numpy(dtype=object)
+        both_missing = pd.isna(old[column]).to_numpy() & pd.isna(new[column]).to_numpy()
+        changed |= ~(both_missing | (a == b))
+    return changed
+
+
+class RollupStore:
+    """
+    Incremental store of sentiment counts and score sums per (day, subreddit, query, label).
+
+    The store file keeps the key and the current day, subreddit, query, label and score of every ingested
+    record. When a record comes back with a new label (e.g. after an active learning round), its old
+    contribution is taken out of the rollup and the new one is added; unchanged records are skipped.
+    Yearly, quarterly and weekly series are re-aggregations of the small rollup table, so they never
+    re-scan the labelled corpus.
+
+    Parameters:
+    - store_file: Parquet file of the ingested records (the rollup is rebuilt from it on load)
+    - score_column: Column holding the label scores
+    - label_column: Column holding the labels (e.g. "roberta_label")
+    """
+
+    def __init__(self, store_file=DEFAULT_STORE_FILE, score_column="roberta_score", label_column="label"):
+        self.store_file = store_file
+        self.score_column = score_column
+        self.label_column = label_column
+        self.load()
+
+    def load(self):
+        records = pd.read_parquet(self.store_file) if os.path.exists(self.store_file) else None
+        if records is None or "key" not in records:
+            if records is not None:
+                print(f"{self.store_file} is an old rollup store without its records; starting a new store")
+            records = pd.DataFrame({"key": np.empty(0, dtype=np.uint64)}).assign(
+                **{field: pd.Series(dtype=object) for field in RECORD_FIELDS})
+        # Records sorted by key; the rollup is derived from them, so the two can never disagree
+        self.records = records.sort_values("key", ignore_index=True)
+        self.rollup = rollup_records(self.records).sort_values(ROLLUP_KEYS, ignore_index=True)
+        return self
+
+    @property
+    def keys(self):
+        """Sorted keys of the ingested records."""
+        return self.records["key"].to_numpy(dtype=np.uint64)
+
+    def save(self):
+        folder = os.path.dirname(self.store_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        # One file, written to a temporary file first, so that an interrupted save never corrupts the store
+        self.records.to_parquet(f"{self.store_file}.tmp", index=False)
+        os.replace(f"{self.store_file}.tmp", self.store_file)
+
+    def update(self, batch, save=True):
+        """
+        Merge a labelled batch into the rollup: new records are added and re-labelled records replace their
+        previous contribution. Returns the number of records added or changed.
+        """
+        new = record_fields(batch, self.label_column, self.score_column)
+        new.insert(0, "key", record_keys(batch, self.label_column, self.score_column))
+        # The last occurrence of a record in the batch is its current label
+        new = new.drop_duplicates("key", keep="last").sort_values("key", ignore_index=True)
+
+        keys = self.keys
+        positions = np.searchsorted(keys, new["key"].to_numpy(dtype=np.uint64))
+        known = positions < len(keys)
+        known[known] = keys[positions[known]] == new["key"].to_numpy(dtype=np.uint64)[known]
+        old = self.records.iloc[positions[known]].reset_index(drop=True)
+        changed = _changed(old, new[known].reset_index(drop=True))
+        old = old[changed]
+        keep = ~known
+        keep[np.flatnonzero(known)[changed]] = True
+        new = new[keep]
+        if new.empty:
+            return 0
+
+        # Take the previous contribution of re-labelled records out, then add the new one
+        removed = rollup_records(old)
+        removed[ROLLUP_VALUES] = -removed[ROLLUP_VALUES]
+        rollup = pd.concat([frame for frame in [self.rollup, rollup_records(new), removed] if len(frame)],
+                           ignore_index=True)
+        rollup = rollup.groupby(ROLLUP_KEYS, dropna=False, as_index=False)[ROLLUP_VALUES].sum()
+        self.rollup = rollup[rollup["count"] != 0].sort_values(ROLLUP_KEYS, ignore_index=True)
+
+        records = self.records[~self.records["key"].isin(old["key"])]
+        self.records = pd.concat([records, new], ignore_index=True).sort_values("key", ignore_index=True)
+        if save:
+            self.save()
+        return len(new)
+
+    def ingest_csv(self, file_path, chunksize=100000):
+        """Stream a labelled CSV into the store chunk by chunk. Returns the number of records added or changed."""
+        added = 0
+        for chunk in pd.read_csv(file_path, chunksize=chunksize):
+            added += self.update(chunk, save=False)
+        if added:
+            self.save()
+        return added
+
+    def aggregate(self, freq="quarter", by=("label",), start=None, end=None, value="count"):
+        """
+        Re-aggregate the rollup to a coarser period.
+
+        Parameters:
+        - freq: "year", "quarter", "month", "week", "day" (or a pandas period alias)
+        - by: Rollup keys to keep as columns (e.g. ("label",) or ("subreddit", "label"))
+        - start, end: Optional inclusive day range
+        - value: "count" for the number of records, "mean_score" for the mean score
+
+        Returns a DataFrame indexed by period with one column per combination of the `by` keys.
+        """
+        rollup = self.rollup
+        if start is not None:
+            rollup = rollup[rollup["day"] >= pd.Timestamp(start)]
+        if end is not None:
+            rollup = rollup[rollup["day"] <= pd.Timestamp(end)]
+
+        period = pd.to_datetime(rollup["day"]).dt.to_period(FREQUENCIES.get(freq, freq)).rename("period")
+        by = list(by)
+        grouped = rollup.groupby([period] + [rollup[key] for key in by], dropna=False)[ROLLUP_VALUES].sum()
+        if value == "mean_score":
+            result = grouped["score_sum"] / grouped["score_count"].replace(0, np.nan)
+        else:
+            result = grouped["count"]
+        return result.unstack(by) if by else result
+
+    def series(self, freq="quarter", label=None, start=None, end=None):
+        """Number of records per period (optionally only for one label), like value_counts().sort_index()."""
+        rollup_counts = self.aggregate(freq, by=("label",), start=start, end=end)
+        if label is None:
+            return rollup_counts.sum(axis=1).astype(np.int64)
+        if label not in rollup_counts:
+            return pd.Series(dtype=np.int64)
+        return rollup_counts[label].dropna().astype(np.int64)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Update the sentiment-over-time rollup store with labelled data')
+    parser.add_argument('-f', '--file', type=str, action='append', required=True, help='Labelled CSV file (repeatable)')
+    parser.add_argument('-s', '--store', type=str, default=DEFAULT_STORE_FILE, help='Rollup store file')
+    parser.add_argument('--score-column', type=str, default='roberta_score', help='Column holding the label scores')
+    parser.add_argument('--label-column', type=str, default='label', help='Column holding the labels')
+    parser.add_argument('--freq', type=str, default='quarter', help='Period of the printed summary')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    store = RollupStore(args.store, score_column=args.score_column, label_column=args.label_column)
+    for file_path in args.file:
+        added = store.ingest_csv(file_path)
+        print(f"{file_path}: {added:,} new or re-labelled records ingested")
+
+    print("=" * 50)
+    print(f"Rollup rows: {len(store.rollup):,} ({int(store.rollup['count'].sum()):,} records)")
+    print(store.aggregate(args.freq).fillna(0).astype(int))
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()
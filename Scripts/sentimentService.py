@@ -0,0 +1,360 @@
+import os
+import re
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from aiohttp import web
+
+from tracing import span
+
+# Same mapping as label_data() in labelling_active_learning.ipynb
+LABEL2ID = {"positive": 1, "negative": -1, "neutral": 0}
+
+# Fine-tuned models saved by the active learning rounds: Models/round<N>_finetuned_model
+DEFAULT_MODELS_DIR = "Models"
+ROUND_MODEL_RE = re.compile(r"^round(\d+)_finetuned_model$")
+
+# Number of recent requests and batches the latency and batch size percentiles are computed over
+METRICS_WINDOW = 10000
+
+
+def find_round_model(models_dir=DEFAULT_MODELS_DIR, round=None):
+    """Folder of the fine-tuned model of a round (the latest round by default)."""
+    rounds = {}
+    if os.path.isdir(models_dir):
+        for name in os.listdir(models_dir):
+            match = ROUND_MODEL_RE.match(name)
+            if match and os.path.isdir(os.path.join(models_dir, name)):
+                rounds[int(match.group(1))] = os.path.join(models_dir, name)
+    if not rounds:
+        raise FileNotFoundError(f"No round<N>_finetuned_model folder in {models_dir}")
+    if round is None:
+        return rounds[max(rounds)]
+    if round not in rounds:
+        raise FileNotFoundError(f"No model for round {round} in {models_dir} (rounds: {sorted(rounds)})")
+    return rounds[round]
+
+
+class SentimentModel:
+    """
+    A sentiment model kept in memory, scoring batches of texts on CPU as label_data() does.
+
+    Parameters:
+    - model: Model folder (or Hugging Face model name, if it is cached locally)
+    - max_length: Texts are truncated to this many tokens
+    - threads: Number of torch threads (None keeps the torch default)
+    """
+
+    def __init__(self, model, max_length=512, threads=None):
+        # transformers and torch are only needed to serve a real model
+        import torch
+        from transformers import pipeline
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.name = os.path.basename(os.path.normpath(model))
+        self.max_length = max_length
+        self.pipeline = pipeline("text-classification", model=model, tokenizer=model, device=-1)
+
+    def __call__(self, texts):
+        """Score a batch of texts, returning the roberta_label/roberta_score columns of label_data()."""
+        results = self.pipeline(texts, batch_size=len(texts), padding=True, truncation=True,
+                                max_length=self.max_length)
+        return [{"roberta_label": LABEL2ID[res["label"].lower()], "roberta_score": float(res["score"])}
+                for res in results]
+
+
+def load_model(model, max_length=512, threads=None):
+    """A distilled student for a .joblib file (see distillStudent.py), otherwise a SentimentModel."""
+    if model.endswith(".joblib"):
+        from distillStudent import StudentModel
+        student = StudentModel.load(model)
+        student.name = os.path.splitext(os.path.basename(model))[0]
+        return student
+    return SentimentModel(model, max_length=max_length, threads=threads)
+
+
+class Overloaded(Exception):
+    """Raised when the queue of texts waiting to be scored is full."""
+
+
+def _percentiles(values, percentiles=(50, 90, 99)):
+    if not values:
+        return {f"p{p}": None for p in percentiles}
+    result = np.percentile(np.fromiter(values, dtype=np.float64, count=len(values)), percentiles)
+    return {f"p{p}": round(float(value), 3) for p, value in zip(percentiles, result)}
+
+
+class MicroBatcher:
+    """
+    Coalesce the texts of concurrent requests into dynamic micro-batches.
+
+    A batch is scored as soon as it holds max_batch_size texts, or when its oldest text has waited
+    max_wait_ms. While the model scores one batch, the next one fills up, so under load batches grow
+    towards max_batch_size and at low load a request waits at most max_wait_ms. The model runs in a
+    single background thread and the event loop keeps accepting requests meanwhile.
+
+    Parameters:
+    - score_batch: Function scoring a list of texts (e.g. a SentimentModel)
+    - max_batch_size: Maximum number of texts per batch
+    - max_wait_ms: Maximum time the first text of a batch waits for more texts
+    - max_queue: Maximum number of texts waiting to be scored (more are rejected with Overloaded)
+    """
+
+    def __init__(self, score_batch, max_batch_size=32, max_wait_ms=5, max_queue=10000):
+        self.score_batch = score_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.max_queue = max_queue
+        self._pending = deque()
+        self._ready = None
+        self._task = None
+        self._executor = None
+        self._started = time.perf_counter()
+        self._latencies_ms = deque(maxlen=METRICS_WINDOW)
+        self._batch_sizes = deque(maxlen=METRICS_WINDOW)
+        self._batch_ms = deque(maxlen=METRICS_WINDOW)
+        self._counts = {"requests": 0, "texts": 0, "batches": 0, "errors": 0, "rejected": 0}
+
+    async def start(self):
+        self._ready = asyncio.Event()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="scorer")
+        self._task = asyncio.create_task(self._run())
+        self._started = time.perf_counter()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        for _, future, _ in self._pending:
+            future.cancel()
+        self._pending.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def score(self, texts):
+        """Score a list of texts (they may be split over several batches). Returns one result per text."""
+        if len(self._pending) + len(texts) > self.max_queue:
+            self._counts["rejected"] += 1
+            raise Overloaded(f"{len(self._pending)} texts are already waiting to be scored")
+        start = time.perf_counter()
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in texts]
+        self._pending.extend((text, future, start) for text, future in zip(texts, futures))
+        self._ready.set()
+        self._counts["requests"] += 1
+        self._counts["texts"] += len(texts)
+        try:
+            return await asyncio.gather(*futures)
+        finally:
+            self._latencies_ms.append((time.perf_counter() - start) * 1000)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._ready.wait()
+            self._ready.clear()
+            if not self._pending:
+                continue
+            # Wait for more texts until the batch is full or the oldest text reaches its deadline
+            deadline = self._pending[0][2] + self.max_wait
+            while len(self._pending) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._ready.wait(), timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._ready.clear()
+
+            batch = [self._pending.popleft() for _ in range(min(self.max_batch_size, len(self._pending)))]
+            # Texts of requests that were cancelled while waiting are not scored
+            batch = [item for item in batch if not item[1].done()]
+            if self._pending:
+                self._ready.set()
+            if not batch:
+                continue
+
+            start = time.perf_counter()
+            try:
+                with span("service.batch", rows=len(batch)):
+                    results = await loop.run_in_executor(self._executor, self.score_batch,
+                                                         [text for text, _, _ in batch])
+            except Exception as e:
+                self._counts["errors"] += 1
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._batch_ms.append((time.perf_counter() - start) * 1000)
+            self._batch_sizes.append(len(batch))
+            self._counts["batches"] += 1
+            for (_, future, _), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
+
+    def metrics(self):
+        """Counters, p50/p90/p99 request latency and model time (ms) and batch size statistics."""
+        uptime = time.perf_counter() - self._started
+        batch_sizes = list(self._batch_sizes)
+        return {
+            **self._counts,
+            "queue_depth": len(self._pending),
+            "uptime_s": round(uptime, 3),
+            "texts_per_s": round(self._counts["texts"] / uptime, 3) if uptime > 0 else None,
+            "latency_ms": _percentiles(self._latencies_ms),
+            "batch_ms": _percentiles(self._batch_ms),
+            "batch_size": {
+                "mean": round(float(np.mean(batch_sizes)), 3) if batch_sizes else None,
+                **_percentiles(batch_sizes),
+                "max": max(batch_sizes) if batch_sizes else None,
+                "histogram": {str(size): count for size, count in zip(*np.unique(batch_sizes, return_counts=True))
+                              } if batch_sizes else {},
+            },
+        }
+
+
+def _json_response(data, status=200):
+    return web.json_response(data, status=status, dumps=lambda obj: json.dumps(obj, default=int))
+
+
+class SentimentService:
+    """
+    Local HTTP scoring service.
+
+        POST /score    {"texts": ["...", ...]} or {"text": "..."}
+                       -> {"model": ..., "results": [{"roberta_label": 1, "roberta_score": 0.97}, ...]}
+        GET  /metrics  request latency, batch size and model time percentiles
+        GET  /health   {"status": "ok", "model": ...}
+
+    Parameters:
+    - batcher: MicroBatcher scoring the texts
+    - model_name: Model name reported in the responses
+    - host, port: Address to listen on (port 0 picks a free port)
+    - max_texts: Maximum number of texts per request
+    """
+
+    def __init__(self, batcher, model_name="model", host="127.0.0.1", port=8000, max_texts=1000):
+        self.batcher = batcher
+        self.model_name = model_name
+        self.host = host
+        self.port = port
+        self.max_texts = max_texts
+        self.url = None
+        self._runner = None
+
+    def app(self):
+        app = web.Application()
+        app.router.add_post("/score", self._score)
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_get("/health", self._health)
+        return app
+
+    async def start(self):
+        await self.batcher.start()
+        self._runner = web.AppRunner(self.app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{self.host}:{self.port}"
+        return self.url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+        await self.batcher.stop()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def _score(self, request):
+        try:
+            body = await request.json()
+        except ValueError:
+            return _json_response({"error": "The body must be JSON"}, status=400)
+        texts = body.get("texts", [body["text"]] if "text" in body else None) if isinstance(body, dict) else None
+        if not isinstance(texts, list) or not all(isinstance(text, str) for text in texts):
+            return _json_response({"error": 'Expected {"texts": [strings]} or {"text": string}'}, status=400)
+        if len(texts) > self.max_texts:
+            return _json_response({"error": f"At most {self.max_texts} texts per request"}, status=413)
+        try:
+            results = await self.batcher.score(texts)
+        except Overloaded as e:
+            return _json_response({"error": str(e)}, status=503)
+        except Exception as e:
+            return _json_response({"error": f"{type(e).__name__}: {e}"}, status=500)
+        return _json_response({"model": self.model_name, "results": results})
+
+    async def _metrics(self, request):
+        return _json_response({"model": self.model_name, **self.batcher.metrics()})
+
+    async def _health(self, request):
+        return _json_response({"status": "ok", "model": self.model_name})
+
+
+async def _serve(service):
+    async with service:
+        print(f"Scoring service ({service.model_name}) listening on {service.url}")
+        print(f"POST {service.url}/score, metrics at {service.url}/metrics")
+        try:
+            await asyncio.Event().wait()
+        finally:
+            print("=" * 50)
+            print(json.dumps(service.batcher.metrics(), indent=4, default=int))
+            print("=" * 50)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Local sentiment scoring service with dynamic micro-batching')
+    parser.add_argument('-m', '--model', type=str, default=None,
+                        help='Model folder or distilled student .joblib (default: the latest round in --models-dir)')
+    parser.add_argument('-r', '--round', type=int, default=None, help='Serve the fine-tuned model of this round')
+    parser.add_argument('--models-dir', type=str, default=DEFAULT_MODELS_DIR, help='Folder of the round models')
+    parser.add_argument('-b', '--batch-size', type=int, default=32, help='Maximum texts per batch')
+    parser.add_argument('-w', '--max-wait-ms', type=float, default=5, help='Maximum time a text waits for a batch')
+    parser.add_argument('--max-queue', type=int, default=10000, help='Maximum texts waiting to be scored')
+    parser.add_argument('--max-length', type=int, default=512, help='Maximum tokens per text')
+    parser.add_argument('--threads', type=int, default=None, help='Number of torch threads')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='Address to listen on')
+    parser.add_argument('-p', '--port', type=int, default=8000, help='Port to listen on')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    model_folder = args.model or find_round_model(args.models_dir, args.round)
+    print(f"Loading {model_folder}...")
+    model = load_model(model_folder, max_length=args.max_length, threads=args.threads)
+    # One call before serving, so that the first request does not pay for lazy initialisation
+    model(["warm up"])
+    batcher = MicroBatcher(model, max_batch_size=args.batch_size, max_wait_ms=args.max_wait_ms,
+                           max_queue=args.max_queue)
+    service = SentimentService(batcher, model_name=model.name, host=args.host, port=args.port)
+    try:
+        asyncio.run(_serve(service))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,168 @@
+import os
+import json
+import sqlite3
+import hashlib
+import argparse
+
+import pandas as pd
+import spacy
+
+# Default location of the on-disk token cache (relative to the working directory)
+DEFAULT_CACHE_FILE = os.path.join(".cache", "spacy_tokens.sqlite")
+
+# Pipeline components that are never used by the custom tokenizer.
+# NER is always kept; the lemmatizer of en_core_web_sm also needs tok2vec, tagger and attribute_ruler.
+UNUSED_COMPONENTS = ["parser", "senter"]
+LEMMATIZER_COMPONENTS = ["tagger", "attribute_ruler", "lemmatizer"]
+
+# Loaded pipelines, one per (model, lemmatize) pair
+_NLP = {}
+
+
+def load_nlp(model="en_core_web_sm", lemmatize=True):
+    """Load a spaCy pipeline with only the components the tokenizer needs."""
+    if (model, lemmatize) not in _NLP:
+        disable = UNUSED_COMPONENTS if lemmatize else UNUSED_COMPONENTS + LEMMATIZER_COMPONENTS
+        _NLP[(model, lemmatize)] = spacy.load(model, disable=disable)
+    return _NLP[(model, lemmatize)]
+
+
+def doc_to_tokens(doc, lemmatize=True):
+    """Named entities first, then the (lemmatised) non-entity tokens, as in the original custom_tokenizer."""
+    tokens = [ent.text for ent in doc.ents]
+    if lemmatize:
+        tokens.extend(token.lemma_.lower() for token in doc
+                      if not token.ent_type_ and not token.is_punct and not token.is_space)
+    else:
+        tokens.extend(token.text for token in doc
+                      if not token.ent_type_ and not token.is_punct and not token.is_space)
+    return tokens
+
+
+class TokenCache:
+    """Persistent text-hash -> tokens cache stored in a SQLite file."""
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE):
+        self.cache_file = cache_file
+        folder = os.path.dirname(cache_file)
+        if folder:
+            os.makedirs(folder, exist_ok=True)
+        self.connection = sqlite3.connect(cache_file)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS tokens (key TEXT PRIMARY KEY, tokens TEXT)")
+
+    def get_many(self, keys):
+        """Return a dict of the cached tokens for the given keys."""
+        found = {}
+        keys = list(keys)
+        # SQLite limits the number of query parameters, so look keys up in batches
+        for start in range(0, len(keys), 900):
+            batch = keys[start:start + 900]
+            placeholders = ",".join("?" * len(batch))
+            rows = self.connection.execute(f"SELECT key, tokens FROM tokens WHERE key IN ({placeholders})", batch)
+            for key, tokens in rows:
+                found[key] = json.loads(tokens)
+        return found
+
+    def put_many(self, items):
+        """Store (key, tokens) pairs."""
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO tokens (key, tokens) VALUES (?, ?)",
+                ((key, json.dumps(tokens)) for key, tokens in items)
+            )
+
+    def close(self):
+        self.connection.close()
+
+
+class CachedTokenizer:
+    """
+    Callable spaCy tokenizer for TfidfVectorizer(tokenizer=...) that never parses the same text twice.
+
+    Call prefetch() with the whole corpus before fitting: it parses all uncached texts with nlp.pipe
+    in batches (and n_process workers), so that the per-text calls made by the vectorizer are lookups.
+
+    Parameters:
+    - model: spaCy model name
+    - lemmatize: Return lemmas of non-entity tokens (False returns the token text)
+    - batch_size: Number of texts per nlp.pipe batch
+    - n_process: Number of processes used by nlp.pipe
+    - cache_file: SQLite file for the persistent cache (None keeps the cache in memory only)
+    """
+
+    def __init__(self, model="en_core_web_sm", lemmatize=True, batch_size=1000, n_process=1,
+                 cache_file=DEFAULT_CACHE_FILE):
+        self.model = model
+        self.lemmatize = lemmatize
+        self.batch_size = batch_size
+        self.n_process = n_process
+        self.cache_file = cache_file
+        self._tokens = {}
+        self._cache = None
+
+    def __getstate__(self):
+        # The SQLite connection cannot be pickled (e.g. by GridSearchCV with n_jobs > 1)
+        state = self.__dict__.copy()
+        state["_cache"] = None
+        return state
+
+    def _key(self, text):
+        return hashlib.blake2b(f"{self.model}|{self.lemmatize}|{text}".encode("utf-8"), digest_size=16).hexdigest()
+
+    def _disk_cache(self):
+        if self._cache is None and self.cache_file:
+            self._cache = TokenCache(self.cache_file)
+        return self._cache
+
+    def prefetch(self, texts):
+        """Tokenize every text that is not cached yet, in batches."""
+        keys = {}
+        for text in texts:
+            if isinstance(text, str):
+                key = self._key(text)
+                if key not in self._tokens:
+                    keys[key] = text
+        if not keys:
+            return self
+
+        # Look the remaining texts up in the persistent cache
+        cache = self._disk_cache()
+        if cache is not None:
+            self._tokens.update(cache.get_many(keys))
+        missing = [(key, text) for key, text in keys.items() if key not in self._tokens]
+
+        # Parse the rest with the reduced pipeline
+        if missing:
+            nlp = load_nlp(self.model, self.lemmatize)
+            docs = nlp.pipe((text for _, text in missing), batch_size=self.batch_size, n_process=self.n_process)
+            parsed = [(key, doc_to_tokens(doc, self.lemmatize)) for (key, _), doc in zip(missing, docs)]
+            self._tokens.update(parsed)
+            if cache is not None:
+                cache.put_many(parsed)
+        return self
+
+    def __call__(self, text):
+        key = self._key(text)
+        if key not in self._tokens:
+            self.prefetch([text])
+        return self._tokens[key]
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Pre-populate the spaCy token cache for a CSV column')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Path to the CSV file')
+    parser.add_argument('-c', '--column', type=str, default='Cleaned Text', help='Column to tokenize')
+    parser.add_argument('-n', '--n-process', type=int, default=1, help='Number of spaCy processes')
+    parser.add_argument('--no-lemma', action='store_true', help='Cache token text instead of lemmas')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    texts = pd.read_csv(args.file, engine='pyarrow')[args.column].dropna().astype(str)
+    tokenizer = CachedTokenizer(lemmatize=not args.no_lemma, n_process=args.n_process)
+    tokenizer.prefetch(texts)
+    print(f"Token cache ready for {texts.nunique():,} unique texts in {tokenizer.cache_file}")
+
+if __name__ == "__main__":
+    main()
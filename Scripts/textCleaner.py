@@ -0,0 +1,240 @@
+import os
+import re
+import string
+import hashlib
+import argparse
+from multiprocessing import Pool
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.feather as feather
+import contractions
+import emoji
+from sklearn.feature_extraction.text import ENGLISH_STOP_WORDS
+
+# Bump this whenever a cleaning rule changes, so that cached chunks are not reused
+CLEANER_VERSION = "2"
+
+# Default cache location for cleaned chunks (relative to the working directory)
+DEFAULT_CACHE_DIR = os.path.join(".cache", "cleaned_text")
+
+# ======== PATTERNS ========
+# Links and user mentions are removed in a single pass
+LINKS_AND_MENTIONS = r'http[s]?://\S+|www\.\S+|u/\S+'
+LINKS = r'http[s]?://\S+|www\.\S+'
+USER_MENTIONS = r'u/\S+'
+NON_ASCII = r'[^\x00-\x7F]+'
+PUNCTUATION_BETWEEN_WORDS = r'(\S)[' + re.escape(string.punctuation) + r'](\S)'
+PUNCTUATION_AFTER_WORD = r'(\S)[' + re.escape(string.punctuation) + r']+'
+PUNCTUATION = r'[' + re.escape(string.punctuation) + r']'
+NUMBERS = r'[0-9]+'
+
+# Stopwords removed by the data selection notebook (before the spaCy tokenizer)
+STOPWORDS = frozenset(ENGLISH_STOP_WORDS)
+
+# ======== CLEANING STEPS ========
+# Steps run as Arrow compute kernels over a whole chunk
+ARROW_STEPS = {
+    "lower": pc.utf8_lower,
+    # str.rstrip(" none") of vectorisationAndSimilarity: strips any trailing " ", "n", "o" or "e"
+    "strip_none": lambda array: pc.utf8_rtrim(array, characters=" none"),
+    "subreddits": lambda array: pc.replace_substring(array, 'r/', ''),
+    "new_lines": lambda array: pc.replace_substring(array, '\n\n', ' '),
+    "links_and_mentions": lambda array: pc.replace_substring_regex(array, LINKS_AND_MENTIONS, ''),
+    "links": lambda array: pc.replace_substring_regex(array, LINKS, ''),
+    "user_mentions": lambda array: pc.replace_substring_regex(array, USER_MENTIONS, ''),
+    "non_ascii": lambda array: pc.replace_substring_regex(array, NON_ASCII, ''),
+    # Hyphens become spaces, punctuation between two words becomes a space, the rest is removed
+    "punctuation": lambda array: pc.replace_substring_regex(
+        pc.replace_substring_regex(pc.replace_substring(array, '-', ' '), PUNCTUATION_BETWEEN_WORDS, r'\1 \2'),
+        PUNCTUATION, ''
+    ),
+    # TextPreprocessor only splits words on punctuation (the tokenizer drops what is left)
+    "punctuation_spacing": lambda array: pc.replace_substring_regex(
+        pc.replace_substring(array, '-', ' '), PUNCTUATION_BETWEEN_WORDS, r'\1 \2'
+    ),
+    # topicModelling also turns trailing runs of punctuation into a space
+    "punctuation_runs": lambda array: pc.replace_substring_regex(
+        pc.replace_substring_regex(pc.replace_substring(array, '-', ' '), PUNCTUATION_AFTER_WORD, r'\1 '),
+        PUNCTUATION_BETWEEN_WORDS, r'\1 \2'
+    ),
+    "numbers": lambda array: pc.replace_substring_regex(array, NUMBERS, ''),
+}
+
+
+def demojize(text):
+    """Convert emojis to their descriptive names (plain ASCII text cannot contain emojis)."""
+    return text if text.isascii() else emoji.demojize(text)
+
+
+def remove_stopwords(text):
+    """Drop English stopwords, splitting on whitespace."""
+    return ' '.join(word for word in text.split() if word.lower() not in STOPWORDS)
+
+
+# Steps only available as Python functions (applied text by text)
+PYTHON_STEPS = {
+    "contractions": contractions.fix,
+    "emojis": demojize,
+    "stopwords": remove_stopwords,
+}
+
+# Steps skipped with remove_punctuation=False / convert_emojis=False
+PUNCTUATION_STEPS = ("punctuation", "punctuation_spacing", "punctuation_runs")
+EMOJI_STEPS = ("emojis",)
+
+# ======== PROFILES ========
+# Each profile reproduces the cleaning of one notebook, in its original step order.
+# "default" is the unified cleaning used by the Scripts (dataPipeline, distillStudent, onlineTopics).
+PROFILES = {
+    "default": ["lower", "subreddits", "new_lines", "links_and_mentions", "contractions", "emojis",
+                "non_ascii", "punctuation", "numbers"],
+    # Notebooks/Experimental/vectorisationAndSimilarity.ipynb
+    "vectorisation": ["lower", "strip_none", "subreddits", "new_lines", "links", "user_mentions",
+                      "contractions", "emojis", "non_ascii", "punctuation", "numbers"],
+    # Notebooks/Experimental/data_selection_tfidf.ipynb (keeps non-ASCII characters and numbers)
+    "data_selection": ["lower", "subreddits", "new_lines", "links", "user_mentions", "contractions",
+                       "stopwords", "punctuation", "emojis"],
+    # TextPreprocessor of Notebooks/partCpipieline.ipynb (lowercases last, so emojis are already removed)
+    "text_preprocessor": ["links", "user_mentions", "contractions", "non_ascii", "punctuation_spacing",
+                          "numbers", "emojis", "lower"],
+    # TextPreprocessor of Notebooks/topicModelling.ipynb
+    "topic_modelling": ["lower", "links", "user_mentions", "contractions", "non_ascii", "punctuation_runs",
+                        "numbers", "emojis", "lower"],
+}
+
+
+def profile_steps(profile="default", remove_punctuation=True, convert_emojis=True):
+    """Steps of a cleaning profile, without the punctuation and emoji steps if they are disabled."""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown cleaning profile {profile!r}, expected one of {sorted(PROFILES)}")
+    skipped = (() if remove_punctuation else PUNCTUATION_STEPS) + (() if convert_emojis else EMOJI_STEPS)
+    return [step for step in PROFILES[profile] if step not in skipped]
+
+
+def clean_array(array, steps):
+    """Clean an Arrow string array, fusing consecutive Python steps into a single pass."""
+    i = 0
+    while i < len(steps):
+        if steps[i] in ARROW_STEPS:
+            array = ARROW_STEPS[steps[i]](array)
+            i += 1
+            continue
+        functions = []
+        while i < len(steps) and steps[i] in PYTHON_STEPS:
+            functions.append(PYTHON_STEPS[steps[i]])
+            i += 1
+        texts = array.to_pylist()
+        for function in functions:
+            texts = [None if text is None else function(text) for text in texts]
+        array = pa.array(texts, type=pa.string())
+    return array
+
+
+def clean_text(text, remove_punctuation=True, convert_emojis=True, profile="default"):
+    """Clean a single text (None is returned as None)."""
+    if text is None:
+        return None
+    steps = profile_steps(profile, remove_punctuation, convert_emojis)
+    return clean_array(pa.array([text], type=pa.string()), steps)[0].as_py()
+
+
+def _clean_chunk(args):
+    """Worker: clean one chunk, reading/writing the on-disk cache if enabled."""
+    array, key, cache_dir, steps = args
+
+    if cache_dir:
+        cache_file = os.path.join(cache_dir, f"{key}.arrow")
+        if os.path.exists(cache_file):
+            return feather.read_table(cache_file, memory_map=True).column("cleaned").combine_chunks()
+
+    cleaned = clean_array(array, steps)
+
+    if cache_dir:
+        # Write to a temporary file first so that a crashed worker never leaves a partial cache entry
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        feather.write_feather(pa.table({"cleaned": cleaned}), tmp_file)
+        os.replace(tmp_file, cache_file)
+    return cleaned
+
+
+def _chunk_key(chunk, steps):
+    """Content hash of a chunk of texts plus the cleaning steps."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(f"{CLEANER_VERSION}|{','.join(steps)}|".encode())
+    hasher.update(pd.util.hash_pandas_object(chunk, index=False).values.tobytes())
+    return hasher.hexdigest()
+
+
+def clean_series(texts, remove_punctuation=True, convert_emojis=True, profile="default",
+                 n_jobs=None, chunk_size=50000, cache_dir=DEFAULT_CACHE_DIR):
+    """
+    Clean a Series of texts in parallel and return the "Cleaned Text" Series.
+
+    Parameters:
+    - texts: Series of raw texts (nulls are returned as None)
+    - remove_punctuation: Remove punctuation (False keeps it, as in TextPreprocessorNoPunct)
+    - convert_emojis: Convert emojis to their descriptive names
+    - profile: Cleaning steps to apply (a key of PROFILES, one per notebook)
+    - n_jobs: Number of worker processes (None uses all CPUs, 1 runs in-process)
+    - chunk_size: Number of texts per chunk (the unit of parallelism and caching)
+    - cache_dir: Folder for cached chunks (None disables the cache)
+    """
+    texts = pd.Series(texts)
+    steps = profile_steps(profile, remove_punctuation, convert_emojis)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+
+    # Split into chunks of Arrow string arrays, keyed by their content
+    tasks = []
+    for start in range(0, len(texts), chunk_size):
+        chunk = texts.iloc[start:start + chunk_size]
+        chunk = chunk.where(chunk.isna(), chunk.astype(str))
+        key = _chunk_key(chunk, steps)
+        array = pa.array(chunk.tolist(), type=pa.string(), from_pandas=True)
+        tasks.append((array, key, cache_dir, steps))
+
+    if n_jobs == 1 or len(tasks) <= 1:
+        results = [_clean_chunk(task) for task in tasks]
+    else:
+        with Pool(processes=n_jobs) as pool:
+            results = pool.map(_clean_chunk, tasks)
+
+    cleaned = pa.chunked_array(results, type=pa.string()) if results else pa.chunked_array([], type=pa.string())
+    return pd.Series(cleaned.to_numpy(zero_copy_only=False), index=texts.index, dtype=object, name="Cleaned Text")
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Add a "Cleaned Text" column to a CSV file')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Path to the input CSV file')
+    parser.add_argument('-o', '--output', type=str, help='Path to the output CSV file (defaults to <file>_cleaned.csv)')
+    parser.add_argument('-c', '--column', type=str, default='text', help='Column containing the raw text')
+    parser.add_argument('-j', '--jobs', type=int, default=None, help='Number of worker processes')
+    parser.add_argument('-p', '--profile', type=str, default='default', choices=sorted(PROFILES),
+                        help='Cleaning steps to apply (one profile per notebook)')
+    parser.add_argument('--keep-punctuation', action='store_true', help='Do not remove punctuation')
+    parser.add_argument('--no-cache', action='store_true', help='Disable the cleaned chunk cache')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    output_csv = args.output or f"{os.path.splitext(args.file)[0]}_cleaned.csv"
+    if os.path.abspath(output_csv) == os.path.abspath(args.file):
+        raise ValueError(f"The cleaned output would overwrite the input file {args.file}")
+
+    df = pd.read_csv(args.file, engine='pyarrow')
+    df["Cleaned Text"] = clean_series(
+        df[args.column],
+        remove_punctuation=not args.keep_punctuation,
+        profile=args.profile,
+        n_jobs=args.jobs,
+        cache_dir=None if args.no_cache else DEFAULT_CACHE_DIR
+    )
+
+    df.to_csv(output_csv, index=False)
+    print(f"Cleaned {len(df):,} records and saved to {output_csv}")
+
+if __name__ == "__main__":
+    main()
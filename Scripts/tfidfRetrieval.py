@@ -0,0 +1,154 @@
+import argparse
+
+import numpy as np
+import pandas as pd
+import scipy.sparse as sp
+from sklearn.feature_extraction.text import HashingVectorizer
+from sklearn.preprocessing import normalize
+
+
+class StreamingTfidf:
+    """
+    TF-IDF over a hashed feature space that never builds a dense matrix or a fitted vocabulary.
+
+    HashingVectorizer needs no vocabulary, so document frequencies can be accumulated chunk by
+    chunk with partial_fit and new batches of documents reuse the same feature space.
+
+    Parameters:
+    - n_features: Size of the hashed feature space
+    - tokenizer: Custom tokenizer (e.g. spacyTokenizer.CachedTokenizer), None uses the default token pattern
+    - stop_words: Stop words removed before hashing
+    - min_df: Ignore features appearing in fewer documents than this (applied at transform time)
+    - ngram_range: N-gram range, as in TfidfVectorizer
+    """
+
+    def __init__(self, n_features=2 ** 20, tokenizer=None, stop_words="english", min_df=1, ngram_range=(1, 1)):
+        self.n_features = n_features
+        self.min_df = min_df
+        self.vectorizer = HashingVectorizer(
+            n_features=n_features,
+            tokenizer=tokenizer,
+            token_pattern=None if tokenizer else r"(?u)\b\w\w+\b",
+            stop_words=stop_words,
+            ngram_range=ngram_range,
+            alternate_sign=False,
+            norm=None,
+            dtype=np.float32
+        )
+        self.document_frequency_ = np.zeros(n_features, dtype=np.int64)
+        self.n_documents_ = 0
+
+    def partial_fit(self, texts):
+        """Add the document frequencies of a batch of texts."""
+        counts = self.vectorizer.transform(texts)
+        self.document_frequency_ += np.bincount(counts.indices, minlength=self.n_features)
+        self.n_documents_ += counts.shape[0]
+        return self
+
+    def idf(self):
+        """Smoothed idf, identical to TfidfVectorizer(smooth_idf=True)."""
+        return (np.log((1 + self.n_documents_) / (1 + self.document_frequency_)) + 1).astype(np.float32)
+
+    def transform(self, texts, use_idf=False):
+        """Return L2-normalised (tf or tf-idf) CSR vectors for a batch of texts."""
+        X = self.vectorizer.transform(texts).tocsr()
+        scale = np.ones(self.n_features, dtype=np.float32)
+        if use_idf:
+            scale *= self.idf()
+        if self.min_df > 1:
+            scale *= self.document_frequency_ >= self.min_df
+        if use_idf or self.min_df > 1:
+            X = (X @ sp.diags(scale)).tocsr()
+            X.eliminate_zeros()
+        return normalize(X, norm="l2", copy=False)
+
+
+def merge_top_k(best_scores, best_ids, scores, ids, k):
+    """Merge a block of candidate scores into the running top-k (per row) using argpartition."""
+    scores = np.hstack([best_scores, scores])
+    ids = np.hstack([best_ids, ids])
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores = np.take_along_axis(scores, top, axis=1)
+        ids = np.take_along_axis(ids, top, axis=1)
+    return scores, ids
+
+
+def top_k_per_query(query_vectors, document_blocks, k=100):
+    """
+    Keep the k most similar documents for every query, scoring the documents block by block.
+
+    Parameters:
+    - query_vectors: CSR matrix of L2-normalised query vectors
+    - document_blocks: Iterable of CSR blocks of L2-normalised document vectors (rows in corpus order)
+    - k: Number of documents to keep per query
+
+    Returns (scores, ids) arrays of shape (n_queries, k), sorted by descending similarity.
+    """
+    n_queries = query_vectors.shape[0]
+    best_scores = np.empty((n_queries, 0), dtype=np.float32)
+    best_ids = np.empty((n_queries, 0), dtype=np.int64)
+    offset = 0
+
+    for block in document_blocks:
+        # Cosine similarity of normalised vectors is a sparse dot product; only (queries x block) is dense
+        scores = (query_vectors @ block.T).toarray()
+        ids = np.broadcast_to(np.arange(offset, offset + block.shape[0]), scores.shape)
+        best_scores, best_ids = merge_top_k(best_scores, best_ids, scores, ids, k)
+        offset += block.shape[0]
+
+    order = np.argsort(-best_scores, axis=1, kind="stable")
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+def search_csv(file_path, queries, column="Cleaned Text", top_k=3000, chunksize=50000, tokenizer=None, min_df=5):
+    """
+    Stream a CSV twice and return its top_k rows most similar to any of the queries.
+
+    Pass 1 accumulates document frequencies; pass 2 scores each chunk (tf vectors for documents,
+    tf-idf vectors for the queries, as in the TF-IDF notebooks) and keeps only the best rows.
+    """
+    model = StreamingTfidf(tokenizer=tokenizer, min_df=min_df)
+
+    # Pass 1: document frequencies
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        model.partial_fit(chunk[column].fillna("").astype(str))
+
+    query_vectors = model.transform(queries, use_idf=True)
+
+    # Pass 2: score each chunk and keep the best rows so far
+    best_rows = None
+    for chunk in pd.read_csv(file_path, chunksize=chunksize):
+        document_vectors = model.transform(chunk[column].fillna("").astype(str))
+        # A record's similarity is its best similarity over all the queries
+        similarity = (query_vectors @ document_vectors.T).max(axis=0).toarray().ravel()
+        if len(chunk) > top_k:
+            keep = np.argpartition(-similarity, top_k - 1)[:top_k]
+            chunk, similarity = chunk.iloc[keep], similarity[keep]
+        chunk = chunk.assign(similarity=similarity)
+        best_rows = chunk if best_rows is None else pd.concat([best_rows, chunk]).nlargest(top_k, "similarity")
+
+    if best_rows is None:
+        return pd.DataFrame()
+    return best_rows.sort_values(by="similarity", ascending=False)
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Select the records most similar to a query with streaming TF-IDF')
+    parser.add_argument('-f', '--file', type=str, required=True, help='Path to the CSV file')
+    parser.add_argument('-q', '--query', type=str, action='append', required=True, help='Query text (repeatable)')
+    parser.add_argument('-c', '--column', type=str, default='Cleaned Text', help='Column to search')
+    parser.add_argument('-k', '--top-k', type=int, default=3000, help='Number of records to keep')
+    parser.add_argument('--min-df', type=int, default=5, help='Ignore terms appearing in fewer documents')
+    parser.add_argument('-o', '--output', type=str, default='similarity_scores.csv', help='Output CSV file')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    selected = search_csv(args.file, args.query, column=args.column, top_k=args.top_k, min_df=args.min_df)
+    selected.to_csv(args.output, index=False)
+    print(f"Saved {len(selected):,} records to {args.output}")
+
+if __name__ == "__main__":
+    main()
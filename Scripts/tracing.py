@@ -0,0 +1,232 @@
+import os
+import json
+import time
+import atexit
+import asyncio
+import functools
+import threading
+import contextvars
+from collections import defaultdict
+
+# Set TRACE_FILE=<path> to record spans and write them when the process exits:
+# *.json is written as a Chrome trace (chrome://tracing, Perfetto), anything else as folded stacks
+# (flamegraph.pl, speedscope). Tracing is disabled otherwise.
+TRACE_ENV_VAR = "TRACE_FILE"
+
+_enabled = False
+_trace_file = None
+_events = []
+_start_ns = time.perf_counter_ns()
+
+# Current span path, per thread and per asyncio task
+_current = contextvars.ContextVar("current_span", default=None)
+
+
+class _NoopSpan:
+    """Returned by span() when tracing is disabled, so that instrumented code costs one flag check."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def add(self, rows=0, bytes=0):
+        pass
+
+    def set(self, **attrs):
+        pass
+
+
+_NOOP = _NoopSpan()
+
+
+def _covered_ns(intervals, start, end):
+    """Time between start and end covered by at least one of the (start, end) intervals."""
+    covered, reach = 0, start
+    for child_start, child_end in sorted(intervals):
+        child_start, child_end = max(child_start, reach), min(child_end, end)
+        if child_end > child_start:
+            covered += child_end - child_start
+            reach = child_end
+    return covered
+
+
+class Span:
+    """
+    A timed section of code with wall/CPU time, row and byte counters and free-form attributes.
+
+    Self time is the wall time not covered by any child span. Children running at the same time
+    (asyncio tasks or threads that inherit the span) are counted once, so it is never negative.
+    """
+
+    __slots__ = ("name", "path", "rows", "bytes", "attrs", "start", "cpu_start", "children", "parent", "token")
+
+    def __init__(self, name, rows=0, bytes=0, attrs=None):
+        self.name = name
+        self.rows = rows
+        self.bytes = bytes
+        self.attrs = attrs or {}
+        self.children = []
+
+    def __enter__(self):
+        self.parent = _current.get()
+        self.path = f"{self.parent.path};{self.name}" if self.parent else self.name
+        self.token = _current.set(self)
+        self.cpu_start = time.thread_time_ns()
+        self.start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        end = time.perf_counter_ns()
+        cpu = time.thread_time_ns() - self.cpu_start
+        _current.reset(self.token)
+        duration = end - self.start
+        if self.parent is not None:
+            # list.append is atomic, so children in other threads can report without a lock
+            self.parent.children.append((self.start, end))
+        self_ns = duration - _covered_ns(list(self.children), self.start, end)
+        if exc_type is not None:
+            self.attrs["error"] = exc_type.__name__
+        # list.append is atomic, so spans from several threads can be recorded without a lock
+        _events.append((self.name, self.path, self.start, duration, self_ns, cpu,
+                        self.rows, self.bytes, self.attrs, os.getpid(), threading.get_ident()))
+        return False
+
+    def add(self, rows=0, bytes=0):
+        """Add to the row and byte counters of the span."""
+        self.rows += rows
+        self.bytes += bytes
+
+    def set(self, **attrs):
+        """Attach attributes to the span."""
+        self.attrs.update(attrs)
+
+
+def span(name, rows=0, bytes=0, **attrs):
+    """
+    Context manager timing a section of code:
+
+        with span("save_data", rows=len(posts)) as s:
+            ...
+            s.add(bytes=os.path.getsize(csv_file))
+
+    Note: CPU time is the CPU time of the current thread, so in coroutines it also counts
+    other tasks that ran on the event loop while the span was open.
+    """
+    if not _enabled:
+        return _NOOP
+    return Span(name, rows, bytes, attrs)
+
+
+def traced(name=None):
+    """Decorator wrapping every call of a function (or coroutine function) in a span."""
+    def decorator(func):
+        span_name = name or func.__qualname__
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                if not _enabled:
+                    return await func(*args, **kwargs)
+                with Span(span_name):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with Span(span_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def enable(trace_file=None):
+    """Start recording spans (and write them to trace_file when the process exits)."""
+    global _enabled, _trace_file
+    _enabled = True
+    if trace_file and _trace_file is None:
+        atexit.register(_write_at_exit)
+    _trace_file = trace_file or _trace_file
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    """Forget the recorded spans."""
+    _events.clear()
+
+
+def export_chrome_trace(path):
+    """Write the spans as Chrome trace "complete" events (open with chrome://tracing or ui.perfetto.dev)."""
+    events = []
+    for name, _, start, duration, _, cpu, rows, bytes_, attrs, pid, tid in list(_events):
+        args = {"cpu_ms": cpu / 1e6, **attrs}
+        if rows:
+            args["rows"] = rows
+        if bytes_:
+            args["bytes"] = bytes_
+        events.append({"name": name, "ph": "X", "ts": (start - _start_ns) / 1e3, "dur": duration / 1e3,
+                       "pid": pid, "tid": tid, "args": args})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+
+def export_folded(path):
+    """Write folded stacks ("a;b;c <self time in microseconds>") for flamegraph.pl or speedscope."""
+    totals = defaultdict(int)
+    for _, stack, _, _, self_ns, *_ in list(_events):
+        totals[stack] += self_ns
+    with open(path, "w") as f:
+        for stack, self_ns in sorted(totals.items()):
+            f.write(f"{stack} {self_ns // 1000}\n")
+
+
+def export(path):
+    """Write the spans to path, as a Chrome trace for .json files and as folded stacks otherwise."""
+    if path.endswith(".json"):
+        export_chrome_trace(path)
+    else:
+        export_folded(path)
+
+
+def summary():
+    """Per-span-name totals: calls, wall time, CPU time, rows and bytes."""
+    totals = defaultdict(lambda: [0, 0, 0, 0, 0])
+    for name, _, _, duration, _, cpu, rows, bytes_, *_ in list(_events):
+        total = totals[name]
+        total[0] += 1
+        total[1] += duration
+        total[2] += cpu
+        total[3] += rows
+        total[4] += bytes_
+    return {name: {"calls": calls, "wall_s": wall / 1e9, "cpu_s": cpu / 1e9, "rows": rows, "bytes": bytes_}
+            for name, (calls, wall, cpu, rows, bytes_) in totals.items()}
+
+
+def print_summary():
+    print("=" * 50)
+    print(f"{'span':<32} {'calls':>7} {'wall (s)':>10} {'cpu (s)':>10} {'rows':>10} {'MB':>9}")
+    for name, total in sorted(summary().items(), key=lambda item: -item[1]["wall_s"]):
+        print(f"{name:<32} {total['calls']:>7} {total['wall_s']:>10.3f} {total['cpu_s']:>10.3f} "
+              f"{total['rows']:>10,} {total['bytes'] / 1e6:>9.2f}")
+    print("=" * 50)
+
+
+def _write_at_exit():
+    if _trace_file and _events:
+        export(_trace_file)
+        print(f"Trace written to {_trace_file}")
+
+
+if os.getenv(TRACE_ENV_VAR):
+    enable(os.getenv(TRACE_ENV_VAR))
@@ -0,0 +1,287 @@
+import os
+import json
+import hashlib
+import argparse
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from distillStudent import MANUAL_ROUND_RE, IRRELEVANT_LABEL
+
+# Default location of the training store (relative to the working directory)
+DEFAULT_STORE_DIR = os.path.join(".cache", "training_store")
+
+# Manual labels -> model label ids, as in process_manual_data() (0 -> negative, 1 -> neutral, 2 -> positive)
+MODEL_LABEL2ID = {-1: 0, 0: 1, 1: 2}
+
+# Name of the validation part of the store
+VAL_PART = "val"
+
+# Label of the rows marked irrelevant (2) or left unlabelled: they are stored, so that their text still
+# overrides the labels of earlier rounds, but never trained on
+EXCLUDED_LABEL = -1
+
+# Version of the rows files (parts written by an older version are re-read)
+ROWS_VERSION = 2
+
+# Texts tokenised per record batch
+TOKENIZE_BATCH = 1000
+
+# Read size used when hashing source files
+HASH_BLOCK_SIZE = 1 << 20
+
+ROWS_SCHEMA = pa.schema([("text", pa.string()), ("labels", pa.int64())])
+TOKENS_SCHEMA = pa.schema([("labels", pa.int64()), ("input_ids", pa.list_(pa.int32())),
+                           ("attention_mask", pa.list_(pa.int8()))])
+
+
+def file_hash(path):
+    hasher = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def tokenizer_fingerprint(tokenizer, max_length):
+    """Hash of everything that changes the ids of a tokenizer: its class, vocabulary and rules, special tokens and max_length."""
+    hasher = hashlib.blake2b(digest_size=16)
+    hasher.update(type(tokenizer).__name__.encode())
+    if hasattr(tokenizer, "backend_tokenizer"):
+        # Fast tokenizers serialise their whole pipeline (normaliser, pre-tokeniser, model, post-processor)
+        hasher.update(tokenizer.backend_tokenizer.to_str().encode())
+    else:
+        hasher.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode())
+    hasher.update(json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str).encode())
+    hasher.update(json.dumps([max_length, getattr(tokenizer, "truncation_side", "right")]).encode())
+    return hasher.hexdigest()
+
+
+def write_stream(path, schema, batches):
+    """Write record batches as an Arrow IPC stream (the format datasets memory-maps), atomically."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with pa.OSFile(f"{path}.tmp", "wb") as sink, pa.ipc.new_stream(sink, schema) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+    os.replace(f"{path}.tmp", path)
+
+
+def read_stream(path):
+    """Memory-mapped table of an Arrow IPC stream file (no copy of the data)."""
+    with pa.memory_map(path, "r") as source:
+        return pa.ipc.open_stream(source).read_all()
+
+
+def read_manual_csv(path, keep_excluded=True):
+    """
+    Text and model label ids of a manual labelling file, as in process_manual_data(): duplicated texts keep
+    their first label, then rows marked irrelevant (2) or unlabelled get EXCLUDED_LABEL (or are dropped).
+    """
+    data = pd.read_csv(path, usecols=["text", "manual_label"])
+    data = data[data["text"].notna()].drop_duplicates("text", keep="first")
+    labels = data["manual_label"].where(data["manual_label"] != IRRELEVANT_LABEL).map(MODEL_LABEL2ID)
+    labels = labels.fillna(EXCLUDED_LABEL).astype(np.int64)
+    rows = pd.DataFrame({"text": data["text"].astype(str), "labels": labels})
+    return rows if keep_excluded else rows[rows["labels"] != EXCLUDED_LABEL]
+
+
+def balanced_sample(labels, size, rng):
+    """
+    Indices of up to size rows with classes as balanced as possible: a class with fewer rows than its
+    share gives the rest of its share to the other classes.
+    """
+    classes, counts = np.unique(labels, return_counts=True)
+    remaining = min(size, len(labels))
+    quotas = {}
+    for i, position in enumerate(np.argsort(counts)):
+        quotas[classes[position]] = min(counts[position], remaining // (len(classes) - i))
+        remaining -= quotas[classes[position]]
+    return np.concatenate([rng.choice(np.flatnonzero(labels == label), size=quota, replace=False)
+                           for label, quota in quotas.items()] + [np.empty(0, dtype=np.int64)])
+
+
+class TrainingStore:
+    """
+    Cumulative, Arrow-backed store of the manual labels used for fine-tuning.
+
+    Every round's manual file is read once into rows/<round>.arrow (re-read only if the file changes),
+    and tokenised once per tokenizer into tokens/<fingerprint>/<rows hash>.arrow, so preparing round N
+    only reads and tokenises the rows of round N. Training datasets memory-map these files.
+
+    Parameters:
+    - store_dir: Folder of the store
+    """
+
+    def __init__(self, store_dir=DEFAULT_STORE_DIR):
+        self.store_dir = store_dir
+        self.manifest_file = os.path.join(store_dir, "manifest.json")
+        self.parts = {}
+        if os.path.exists(self.manifest_file):
+            with open(self.manifest_file) as f:
+                self.parts = json.load(f)["parts"]
+
+    def save(self):
+        os.makedirs(self.store_dir, exist_ok=True)
+        with open(f"{self.manifest_file}.tmp", "w") as f:
+            json.dump({"parts": self.parts}, f, indent=4)
+        os.replace(f"{self.manifest_file}.tmp", self.manifest_file)
+
+    def rows_file(self, part):
+        return os.path.join(self.store_dir, "rows", f"{part}.arrow")
+
+    def add_file(self, part, path, round=None):
+        """Append a manual file as a part of the store, unless it was already added unchanged. Returns True if it was (re)read."""
+        stat = os.stat(path)
+        known = self.parts.get(part)
+        if known and known.get("rows_version") != ROWS_VERSION:
+            known = None
+        if known and known["size"] == stat.st_size and known["mtime_ns"] == stat.st_mtime_ns:
+            return False
+        digest = file_hash(path)
+        if known and known["source_hash"] == digest:
+            known.update(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+            return False
+
+        # The validation set is used whole, so its excluded rows are dropped
+        rows = read_manual_csv(path, keep_excluded=part != VAL_PART)
+        table = pa.Table.from_pandas(rows, schema=ROWS_SCHEMA, preserve_index=False)
+        write_stream(self.rows_file(part), ROWS_SCHEMA, table.to_batches())
+        self.parts[part] = {"round": round, "rows_version": ROWS_VERSION, "source": os.path.abspath(path),
+                            "source_hash": digest,
+                            "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "rows": len(rows),
+                            "rows_hash": hashlib.blake2b(pd.util.hash_pandas_object(rows, index=False).values.tobytes(),
+                                                         digest_size=16).hexdigest()}
+        return True
+
+    def ingest(self, manual_dir, val_file=None):
+        """Add the round<N>_manual_low_confidence.csv files of manual_dir (and the validation set) that are new or changed."""
+        added = []
+        for name in sorted(os.listdir(manual_dir)):
+            match = MANUAL_ROUND_RE.match(name)
+            if match and self.add_file(f"round{int(match.group(1))}", os.path.join(manual_dir, name), int(match.group(1))):
+                added.append(name)
+        if val_file and self.add_file(VAL_PART, val_file):
+            added.append(os.path.basename(val_file))
+        self.save()
+        return added
+
+    def rounds(self):
+        return sorted(info["round"] for part, info in self.parts.items() if part != VAL_PART)
+
+    def rows(self, part):
+        return read_stream(self.rows_file(part))
+
+    def train_indices(self, round=None):
+        """
+        Parts of rounds 1..round and the rows of their concatenation used for training: a text labelled
+        in several rounds keeps its latest label, and is dropped if that label is irrelevant or missing.
+        """
+        parts = [f"round{r}" for r in self.rounds() if round is None or r <= round]
+        texts = pd.concat([self.rows(part).column("text").to_pandas() for part in parts], ignore_index=True)
+        labels = np.concatenate([self.rows(part).column("labels").to_numpy() for part in parts])
+        latest = ~texts[::-1].duplicated(keep="first")[::-1].to_numpy()
+        return parts, np.flatnonzero(latest & (labels != EXCLUDED_LABEL))
+
+    def incremental_indices(self, round=None, replay=500, seed=42):
+        """
+        Rows of the given round (the latest by default) plus a class-balanced replay sample of at most
+        replay rows from the earlier rounds, so that the rows trained on per round stay bounded.
+        """
+        round = round or max(self.rounds())
+        parts, indices = self.train_indices(round)
+        if f"round{round}" not in parts:
+            raise KeyError(f"Round {round} is not in the store (rounds: {self.rounds()})")
+        part_of_row = np.repeat(np.arange(len(parts)), [self.parts[part]["rows"] for part in parts])
+        is_new = part_of_row[indices] == parts.index(f"round{round}")
+        old = indices[~is_new]
+        labels = np.concatenate([self.rows(part).column("labels").to_numpy() for part in parts])
+        replayed = old[balanced_sample(labels[old], replay, np.random.default_rng(seed))]
+        return parts, np.sort(np.concatenate([indices[is_new], replayed]))
+
+    def tokens_file(self, part, fingerprint):
+        return os.path.join(self.store_dir, "tokens", fingerprint, f"{self.parts[part]['rows_hash']}.arrow")
+
+    def tokenized(self, part, tokenizer, max_length=512):
+        """Path of the tokenised part (labels, input_ids, attention_mask), tokenising it on first use."""
+        path = self.tokens_file(part, tokenizer_fingerprint(tokenizer, max_length))
+        if not os.path.exists(path):
+            rows = self.rows(part)
+
+            def batches():
+                for batch in rows.to_batches(max_chunksize=TOKENIZE_BATCH):
+                    encoded = tokenizer(batch.column("text").to_pylist(), truncation=True, max_length=max_length)
+                    yield pa.record_batch([batch.column("labels"),
+                                           pa.array(encoded["input_ids"], type=pa.list_(pa.int32())),
+                                           pa.array(encoded["attention_mask"], type=pa.list_(pa.int8()))],
+                                          schema=TOKENS_SCHEMA)
+
+            write_stream(path, TOKENS_SCHEMA, batches())
+        return path
+
+    def dataset(self, tokenizer, round=None, max_length=512, replay=None, seed=42):
+        """
+        DatasetDict of the memory-mapped, tokenised train (rounds 1..round) and val sets, as process_manual_data()
+        returns. With replay, the train set is the round's rows plus a replay sample (see incremental_indices).
+        """
+        # datasets is only needed to build training datasets
+        from datasets import Dataset, DatasetDict, concatenate_datasets
+
+        if replay is None:
+            parts, indices = self.train_indices(round)
+        else:
+            parts, indices = self.incremental_indices(round, replay, seed)
+        train = concatenate_datasets([Dataset.from_file(self.tokenized(part, tokenizer, max_length)) for part in parts])
+        if len(indices) < len(train):
+            train = train.select(indices)
+        splits = {"train": train}
+        if VAL_PART in self.parts:
+            splits["val"] = Dataset.from_file(self.tokenized(VAL_PART, tokenizer, max_length))
+        return DatasetDict(splits)
+
+    def prune(self):
+        """Remove the tokenised files of rows that are no longer in the store."""
+        current = {f"{info['rows_hash']}.arrow" for info in self.parts.values()}
+        tokens_dir = os.path.join(self.store_dir, "tokens")
+        removed = 0
+        if os.path.isdir(tokens_dir):
+            for fingerprint in os.listdir(tokens_dir):
+                for name in os.listdir(os.path.join(tokens_dir, fingerprint)):
+                    if name not in current:
+                        os.remove(os.path.join(tokens_dir, fingerprint, name))
+                        removed += 1
+        return removed
+
+
+def main():
+    # Set up argument parser
+    parser = argparse.ArgumentParser(description='Add the manual labelling rounds to the cumulative training store')
+    parser.add_argument('--manual-dir', type=str, default='Data/Labelling/Manual',
+                        help='Folder of the round<N>_manual_low_confidence.csv files')
+    parser.add_argument('-v', '--val', type=str, default='Data/Labelling/Manual/manual_val_set.csv', help='Validation set')
+    parser.add_argument('-s', '--store', type=str, default=DEFAULT_STORE_DIR, help='Store folder')
+    parser.add_argument('-t', '--tokenizer', type=str, default=None, help='Also tokenise the store with this tokenizer')
+    parser.add_argument('--max-length', type=int, default=512, help='Maximum tokens per text')
+    parser.add_argument('--prune', action='store_true', help='Remove tokenised files of replaced rounds')
+
+    # Parse arguments
+    args = parser.parse_args()
+
+    store = TrainingStore(args.store)
+    added = store.ingest(args.manual_dir, val_file=args.val)
+    print("=" * 50)
+    print(f"Added: {', '.join(added) if added else 'nothing new'}")
+    for part, info in sorted(store.parts.items(), key=lambda item: (item[1]["round"] is None, item[1]["round"] or 0)):
+        print(f"{part:<10} {info['rows']:>7,} rows")
+    if args.tokenizer:
+        from transformers import AutoTokenizer
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+        for part in store.parts:
+            store.tokenized(part, tokenizer, args.max_length)
+        print(f"Tokenised with {args.tokenizer} ({tokenizer_fingerprint(tokenizer, args.max_length)})")
+    if args.prune:
+        print(f"Removed {store.prune()} stale tokenised files")
+    print("=" * 50)
+
+if __name__ == "__main__":
+    main()